@@ -12,10 +12,11 @@ except ImportError:
     gridspec = None
 import pymc
 import os
+import diagnostics
 from pylab import bar, hist, plot as pyplot, xlabel, ylabel, xlim, ylim, close, savefig, acorr, mlab
 from pylab import figure, subplot, subplots_adjust, gca, scatter, axvline, yticks, xticks
 from pylab import setp, axis, contourf, cm, title, colorbar, clf, fill, show, text
-from pylab import errorbar
+from pylab import errorbar, vlines, axhline
 from pprint import pformat
 
 # Import numpy functions
@@ -637,6 +638,26 @@ def gof_plot(simdata, trueval, name=None, nbins=None, format='png', suffix='-gof
     savefig("%s%s%s.%s" % (path, name or 'MCMC', suffix, format))
     #close()
 
+def _plot_acf(rho, name, maxlags, rows, fontmap):
+    """ Plot autocorrelations rho at lags 0, 1, ..., like pylab.acorr, in the current axes"""
+    lags = arange(len(rho))
+    vlines(concatenate((-lags[:0:-1], lags)), 0, concatenate((rho[:0:-1], rho)))
+    axhline(0, color='k')
+
+    # Set axis bounds
+    ylim(-.1, 1.1)
+    xlim(-maxlags, maxlags)
+
+    # Plot options
+    title('\n\n   %s acorr'%name, x=0., y=1., ha='left', va='top', fontsize='small')
+
+    # Smaller tick labels
+    tlabels = gca().get_xticklabels()
+    setp(tlabels, 'fontsize', fontmap[rows/2])
+
+    tlabels = gca().get_yticklabels()
+    setp(tlabels, 'fontsize', fontmap[rows/2])
+
 @plotwrapper
 def autocorrelation(data, name, maxlags=100, format='png', suffix='-acf', path='./', fontmap = {1:10, 2:8, 3:6, 4:5, 5:4}, new=True, last=True, rows=1, columns=1, num=1, verbose=1):
     """
@@ -678,28 +699,16 @@ def autocorrelation(data, name, maxlags=100, format='png', suffix='-acf', path='
             print 'Plotting', name
         figure()
 
-    subplot(rows, columns, num)
     if ndim(data) == 1:
-        acorr(data, detrend=mlab.detrend_mean, maxlags=maxlags)
-
-        # Set axis bounds
-        ylim(-.1, 1.1)
-        xlim(-maxlags, maxlags)
-
-        # Plot options
-        title('\n\n   %s acorr'%name, x=0., y=1., ha='left', va='top', fontsize='small')
-
-        # Smaller tick labels
-        tlabels = gca().get_xticklabels()
-        setp(tlabels, 'fontsize', fontmap[rows/2])
-
-        tlabels = gca().get_yticklabels()
-        setp(tlabels, 'fontsize', fontmap[rows/2])
+        subplot(rows, columns, num)
+        _plot_acf(diagnostics.autocorrelation(data, maxlags)[:, 0], name, maxlags, rows, fontmap)
     elif ndim(data) == 2:
-        # generate acorr plot for each dimension
+        # generate acorr plot for each dimension, from the autocorrelations of all dimensions computed at once
+        rho = diagnostics.autocorrelation(data, maxlags)
         rows = data.shape[1]
         for j in range(rows):
-            autocorrelation(data[:, j], '%s_%d' % (name, j), maxlags, fontmap=fontmap, rows=rows, columns=1, num=j+1)
+            subplot(rows, 1, j+1)
+            _plot_acf(rho[:, j], '%s_%d' % (name, j), maxlags, rows, fontmap)
     else:
         raise ValueError, 'Only 1- and 2- dimensional functions can be displayed' 
 
@@ -2,6 +2,71 @@
 
 import pylab as pl
 import pymc as mc
+import scipy.sparse
+
+
+def age_weight_operator(age_start, age_end, age_weights, n_ages):
+    """ Generate a sparse linear operator for integrating an age pattern over age intervals
+
+    :Parameters:
+      - `age_start, age_end` : int arrays, row i puts weight on age indices age_start[i] <= a < age_end[i]
+      - `age_weights` : list of arrays with len == n_ages, age_weights[i][a] is the weight of age index a in row i
+      - `n_ages` : int
+
+    :Results:
+      - Returns dict with 'W', a scipy.sparse.csr_matrix with a normalized row for each distinct
+        (age_start, age_end, age_weights) combination, and 'index', an int array mapping each row to its row of 'W'
+
+    .. note::
+      - rows with an empty interval or zero total weight put all weight on age_start[i]
+      - rows are considered duplicates if they have equal intervals and share the same age_weights array object
+
+    """
+    n = len(age_start)
+    index = pl.zeros(n, dtype=int)
+    row_for = {}
+    rows, cols, vals = [], [], []
+    for i, a0, a1, w in zip(range(n), age_start, age_end, age_weights):
+        key = (a0, a1, id(w))
+        if key not in row_for:
+            j = len(row_for)
+            row_for[key] = j
+
+            w_j = pl.array(w[a0:a1], dtype=float)
+            if len(w_j) == 0 or w_j.sum() <= 0.:
+                rows.append(j)
+                cols.append(a0)
+                vals.append(1.)
+            else:
+                rows += [j] * len(w_j)
+                cols += range(a0, a0+len(w_j))
+                vals += list(w_j / w_j.sum())
+        index[i] = row_for[key]
+
+    W = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(row_for), n_ages))
+    return dict(W=W, index=index)
+
+
+def mu_interval_from_operator(name, mu_age, operator):
+    """ Generate PyMC deterministic for the age-integrated rate of each row
+
+    :Parameters:
+      - `name` : str
+      - `mu_age` : pymc.Node with values of PCGP
+      - `operator` : dict, from age_weight_operator
+
+    :Results:
+      - Returns 'mu_interval', a pymc.Deterministic equal to W * mu_age for each row
+
+    """
+    W = operator['W']
+    index = operator['index']
+
+    @mc.deterministic(name='mu_interval_%s'%name)
+    def mu_interval(mu_age=mu_age):
+        return (W * mu_age)[index]
+
+    return mu_interval
 
 
 def age_standardize_approx(name, age_weights, mu_age, age_start, age_end, ages):
@@ -19,30 +84,17 @@ def age_standardize_approx(name, age_weights, mu_age, age_start, age_end, ages):
     Returns dict of PyMC objects, including 'mu_interval'
     the approximate integral of gamma  data predicted stochastic
     """
-    cum_sum_weights = pl.cumsum(age_weights)
-
-    @mc.deterministic(name='cum_sum_mu_%s'%name)
-    def weighted_sum_mu(mu_age=mu_age, age_weights=age_weights):
-        return pl.cumsum(mu_age*age_weights)
-
-    age_start = age_start.__array__().clip(ages[0], ages[-1]) - ages[0]  # FIXME: Pandas bug, makes clip require __array__()
-    age_end = age_end.__array__().clip(ages[0], ages[-1]) - ages[0]
-    pl.seterr('ignore')
-    @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(weighted_sum_mu=weighted_sum_mu, cum_sum_weights=cum_sum_weights,
-                    mu_age=mu_age,
-                    age_start=pl.array(age_start, dtype=int),
-                    age_end=pl.array(age_end, dtype=int)):
-        mu = (weighted_sum_mu[age_end] - weighted_sum_mu[age_start]) / (cum_sum_weights[age_end] - cum_sum_weights[age_start])
-        
-        # correct cases where age_start == age_end
-        i = age_start == age_end
-        if pl.any(i):
-            mu[i] = mu_age[age_start[i]]
+    age_start = pl.array(age_start.__array__().clip(ages[0], ages[-1]) - ages[0], dtype=int)  # FIXME: Pandas bug, makes clip require __array__()
+    age_end = pl.array(age_end.__array__().clip(ages[0], ages[-1]) - ages[0], dtype=int)
 
-        return mu
+    # the weighted sum includes ages age_start+1 through age_end,
+    # or just age_start if age_start == age_end
+    age_weights = pl.array(age_weights, dtype=float)
+    op_start = pl.where(age_start < age_end, age_start+1, age_start)
+    op_end = pl.where(age_start < age_end, age_end+1, age_start)
+    operator = age_weight_operator(op_start, op_end, [age_weights]*len(age_start), len(ages))
 
-    return dict(mu_interval=mu_interval)
+    return dict(mu_interval=mu_interval_from_operator(name, mu_age, operator))
 
 def age_integrate_approx(name, age_weights, mu_age, age_start, age_end, ages):
     """ Generate PyMC objects for approximating the integral of gamma from age_start[i] to age_end[i]
@@ -59,28 +111,23 @@ def age_integrate_approx(name, age_weights, mu_age, age_start, age_end, ages):
     Returns dict of PyMC objects, including 'mu_interval'
     the approximate integral of gamma  data predicted stochastic
     """
-    # FIXME: should use final age weight
-    age_weights = [pl.array([1.e-9+float(w_ia) for w_ia in w_i.split(';')][:-1]) for w_i in age_weights]
-    wt_sum = pl.array([sum(w_i) for w_i in age_weights])
+    age_start = pl.array(age_start.__array__().clip(ages[0], ages[-1]) - ages[0], dtype=int)  # FIXME: Pandas bug, makes clip require __array__()
+    age_end = pl.array(age_end.__array__().clip(ages[0], ages[-1]) - ages[0], dtype=int)
 
-    age_start = age_start.__array__().clip(ages[0], ages[-1]) - ages[0]  # FIXME: Pandas bug, makes clip require __array__()
-    age_end = age_end.__array__().clip(ages[0], ages[-1]) - ages[0]
-    pl.seterr('ignore')
-    @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(age_weights=age_weights,
-                    wt_sum=wt_sum,
-                    mu_age=mu_age,
-                    age_start=pl.array(age_start, dtype=int),
-                    age_end=pl.array(age_end, dtype=int)):
-        N = len(age_weights)
-        mu = pl.zeros(N)
-
-        for i in range(N):
-            mu[i] = pl.dot(age_weights[i], mu_age[age_start[i]:age_end[i]]) / wt_sum[i]
+    # parse each distinct (age_start, age_weights) once, into weights on the full age range
+    # FIXME: should use final age weight
+    parsed = {}
+    weights = []
+    for a0, w_i in zip(age_start, age_weights):
+        if (a0, w_i) not in parsed:
+            w = [1.e-9+float(w_ia) for w_ia in w_i.split(';')][:-1][:len(ages)-a0]
+            parsed[a0, w_i] = pl.zeros(len(ages))
+            parsed[a0, w_i][a0:a0+len(w)] = w
+        weights.append(parsed[a0, w_i])
 
-        return mu
+    operator = age_weight_operator(age_start, age_end, weights, len(ages))
 
-    return dict(mu_interval=mu_interval)
+    return dict(mu_interval=mu_interval_from_operator(name, mu_age, operator))
 
 
 def midpoint_approx(name, mu_age, age_start, age_end, ages):
@@ -97,13 +144,10 @@ def midpoint_approx(name, mu_age, age_start, age_end, ages):
     Returns dict of PyMC objects, including 'mu_interval'
     the approximate integral of gamma  data predicted stochastic
     """
-    age_mid = (age_start + age_end) / 2.
-    @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(mu_age=mu_age,
-                    age_mid=pl.array(age_mid, dtype=int)):
-        return mu_age.take(pl.clip(age_mid, ages[0], ages[-1]) - ages[0])
+    age_mid = midpoint_index(age_start, age_end, ages)
+    operator = age_weight_operator(age_mid, age_mid+1, [pl.ones(len(ages))]*len(age_mid), len(ages))
 
-    return dict(mu_interval=mu_interval)
+    return dict(mu_interval=mu_interval_from_operator(name, mu_age, operator))
 
 
 def midpoint_covariate_approx(name, mu_age, age_start, age_end, ages, transform=lambda x: x):
@@ -123,14 +167,31 @@ def midpoint_covariate_approx(name, mu_age, age_start, age_end, ages, transform=
     """
     theta = mc.Normal('theta_%s'%name, 0., 10.**-2, value=0.)
 
-    age_mid = (age_start + age_end) / 2.
+    age_mid = midpoint_index(age_start, age_end, ages)
+    operator = age_weight_operator(age_mid, age_mid+1, [pl.ones(len(ages))]*len(age_mid), len(ages))
+    mu_mid = mu_interval_from_operator('mid_%s'%name, mu_age, operator)
+
     age_width = transform(age_end - age_start)
     @mc.deterministic(name='mu_interval_%s'%name)
-    def mu_interval(mu_age=mu_age,
+    def mu_interval(mu_mid=mu_mid,
                     theta=theta,
-                    age_mid=pl.array(age_mid, dtype=int),
                     age_width=pl.array(age_width, dtype=float)):
         
-        return mu_age.take(pl.clip(age_mid, ages[0], ages[-1]) - ages[0]) + theta*age_width
+        return mu_mid + theta*age_width
 
     return dict(mu_interval=mu_interval, theta=theta)
+
+
+def midpoint_index(age_start, age_end, ages):
+    """ Find index of the age at the midpoint of each age interval
+
+    :Parameters:
+      - `age_start, age_end` : array
+      - `ages` : array
+
+    :Results:
+      - Returns int array of indices into ages
+
+    """
+    age_mid = pl.array((age_start + age_end) / 2., dtype=int)
+    return pl.array(pl.clip(age_mid, ages[0], ages[-1]) - ages[0], dtype=int)
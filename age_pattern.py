@@ -2,9 +2,41 @@
 
 import pylab as pl
 import pymc as mc
+import scipy.interpolate
 
+_basis_cache = {}
 
-def spline(name, ages, knots, smoothing, interpolation_method='linear'):
+def spline_basis(knots, ages, interpolation_method='linear'):
+    """ Find the matrix B that maps values at the knots to values at the ages
+
+    Parameters
+    ----------
+    knots : array, strictly increasing
+    ages : array, points to interpolate to
+    interpolation_method : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, 'cubic'
+
+    Results
+    -------
+    Returns array B of shape (len(ages), len(knots)), so that
+    interp1d(knots, y, kind=interpolation_method)(ages) == dot(B, y)
+
+    Notes
+    -----
+    Every supported interpolation method is linear in the values at
+    the knots (for quadratic and cubic this is the spline coefficient
+    solve), so B is found once by interpolating the identity matrix,
+    and cached for each (knots, ages, interpolation_method)
+    """
+    key = (tuple(knots), tuple(ages), interpolation_method)
+    if key not in _basis_cache:
+        I = pl.eye(len(knots))
+        f = scipy.interpolate.interp1d(knots, I, kind=interpolation_method, axis=0, bounds_error=False, fill_value=0.)
+        B = pl.array(f(ages), dtype=float)
+        B.flags.writeable = False
+        _basis_cache[key] = B
+    return _basis_cache[key]
+
+def spline(name, ages, knots, smoothing, interpolation_method='linear', use_basis=False):
     """ Generate PyMC objects for a piecewise constant Gaussian process (PCGP) model
 
     Parameters
@@ -14,6 +46,7 @@ def spline(name, ages, knots, smoothing, interpolation_method='linear'):
     ages : array, points to interpolate to
     smoothing : pymc.Node, smoothness parameter for smoothing spline
     interpolation_method : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, 'cubic'
+    use_basis : bool, optional, evaluate mu_age as a precomputed basis matrix times exp(gamma), instead of building an interp1d at each step
 
     Results
     -------
@@ -29,11 +62,16 @@ def spline(name, ages, knots, smoothing, interpolation_method='linear'):
     flat_gamma = mc.Lambda('flat_gamma_%s'%name, lambda gamma=gamma: pl.array([x for x in pl.flatten(gamma)]))
 
 
-    import scipy.interpolate
-    @mc.deterministic(name='mu_age_%s'%name)
-    def mu_age(gamma=flat_gamma, knots=knots, ages=ages):
-        mu = scipy.interpolate.interp1d(knots, pl.exp(gamma), kind=interpolation_method, bounds_error=False, fill_value=0.)
-        return mu(ages)
+    if use_basis:
+        B = spline_basis(knots, ages, interpolation_method)
+        @mc.deterministic(name='mu_age_%s'%name)
+        def mu_age(gamma=flat_gamma, B=B):
+            return pl.dot(B, pl.exp(gamma))
+    else:
+        @mc.deterministic(name='mu_age_%s'%name)
+        def mu_age(gamma=flat_gamma, knots=knots, ages=ages):
+            mu = scipy.interpolate.interp1d(knots, pl.exp(gamma), kind=interpolation_method, bounds_error=False, fill_value=0.)
+            return mu(ages)
 
     vars = dict(gamma=gamma, mu_age=mu_age, ages=ages, knots=knots)
 
@@ -163,6 +163,31 @@ pop_C_ui_per_1000 = '[%.0f, %.0f]' % tuple(pop_C_ui*1000)
 print pop_C_ui_per_1000
 
 
+### @export 'beta-binomial-marginal-timing'
+import time
+import rate_model
+
+def time_beta_binomial(rate_type, r, n, iter=2000):
+    """ Time MCMC for the rate_model beta-binomial likelihood with one
+    latent Beta stoch per row, or with the latent rates integrated out"""
+    N = len(r)
+    mu = mc.Uniform('mu', 0., 1., value=.001)
+    pi = mc.Lambda('pi', lambda mu=mu: mu*pl.ones(N))
+    model_vars = getattr(rate_model, rate_type)('schiz', pi, r, n)
+    model_vars.update(mu=mu, pi=pi)
+
+    start_time = time.time()
+    mc.MCMC(model_vars).sample(iter, verbose=False, progress_bar=False)
+    return time.time() - start_time
+
+beta_binomial_seconds = {}
+for reps in [1, 10, 50]:
+    for rate_type in ['beta_binom', 'marginal_beta_binom']:
+        beta_binomial_seconds['%s_%d' % (rate_type, reps*len(r))] = time_beta_binomial(rate_type, pl.tile(r, reps), pl.tile(n, reps))
+    print '%d rows: latent %.1fs, marginal %.1fs' % (reps*len(r), beta_binomial_seconds['beta_binom_%d' % (reps*len(r))],
+                                                     beta_binomial_seconds['marginal_beta_binom_%d' % (reps*len(r))])
+
+
 ### @export 'save-vars'
 book_graphics.save_json('beta_binomial_model.json', vars())
 
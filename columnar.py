@@ -0,0 +1,234 @@
+""" Typed columnar storage for DataFrames and area hierarchies
+
+A DataFrame is stored as a directory with one .npy file per column
+and a meta.json describing them, so that loading reads each column as
+a typed array instead of parsing text, and a subset of the columns can
+be read without touching the rest.  load_column returns the
+memory-mapped arrays themselves; load_frame copies them once into a
+DataFrame.  Numeric columns are stored as
+they are, text columns as integer codes into a list of levels, and
+ragged columns (like the semicolon-delimited age_weights) as a flat
+array of values with an array of offsets.  Ragged columns load as an
+array of float arrays, one for each row, so no precision is lost to
+formatting them as text again; ragged_text() formats them for csv.
+
+A hierarchy is stored as its list of nodes with a parent-index
+array, where parent[i] is the position of the parent of node i, or
+-1 for the root.
+"""
+
+import os
+
+import numpy as np
+import pandas
+import networkx as nx
+import simplejson as json
+
+def _column_kind(values):
+    """ Find how to store a column: numeric, or text as codes into levels"""
+    if values.dtype.kind in 'biuf':
+        return 'numeric'
+    for v in values:
+        if isinstance(v, basestring):
+            return 'category'
+    try:
+        np.array(values, dtype=float)
+        return 'numeric'
+    except (TypeError, ValueError):
+        return 'category'
+
+def _str(v):
+    """ Convert json unicode back to str when possible, to match what read_csv produces"""
+    if isinstance(v, unicode):
+        try:
+            return str(v)
+        except UnicodeEncodeError:
+            pass
+    return v
+
+def save_column(values, dir, fname, kind):
+    """ Save an array of column values in dir/fname.npy (and dir/fname-offsets.npy
+    for ragged columns)
+
+    :Results:
+      - Returns dict describing the column, for meta.json
+    """
+    desc = dict(kind=kind, file=fname)
+    if kind == 'numeric':
+        values = np.asarray(values)
+        if values.dtype.kind not in 'biuf':
+            values = np.array(values, dtype=float)
+        np.save('%s/%s.npy' % (dir, fname), values)
+
+    elif kind == 'ragged':
+        rows = []
+        for v in values:
+            if isinstance(v, basestring):
+                rows.append([float(w) for w in v.split(';') if w])
+            elif isinstance(v, (list, tuple, np.ndarray)):
+                rows.append([float(w) for w in v])
+            else:
+                rows.append([])
+        offsets = np.cumsum([0] + [len(r) for r in rows])
+        np.save('%s/%s.npy' % (dir, fname), np.array(sum(rows, []), dtype=float))
+        np.save('%s/%s-offsets.npy' % (dir, fname), offsets)
+
+    else:
+        levels = sorted(set([v for v in values if not pandas.isnull(v)]))
+        index = dict([(v, i) for i, v in enumerate(levels)])
+        codes = np.array([index.get(v, -1) if not pandas.isnull(v) else -1 for v in values], dtype=np.int32)
+        np.save('%s/%s.npy' % (dir, fname), codes)
+        desc['levels'] = levels
+
+    return desc
+
+def load_column(dir, desc, mmap_mode='r', as_text=True):
+    """ Load a column saved by save_column()
+
+    :Parameters:
+      - `dir` : str, directory of the DataFrame
+      - `desc` : dict, from meta.json
+      - `mmap_mode` : str, optional, as for np.load; numeric columns are memory-mapped by default
+      - `as_text` : bool, optional, if False, return ragged columns as (values, offsets)
+        and text columns as (codes, levels) instead of arrays of objects
+
+    :Results:
+      - Returns array of column values; for ragged columns, an array of
+        float arrays, one for each row
+    """
+    values = np.load('%s/%s.npy' % (dir, desc['file']), mmap_mode=mmap_mode)
+    if desc['kind'] == 'numeric':
+        return values
+
+    elif desc['kind'] == 'ragged':
+        offsets = np.load('%s/%s-offsets.npy' % (dir, desc['file']))
+        if not as_text:
+            return values, offsets
+        col = np.empty(len(offsets)-1, dtype=object)
+        for i in range(len(offsets)-1):
+            col[i] = np.array(values[offsets[i]:offsets[i+1]])
+        return col
+
+    else:
+        levels = [_str(v) for v in desc['levels']]
+        if not as_text:
+            return values, levels
+        col = np.empty(len(values), dtype=object)
+        col[:] = [levels[c] if c >= 0 else np.nan for c in values]
+        return col
+
+def ragged_text(values):
+    """ Format a ragged column as semicolon-delimited text, as it is stored in csv files
+
+    :Parameters:
+      - `values` : list of str or float arrays, e.g. from load_column
+
+    :Results:
+      - Returns list of str, with rows that are not float arrays unchanged
+    """
+    text = []
+    for v in values:
+        if isinstance(v, (list, tuple, np.ndarray)):
+            v = ';'.join([repr(float(w)) for w in v])
+        text.append(v)
+    return text
+
+def save_frame(df, dir, ragged=[]):
+    """ Save a DataFrame in columnar format
+
+    :Parameters:
+      - `df` : pandas.DataFrame
+      - `dir` : str, directory to save in, created if necessary
+      - `ragged` : list of str, optional, columns of semicolon-delimited numbers
+    """
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    columns = []
+    for i, c in enumerate(df.columns):
+        values = np.array(df[c])
+        kind = (c in ragged) and 'ragged' or _column_kind(values)
+        desc = save_column(values, dir, 'col%d' % i, kind)
+        desc['name'] = c
+        columns.append(desc)
+
+    index = np.array(df.index)
+    index_desc = save_column(index, dir, 'index', _column_kind(index))
+
+    f = open(dir + '/meta.json', 'w')
+    json.dump(dict(columns=columns, index=index_desc, length=len(df.index)), f, indent=2)
+    f.close()
+
+def load_frame(dir, columns=None, mmap_mode='r'):
+    """ Load a DataFrame saved by save_frame()
+
+    :Parameters:
+      - `dir` : str, directory it was saved in
+      - `columns` : list of str, optional, the columns to read, all columns by default
+      - `mmap_mode` : str, optional, as for np.load
+
+    :Results:
+      - Returns pandas.DataFrame, with columns in the order they were saved
+
+    .. note::
+      - the DataFrame holds copies of the columns, not the memory-mapped
+        files; use load_column to work on the files without copying
+    """
+    meta = json.load(open(dir + '/meta.json'))
+    if columns != None:
+        missing = set(columns) - set([_str(c['name']) for c in meta['columns']])
+        assert not missing, 'columns %s not found in %s' % (', '.join(missing), dir)
+
+    names = []
+    data = {}
+    for desc in meta['columns']:
+        name = _str(desc['name'])
+        if columns != None and name not in columns:
+            continue
+        names.append(name)
+        data[name] = load_column(dir, desc, mmap_mode)
+
+    index = load_column(dir, meta['index'], mmap_mode)
+    return pandas.DataFrame(data, index=index, columns=names)
+
+def save_hierarchy(G, dir):
+    """ Save a tree-shaped nx.DiGraph as a node list and parent-index array
+
+    :Parameters:
+      - `G` : nx.DiGraph, with at most one predecessor for each node
+      - `dir` : str, directory to save in, created if necessary
+    """
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    nodes = sorted(G.nodes())
+    index = dict([(n, i) for i, n in enumerate(nodes)])
+    parent = -np.ones(len(nodes), dtype=np.int32)
+    edge_data = [None] * len(nodes)
+    edge_order = []  # child of each edge, in the order G lists them, which is the order of successors
+    for u, v in G.edges():
+        assert parent[index[v]] == -1, 'hierarchy must be a tree, but %s has more than one parent' % v
+        parent[index[v]] = index[u]
+        edge_data[index[v]] = G.edge[u][v]
+        edge_order.append(index[v])
+
+    np.save(dir + '/parent.npy', parent)
+    f = open(dir + '/meta.json', 'w')
+    json.dump(dict(nodes=[[n, G.node[n]] for n in nodes], edges=edge_data, edge_order=edge_order), f, indent=2)
+    f.close()
+
+def load_hierarchy(dir):
+    """ Load a hierarchy saved by save_hierarchy()
+
+    :Results:
+      - Returns nx.DiGraph, with edges added in the order they were saved,
+        since the order of successors sets the order of the random effects
+    """
+    meta = json.load(open(dir + '/meta.json'))
+    parent = np.load(dir + '/parent.npy')
+    nodes = [_str(n) for n, attr in meta['nodes']]
+
+    G = nx.DiGraph()
+    G.add_nodes_from([(n, attr) for n, (name, attr) in zip(nodes, meta['nodes'])])
+    G.add_edges_from([(nodes[parent[i]], nodes[i], meta['edges'][i] or {}) for i in meta['edge_order']])
+    return G
@@ -0,0 +1,118 @@
+""" Closed-form solution of the two-compartment S/C model
+
+The prevalence from the Dismod ODE does not depend on background
+mortality, because it removes people from S and C at the same rate.
+What remains is the linear system::
+
+    S'(a) = - i(a) S(a) + r(a) C(a)
+    C'(a) = + i(a) S(a) - [r(a) + f(a)] C(a)
+
+With i, r, f piecewise constant on each age interval (using the value
+at the start of the interval, as in dismod_ode), this system has a
+closed-form 2x2 matrix-exponential solution on each interval.  The
+functions here compute it for all ages at once, with an optional
+batch dimension, so a single call can solve for many parameter vectors
+(for example, all posterior draws).
+"""
+
+import pylab as pl
+
+
+def transition_matrices(i, r, f, h):
+    """ Find the matrix exponential of the S/C system on each age interval
+
+    :Parameters:
+      - `i, r, f` : arrays of the same shape, constant incidence, remission and excess-mortality on each interval
+      - `h` : array, broadcastable to the shape of i, width of each interval
+
+    :Results:
+      - Returns tuple (m11, m12, m21, m22) of arrays with the entries of
+        exp(A h), each scaled by exp(-lambda h) for the dominant eigenvalue lambda
+        of A, so that products over many intervals do not underflow
+
+    .. note::
+      - The scaling does not change the ratio C/(S+C)
+      - A has real eigenvalues tr/2 +/- delta, with delta^2 = (i+r+f)^2/4 - i*f >= 0
+
+    """
+    i = pl.array(i, dtype=float)
+    r = pl.array(r, dtype=float)
+    f = pl.array(f, dtype=float)
+
+    half_tr = -.5*(i + r + f)
+    delta = pl.sqrt((half_tr**2 - i*f).clip(0., pl.inf))
+
+    # exp(A h) exp(-lambda h) = c I + s (A - tr/2 I)
+    c = .5*(1. + pl.exp(-2.*delta*h))
+    s = h * pl.ones_like(delta)
+    nonzero = delta*h > 1.e-8
+    s[nonzero] = -pl.expm1(-2.*(delta*h)[nonzero]) / (2.*delta[nonzero])
+
+    return (c + s*(-i - half_tr),
+            s*r,
+            s*i,
+            c + s*(-(r+f) - half_tr))
+
+
+def cumulative_transitions(M):
+    """ Find the products of transition matrices from the first age to each age
+
+    :Parameters:
+      - `M` : tuple of 4 arrays, with last dimension N-1, from transition_matrices
+
+    :Results:
+      - Returns tuple of 4 arrays with last dimension N, the entries of
+        P_k = M_{k-1} ... M_0 (P_0 is the identity)
+
+    .. note::
+      - uses a log-depth prefix scan, so the work is vectorized across ages
+
+    """
+    shape = M[0].shape[:-1] + (M[0].shape[-1]+1,)
+    P = [pl.zeros(shape) for k in range(4)]
+    for k in range(4):
+        P[k][..., 1:] = M[k]
+    P[0][..., 0] = 1.
+    P[3][..., 0] = 1.
+
+    d = 1
+    while d < shape[-1]:
+        p11, p12, p21, p22 = [P_k.copy() for P_k in P]
+        p11[..., d:] = P[0][..., d:]*P[0][..., :-d] + P[1][..., d:]*P[2][..., :-d]
+        p12[..., d:] = P[0][..., d:]*P[1][..., :-d] + P[1][..., d:]*P[3][..., :-d]
+        p21[..., d:] = P[2][..., d:]*P[0][..., :-d] + P[3][..., d:]*P[2][..., :-d]
+        p22[..., d:] = P[2][..., d:]*P[1][..., :-d] + P[3][..., d:]*P[3][..., :-d]
+        P = [p11, p12, p21, p22]
+        d *= 2
+
+    return P
+
+
+def prevalence(i, r, f, C0, ages):
+    """ Solve for prevalence at each age
+
+    :Parameters:
+      - `i, r, f` : arrays with last dimension len(ages), incidence, remission and excess-mortality;
+        leading dimensions (if any) are treated as a batch
+      - `C0` : float or array matching the batch dimensions, prevalence at ages[0]
+      - `ages` : array
+
+    :Results:
+      - Returns array of prevalence, with the same shape as i
+
+    """
+    ages = pl.array(ages, dtype=float)
+    i = pl.array(i, dtype=float)
+    r = pl.array(r, dtype=float)
+    f = pl.array(f, dtype=float)
+
+    M = transition_matrices(i[..., :-1], r[..., :-1], f[..., :-1], pl.diff(ages))
+    P = cumulative_transitions(M)
+
+    C0 = pl.array(C0, dtype=float)[..., pl.newaxis]
+    S = P[0]*(1.-C0) + P[1]*C0
+    C = P[2]*(1.-C0) + P[3]*C0
+
+    p = C / (S + C)
+    p[pl.isnan(p)] = 0.
+    return p
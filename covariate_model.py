@@ -3,7 +3,9 @@
 import pylab as pl
 import pymc as mc
 import pandas
-import networkx as nx
+import scipy.sparse
+
+import hierarchy_index
 
 sex_value = {'male': .5, 'total':0., 'female': -.5}
 
@@ -27,8 +29,59 @@ def MyTruncatedNormal(name, mu, tau, a, b, value):
             return mc.normal_like(value, mu, tau)
         else:
             return -pl.inf
+
+    # mark for flat_model, which computes this log-likelihood in vectorized form
+    my_trunc_norm.logp_kind = 'truncated_normal'
     return my_trunc_norm
 
+def ancestor_matrix(hierarchy, nodes, root='all', index=None):
+    """ Find the path from the root to every node of the area hierarchy
+
+    :Parameters:
+      - `hierarchy` : networkx.DiGraph
+      - `nodes` : list of nodes, in the order to use for rows and column indices
+      - `root` : str, optional
+      - `index` : dict, optional, from hierarchy_index.build(hierarchy, root), to reuse between calls
+
+    :Results:
+      - Returns an int array with a row for each node, where row j
+        holds the column indices of the path from `root` to nodes[j],
+        padded with -1 (rows for nodes not reachable from `root` are all -1)
+
+    """
+    if index is None:
+        index = hierarchy_index.build(hierarchy, root)
+    col_index = dict([(node, j) for j, node in enumerate(nodes)])
+
+    # column of each id in the index, with an extra -1 at the end so that padding maps to padding
+    col = pl.array([col_index[node] for node in index['nodes']] + [-1], dtype=int)
+    return col[hierarchy_index.row_ancestors(index, nodes)]
+
+def area_indicator_matrix(areas, nodes, ancestors):
+    """ Generate sparse indicator matrix of area random effects
+
+    :Parameters:
+      - `areas` : list of str, area of each row of data
+      - `nodes` : list of nodes in the area hierarchy, in column order
+      - `ancestors` : int array, from ancestor_matrix(hierarchy, nodes)
+
+    :Results:
+      - Returns scipy.sparse.csr_matrix with U[i,j] == 1 if nodes[j] is on the path to areas[i]
+
+    """
+    col_index = dict([(node, j) for j, node in enumerate(nodes)])
+    row_node = pl.array([col_index.get(a, -1) for a in areas], dtype=int)
+
+    for a in sorted(set([a for a, j in zip(areas, row_node) if j < 0])):
+        print 'WARNING: "%s" not in model hierarchy, skipping random effects for this observation' % a
+
+    # take the ancestor rows for each observation, and drop the padding
+    A = ancestors[pl.maximum(row_node, 0)]
+    A[row_node < 0] = -1
+    i, k = pl.where(A >= 0)
+
+    return scipy.sparse.csr_matrix((pl.ones(len(i)), (i, A[i, k])), shape=(len(row_node), len(nodes)))
+
 def mean_covariate_model(name, mu, input_data, parameters, model, root_area, root_sex, root_year, zero_re=True):
     """ Generate PyMC objects covariate adjusted version of mu
 
@@ -46,50 +99,41 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
     n = len(input_data.index)
 
     # make U and alpha
-    p_U = model.hierarchy.number_of_nodes()  # random effects for area
-    U = pandas.DataFrame(pl.zeros((n, p_U)), columns=model.hierarchy.nodes(), index=input_data.index)
-    for i, row in input_data.T.iteritems():
-        if row['area'] not in model.hierarchy:
-            print 'WARNING: "%s" not in model hierarchy, skipping random effects for this observation' % row['area']
-            continue
-        
-        for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', input_data.ix[i, 'area'])):
-            model.hierarchy.node[node]['level'] = level
-            U.ix[i, node] = 1.
-            
-    for n2 in model.hierarchy.nodes():
-        for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', n2)):
-                        model.hierarchy.node[node]['level'] = level
-                        
-    #U = U.select(lambda col: U[col].std() > 1.e-5, axis=1)  # drop constant columns
-    if len(U.index) == 0:
-        U = pandas.DataFrame()
-    else:
-        U = U.select(lambda col: (U[col].max() > 0) and (model.hierarchy.node[col].get('level') > model.hierarchy.node[root_area]['level']), axis=1)  # drop columns with only zeros and which are for higher levels in hierarchy
-        #U = U.select(lambda col: model.hierarchy.node[col].get('level') <= 2, axis=1)  # drop country-level REs
-        #U = U.drop(['super-region_0', 'north_america_high_income', 'USA'], 1)
+    index = hierarchy_index.build(model.hierarchy)
+    nodes = model.hierarchy.nodes()
+    ancestors = ancestor_matrix(model.hierarchy, nodes, index=index)
+    level = (ancestors >= 0).sum(axis=1) - 1
+    level_of = dict(zip(nodes, level))
 
-        #U = U.drop(['super-region_0', 'north_america_high_income'], 1)
-        #U = U.drop(U.columns, 1)
+    U = area_indicator_matrix(input_data['area'], nodes, ancestors)
 
+    columns = []
+    if n > 0:
+        # drop columns with only zeros and which are for higher levels in hierarchy
+        cnt = pl.array(U.sum(axis=0)).ravel()
+        keep = (cnt > 0) & (level > level_of[root_area])
 
         ## drop random effects with less than 1 observation or with all observations set to 1, unless they have an informative prior
-        keep = []
-        if 'random_effects' in parameters:
-            for re in parameters['random_effects']:
-                if parameters['random_effects'][re].get('dist') == 'Constant':
-                    keep.append(re)
-        U = U.select(lambda col: 1 <= U[col].sum() < len(U[col]) or col in keep, axis=1)
+        const = [re for re in parameters.get('random_effects', {}) if parameters['random_effects'][re].get('dist') == 'Constant']
+        keep &= ((cnt >= 1) & (cnt < n)) | pl.array([node in const for node in nodes], dtype=bool)
 
+        columns = [node for j, node in enumerate(nodes) if keep[j]]
 
-    U_shift = pandas.Series(0., index=U.columns)
-    for level, node in enumerate(nx.shortest_path(model.hierarchy, 'all', root_area)):
+    U_shift = pandas.Series(0., index=columns)
+    for node in hierarchy_index.path(index, root_area):
         if node in U_shift:
             U_shift[node] = 1.
-    U = U - U_shift
+
+    # the sparse matrix is used to calculate pi, the DataFrame is kept for reference in output
+    if len(columns) > 0:
+        U_sparse = U[:, pl.where(keep)[0]].tocsr()
+        U = pandas.DataFrame(U_sparse.toarray(), columns=columns, index=input_data.index) - U_shift
+    else:
+        U_sparse = None
+        U = pandas.DataFrame()
 
     sigma_alpha = []
-    for i in range(5):  # max depth of hierarchy is 5
+    for i in range(hierarchy_index.levels(index)):  # one for each level of the hierarchy
         effect = 'sigma_alpha_%s_%d'%(name,i)
         if 'random_effects' in parameters and effect in parameters['random_effects']:
             prior = parameters['random_effects'][effect]
@@ -105,10 +149,7 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
     const_alpha_sigma = pl.array([])
     alpha_potentials = []
     if len(U.columns) > 0:
-        tau_alpha_index = []
-        for alpha_name in U.columns:
-            tau_alpha_index.append(model.hierarchy.node[alpha_name]['level'])
-        tau_alpha_index=pl.array(tau_alpha_index, dtype=int)
+        tau_alpha_index = pl.array([level_of[alpha_name] for alpha_name in U.columns], dtype=int)
 
         tau_alpha_for_alpha = [sigma_alpha[i]**-2 for i in tau_alpha_index]
 
@@ -184,10 +225,7 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
             output_template = model.output_template.groupby(['area', 'sex', 'year']).first()
         covs = output_template.filter(list(X.columns) + ['pop'])
         if len(covs.columns) > 1:
-            leaves = [n for n in nx.traversal.bfs_tree(model.hierarchy, root_area) if model.hierarchy.successors(n) == []]
-            if len(leaves) == 0:
-                # networkx returns an empty list when the bfs tree is a single node
-                leaves = [root_area]
+            leaves = hierarchy_index.leaves(index, root_area)
 
             if root_sex == 'total' and root_year == 'all':  # special case for all years and sexes
                 covs = covs.delevel().drop(['year', 'sex'], axis=1).groupby('area').mean()  # TODO: change to .reset_index(), but that doesn't work with old pandas
@@ -240,11 +278,29 @@ def mean_covariate_model(name, mu, input_data, parameters, model, root_area, roo
             else:
                 const_beta_sigma.append(pl.nan)
                 
+    # collect effect coefficients into array-valued nodes, so that
+    # pi does not need to convert lists of scalar nodes at each step
+    if len(alpha) > 0:
+        alpha_vec = mc.Lambda('alpha_vec_%s'%name, lambda alpha=alpha: pl.array(alpha, dtype=float))
+    else:
+        alpha_vec = pl.zeros(0)
+    if len(beta) > 0:
+        beta_vec = mc.Lambda('beta_vec_%s'%name, lambda beta=beta: pl.array(beta, dtype=float))
+    else:
+        beta_vec = pl.zeros(0)
+
+    U_shift_array = pl.array(U_shift, dtype=float)
+    X_array = pl.array(X, dtype=float)
+
     @mc.deterministic(name='pi_%s'%name)
-    def pi(mu=mu, U=pl.array(U, dtype=float), alpha=alpha, X=pl.array(X, dtype=float), beta=beta):
-        return mu * pl.exp(pl.dot(U, [float(x) for x in alpha]) + pl.dot(X, [float(x) for x in beta]))
+    def pi(mu=mu, alpha=alpha_vec, beta=beta_vec):
+        log_shift = pl.dot(X_array, beta)
+        if len(alpha) > 0:
+            log_shift += U_sparse * alpha - pl.dot(U_shift_array, alpha)
+        return mu * pl.exp(log_shift)
 
-    return dict(pi=pi, U=U, U_shift=U_shift, sigma_alpha=sigma_alpha, alpha=alpha, alpha_potentials=alpha_potentials, X=X, X_shift=X_shift, beta=beta, hierarchy=model.hierarchy, const_alpha_sigma=const_alpha_sigma, const_beta_sigma=const_beta_sigma)
+    return dict(pi=pi, U=U, U_shift=U_shift, U_sparse=U_sparse, sigma_alpha=sigma_alpha, alpha=alpha, alpha_vec=alpha_vec, alpha_potentials=alpha_potentials,
+                X=X, X_shift=X_shift, beta=beta, beta_vec=beta_vec, hierarchy=model.hierarchy, const_alpha_sigma=const_alpha_sigma, const_beta_sigma=const_beta_sigma)
 
 
 
@@ -290,18 +346,97 @@ def predict_for(model, parameters,
       - `sex` : str, sex to predict for
       - `year` : str, year to predict for
       - `population_weighted` : bool, should prediction be population weighted if it is the aggregation of units area RE hierarchy?
-      - `vars` : dict, including entries for alpha, beta, mu_age, U, and X
+      - `vars` : dict, including entries for alpha, beta, mu_age, U, and X, and optionally mu_age_trace
       - `lower, upper` : float, bounds on predictions from expert priors
 
     :Results:
       - Returns array of draws from posterior predicted distribution
 
     """
-    area_hierarchy = model.hierarchy
-    output_template = model.output_template.copy()
+    mu_age_trace = age_pattern_trace(vars)
+    shifts = leaf_covariate_shifts(model, parameters, root_area, area, sex, year, vars, len(mu_age_trace))
+    covariate_shift = aggregate_covariate_shift(shifts, shifts['leaves'], population_weighted)
 
-    # find number of samples from posterior
-    len_trace = len(vars['mu_age'].trace())
+    parameter_prediction = (mu_age_trace.T * covariate_shift).T
+        
+    # clip predictions to bounds from expert priors
+    parameter_prediction = parameter_prediction.clip(lower, upper)
+    
+    return parameter_prediction
+
+
+def predict_for_leaves(model, parameters,
+                       root_area, root_sex, root_year,
+                       area, sex, year,
+                       vars,
+                       lower, upper):
+    """ Generate draws from posterior predicted distribution for every
+    leaf of the area hierarchy below a specific (area, sex, year) at once
+
+    :Parameters:
+      - `model` : data.DataModel
+      - `root_area, root_sex, root_year` : the node for which this model was fit consistently
+      - `area, sex, year` : the node to predict for
+      - `vars` : dict, including entries for alpha, beta, mu_age, U, and X, and optionally mu_age_trace
+      - `lower, upper` : float, bounds on predictions from expert priors
+
+    :Results:
+      - Returns dict with 'leaves' (list of areas), 'pop' (array of leaf populations),
+        'draws' (leaves x draws x ages array of predictions for each leaf) and
+        'aggregate' (draws x ages array of population weighted predictions for area)
+
+    """
+    mu_age_trace = age_pattern_trace(vars)
+    shifts = leaf_covariate_shifts(model, parameters, root_area, area, sex, year, vars, len(mu_age_trace))
+
+    draws = pl.exp(shifts['log_shift'])[:, :, pl.newaxis] * mu_age_trace[pl.newaxis, :, :]
+    covariate_shift = aggregate_covariate_shift(shifts, shifts['leaves'], True)
+    aggregate = (mu_age_trace.T * covariate_shift).T
+
+    return dict(leaves=shifts['leaves'], pop=shifts['pop'],
+                draws=draws.clip(lower, upper), aggregate=aggregate.clip(lower, upper))
+
+
+def hierarchy_leaves(area_hierarchy, area):
+    """ Find the leaves of the area hierarchy below area, in breadth-first order"""
+    return hierarchy_index.leaves(hierarchy_index.build(area_hierarchy, area), area)
+
+
+def age_pattern_trace(vars):
+    """ Use draws of the age pattern recomputed in batch, if available
+    (see derived_quantities.from_traces), otherwise the trace of mu_age"""
+    if 'mu_age_trace' in vars:
+        return vars['mu_age_trace']
+    else:
+        return vars['mu_age'].trace()
+
+
+def leaf_covariate_shifts(model, parameters, root_area, area, sex, year, vars, len_trace, output_template=None, index=None):
+    """ Generate draws of the random and fixed effect shift for every
+    leaf of the area hierarchy below area
+
+    :Parameters:
+      - `model` : data.DataModel
+      - `parameters` : dict, including random_effects priors
+      - `root_area` : str, area for which this model was fit consistently
+      - `area, sex, year` : the node to predict for
+      - `vars` : dict, including entries for alpha, beta, U, and X
+      - `len_trace` : int, number of draws
+      - `output_template` : pandas.DataFrame, optional, model.output_template grouped by area, sex, and year,
+        to reuse between calls
+      - `index` : dict, optional, from hierarchy_index.build(model.hierarchy), to reuse between calls
+
+    :Results:
+      - Returns dict with 'leaves' (list of areas), 'log_shift' (leaves x draws array) and 'pop' (array of leaf populations)
+
+    .. note::
+      - random effects for nodes without data are drawn once, and shared by all leaves below them
+
+    """
+    if index is None:
+        index = hierarchy_index.build(model.hierarchy)
+    if output_template is None:
+        output_template = model.output_template.groupby(['area', 'sex', 'year']).mean()
 
     # compile array of draws from posterior distribution of alpha (random effect covariate values)
     # a row for each draw from the posterior distribution
@@ -320,7 +455,6 @@ def predict_for(model, parameters,
     
     if 'alpha' in vars and isinstance(vars['alpha'], mc.Node):
         assert 0, 'No longer used'
-        alpha_trace = vars['alpha'].trace()
     elif 'alpha' in vars and isinstance(vars['alpha'], list):
         alpha_trace = []
         for n, sigma in zip(vars['alpha'], vars['const_alpha_sigma']):
@@ -331,31 +465,22 @@ def predict_for(model, parameters,
                 sigma = max(sigma, 1.e-9) # make sure sigma is non-zero
                 assert not pl.isnan(sigma)
                 alpha_trace.append(mc.rnormal(float(n), sigma**-2, size=len_trace))
-        alpha_trace = pl.vstack(alpha_trace).T
     else:
-        alpha_trace = pl.array([])
+        alpha_trace = []
 
 
     # compile array of draws from posterior distribution of beta (fixed effect covariate values)
     # a row for each draw from the posterior distribution
     # a column for each fixed effect
     #
-    # there are several cases to handle, or at least at one time there were:
-    #   vars['beta'] is a pymc Stochastic with an array for its value (no longer used?)
-    #   vars['beta'] is a list of pymc Nodes
-    #   vars['beta'] is a list of floats
-    #   vars['beta'] is a list of some floats and some pymc Nodes
-    #   'beta' is not in vars
-    #
+    # there are the same cases to handle as for alpha above, and
     # when vars['beta'][i] is a float, there is also information on the uncertainty in this value, stored in
-    # vars['const_beta_sigma'][i], which is not used when fitting the model, but should be incorporated in
-    # the prediction
+    # vars['const_beta_sigma'][i]
     #
     # TODO: refactor to reduce duplicate code (this is very similar to code for alpha above)
 
     if 'beta' in vars and isinstance(vars['beta'], mc.Node):
         assert 0, 'No longer used'
-        beta_trace = vars['beta'].trace()
     elif 'beta' in vars and isinstance(vars['beta'], list):
         beta_trace = []
         for n, sigma in zip(vars['beta'], vars['const_beta_sigma']):
@@ -366,70 +491,36 @@ def predict_for(model, parameters,
                 sigma = max(sigma, 1.e-9) # make sure sigma is non-zero
                 assert not pl.isnan(sigma)
                 beta_trace.append(mc.rnormal(float(n), sigma**-2., size=len_trace))
-        beta_trace = pl.vstack(beta_trace).T
+        beta_trace = pl.vstack(beta_trace)
     else:
         beta_trace = pl.array([])
 
     # the prediction for the requested area is produced by aggregating predictions for all of the childred
-    # of that area in the area_hierarchy (a networkx.DiGraph)
+    # of that area in the area hierarchy
 
-    leaves = [n for n in nx.traversal.bfs_tree(area_hierarchy, area) if area_hierarchy.successors(n) == []]
-    if len(leaves) == 0:
-        # networkx returns an empty list when the bfs tree is a single node
-        leaves = [area]
+    leaves = hierarchy_index.leaves(index, area)
 
-
-    # initialize covariate_shift and total_population
-    covariate_shift = pl.zeros(len_trace)
-    total_population = 0.
-
-    # group output_template for easy access
-    output_template = output_template.groupby(['area', 'sex', 'year']).mean()
-
-    # if there are fixed effects, the effect coefficients are stored as an array in vars['X']
-    # use this to put together a covariate matrix for the predictions, according to the output_template
-    # covariate values
-    #
-    # the resulting array is covs
-    if 'X' in vars:
-        covs = output_template.filter(vars['X'].columns)
-        if 'x_sex' in vars['X'].columns:
-            covs['x_sex'] = sex_value[sex]
-        assert pl.all(covs.columns == vars['X_shift'].index), 'covariate columns and unshift index should match up'
-        for x_i in vars['X_shift'].index:
-            covs[x_i] -= vars['X_shift'][x_i] # shift covariates so that the root node has X_ar,sr,yr == 0
-    else:
-        covs = pandas.DataFrame(index=output_template.index)
-
-    # if there are random effects, put together an indicator based on
-    # their hierarchical relationships
+    # if there are random effects, put together a leaf x random effect indicator matrix based on
+    # their hierarchical relationships, adding a column (and a draw of alpha) for each node on
+    # the path from root_area to a leaf that was not in the model
     #
     if 'U' in vars:
-        p_U = area_hierarchy.number_of_nodes()  # random effects for area
-        U_l = pandas.DataFrame(pl.zeros((1, p_U)), columns=area_hierarchy.nodes())
-        U_l = U_l.filter(vars['U'].columns)
+        columns = list(vars['U'].columns)
     else:
-        U_l = pandas.DataFrame(index=[0])
-
-    # loop through leaves of area_hierarchy subtree rooted at 'area',
-    # make prediction for each using appropriate random
-    # effects and appropriate fixed effect covariates
-    #
-    for l in leaves:
-        log_shift_l = pl.zeros(len_trace)
-        U_l.ix[0,:] = 0.
+        columns = []
+    column_index = dict([(node, j) for j, node in enumerate(columns)])
 
-        root_to_leaf = nx.shortest_path(area_hierarchy, root_area, l)
+    rows = []
+    cols = []
+    for i, l in enumerate(leaves):
+        root_to_leaf = hierarchy_index.path(index, l, root_area)
         for node in root_to_leaf[1:]:
-            if node not in U_l.columns:
-                ## Add a columns U_l[node] = rnormal(0, appropriate_tau)
-                level = len(nx.shortest_path(area_hierarchy, 'all', node))-1
+            if node not in column_index:
+                ## Add a column for node with alpha drawn from rnormal(0, appropriate_tau)
+                level = index['depth'][index['id'][node]]
                 if 'sigma_alpha' in vars:
                     tau_l = vars['sigma_alpha'][level].trace()**-2
-                    
-                U_l[node] = 0.
 
-                # if this node was not already included in the alpha_trace array, add it
                 # there are several cases for adding:
                 #  if the random effect has a distribution of Constant
                 #    add it, using a sigma as well
@@ -448,47 +539,86 @@ def predict_for(model, parameters,
                     else:
                         alpha_node = pl.zeros(len_trace)
 
-                if len(alpha_trace) > 0:
-                    alpha_trace = pl.vstack((alpha_trace.T, alpha_node)).T
-                else:
-                    alpha_trace = pl.atleast_2d(alpha_node).T
+                column_index[node] = len(columns)
+                columns.append(node)
+                alpha_trace.append(alpha_node)
 
-            # TODO: implement a more robust way to align alpha_trace and U_l
-            U_l.ix[0, node] = 1.
+            rows.append(i)
+            cols.append(column_index[node])
+
+    log_shift = pl.zeros((len(leaves), len_trace))
+    if len(columns) > 0:
+        alpha_trace = pl.vstack(alpha_trace)
+        U_leaves = scipy.sparse.csr_matrix((pl.ones(len(rows)), (rows, cols)), shape=(len(leaves), len(columns)))
 
         # 'shift' the random effects matrix to have the intended
         # level of the hierarchy as the reference value
+        U_shift = pl.zeros(len(columns))
         if 'U_shift' in vars:
-            for node in vars['U_shift']:
-                U_l -= vars['U_shift'][node]
+            for node in vars['U_shift'].index:
+                U_shift[column_index[node]] = vars['U_shift'][node]
 
         # add the random effect intercept shift (len_trace draws)
-        log_shift_l += pl.dot(alpha_trace, U_l.T).flatten()
-            
-        # make X_l
-        if len(beta_trace) > 0:
-            X_l = covs.ix[l, sex, year]
-            log_shift_l += pl.dot(beta_trace, X_l.T).flatten()
+        log_shift += U_leaves * alpha_trace - pl.dot(U_shift, alpha_trace)
+
+    # if there are fixed effects, the effect coefficients are stored as an array in vars['X']
+    # use this to put together a leaf x covariate matrix for the predictions, according to the
+    # output_template covariate values
+    if len(beta_trace) > 0:
+        covs = output_template.filter(vars['X'].columns)
+        if 'x_sex' in vars['X'].columns:
+            covs['x_sex'] = sex_value[sex]
+        assert pl.all(covs.columns == vars['X_shift'].index), 'covariate columns and unshift index should match up'
+        for x_i in vars['X_shift'].index:
+            covs[x_i] -= vars['X_shift'][x_i] # shift covariates so that the root node has X_ar,sr,yr == 0
+
+        X_leaves = pl.array([covs.ix[l, sex, year] for l in leaves], dtype=float)
+        log_shift += pl.dot(X_leaves, beta_trace)
+
+    pop = pl.array([output_template['pop'][l, sex, year] for l in leaves], dtype=float)
+
+    return dict(leaves=leaves, log_shift=log_shift, pop=pop)
+
+
+def aggregate_covariate_shift(shifts, leaves, population_weighted):
+    """ Combine the covariate shifts of a subset of leaves
+
+    :Parameters:
+      - `shifts` : dict, from leaf_covariate_shifts
+      - `leaves` : list of areas, the leaves to combine
+      - `population_weighted` : bool, combine in linear-space with population weights, or in log-space without weights
+
+    :Results:
+      - Returns array of draws of the multiplicative shift for the aggregate of leaves
+
+    """
+    return aggregate_covariate_shifts(shifts, [leaves], population_weighted)[0]
 
+
+def aggregate_covariate_shifts(shifts, leaf_lists, population_weighted):
+    """ Combine the covariate shifts of several subsets of leaves at once
+
+    :Parameters:
+      - `shifts` : dict, from leaf_covariate_shifts
+      - `leaf_lists` : list of lists of areas, the leaves to combine for each aggregate
+      - `population_weighted` : bool, combine in linear-space with population weights, or in log-space without weights
+
+    :Results:
+      - Returns (aggregates x draws) array of the multiplicative shift for each aggregate
+
+    """
+    index = dict([(l, i) for i, l in enumerate(shifts['leaves'])])
+    weights = pl.zeros((len(leaf_lists), len(shifts['leaves'])))
+    for k, leaves in enumerate(leaf_lists):
+        ix = [index[l] for l in leaves]
         if population_weighted:
-            # combine in linear-space with population weights
-            shift_l = pl.exp(log_shift_l)
-            covariate_shift += shift_l * output_template['pop'][l,sex,year]
-            total_population += output_template['pop'][l,sex,year]
+            weights[k, ix] = shifts['pop'][ix] / shifts['pop'][ix].sum()
         else:
-            # combine in log-space without weights
-            covariate_shift += log_shift_l
-            total_population += 1.
+            weights[k, ix] = 1. / len(ix)
 
     if population_weighted:
-        covariate_shift /= total_population
+        # combine in linear-space with population weights
+        return pl.dot(weights, pl.exp(shifts['log_shift']))
     else:
-        covariate_shift = pl.exp(covariate_shift / total_population)
-        
-    parameter_prediction = (vars['mu_age'].trace().T * covariate_shift).T
-        
-    # clip predictions to bounds from expert priors
-    parameter_prediction = parameter_prediction.clip(lower, upper)
-    
-    return parameter_prediction
-    
+        # combine in log-space without weights
+        return pl.exp(pl.dot(weights, shifts['log_shift']))
@@ -6,7 +6,7 @@ import pymc as mc
 import pylab as pl
 import simplejson as json
 
-import graphics
+import hierarchy_index
 
 def describe_vars(d):
     m = mc.Model(d)
@@ -30,25 +30,27 @@ def describe_vars(d):
     return df.sort('logp')
 
 
-def check_convergence(vars):
+def check_convergence(vars, report=False):
     """ Apply a simple test of convergence to the model: compare
-    autocorrelation at 25 lags to zero lags.  warn about convergence if it exceeds
-    10% for any stoch """
+    autocorrelation at lags 50 to 99 to zero lags, and report
+    non-convergence if it exceeds 50% for any dimension of any stoch
+
+    :Parameters:
+      - `vars` : dict, or dict of dicts, of PyMC nodes with traces
+      - `report` : boolean, optional, return the full report from diagnostics.convergence_report,
+        with the effective sample size, autocorrelation time, and Geweke score of each dimension
+
+    :Results:
+      - Returns True if every dimension passed the test, or the report
+    """
     import dismod3
+    import diagnostics
     cells, stochs = dismod3.graphics.tally_stochs(vars)
 
-    for s in sorted(stochs, key=lambda s: s.__name__):
-        tr = s.trace()
-        if len(tr.shape) == 1:
-            tr = tr.reshape((len(tr), 1))
-        for d in range(len(pl.atleast_1d(s.value))):
-            for k in range(50,100):
-                acorr = pl.dot(tr[:-k,d]-tr[:k,d].mean(), tr[k:,d]-tr[k:,d].mean()) / pl.dot(tr[k:,d]-tr[k:,d].mean(), tr[k:,d]-tr[k:,d].mean())
-                if abs(acorr) > .5:
-                    print 'potential non-convergence', s, acorr
-                    return False
-            
-    return True
+    df = diagnostics.convergence_report(sorted(stochs, key=lambda s: s.__name__))
+    if report:
+        return df
+    return bool(df['converged'].all())
 
 class ModelVars(dict):
     """ Container class for PyMC Node objects that make up the model
@@ -149,16 +151,18 @@ class ModelData:
             return self.input_data
 
     def describe(self, data_type):
-        G = self.hierarchy
+        import hierarchy_index
+        index = hierarchy_index.build(self.hierarchy)
         df = self.get_data(data_type)
 
-        for n in nx.dfs_postorder_nodes(G, 'all'):
-            G.node[n]['cnt'] = len(df[df['area']==n].index) + pl.sum([G.node[c]['cnt'] for c in G.successors(n)])
-            G.node[n]['depth'] = nx.shortest_path_length(G, 'all', n)
-        
-        for n in nx.dfs_preorder_nodes(G, 'all'):
-            if G.node[n]['cnt'] > 0:
-                print ' *'*G.node[n]['depth'], n, int(G.node[n]['cnt'])
+        # count rows of data for each area, and add every row to the count of each ancestor of its area
+        paths = hierarchy_index.row_ancestors(index, df['area'])
+        paths = paths[paths >= 0]
+        cnt = pl.bincount(paths, minlength=len(index['nodes']))
+
+        for i, n in enumerate(index['nodes']):
+            if cnt[i] > 0:
+                print ' *'*index['depth'][i], n, int(cnt[i])
 
     def keep(self, areas=['all'], sexes=['male', 'female', 'total'], start_year=-pl.inf, end_year=pl.inf):
         """ Modify model to feature only desired area/sex/year(s)
@@ -199,31 +203,49 @@ class ModelData:
         reload(covariate_model)
         self.estimates = self.estimates.append(pandas.DataFrame())
 
-    def save(self, path):
+    def save(self, path, binary=True, human_readable=True):
         """ Saves all model data in human-readable files
 
         :Parameters:
           - `path` : str, directory to save in
+          - `binary` : bool, optional, also save input data, output template, and
+            hierarchy in columnar binary format in path/columnar, for fast loading
+          - `human_readable` : bool, optional, if False, save input data, output
+            template, and hierarchy only in columnar binary format
 
         :Results:
           - Saves files to specified path, overwritting what was there before
         
         """
 
-        self.input_data.to_csv(path + '/input_data.csv')
-        self.output_template.to_csv(path + '/output_template.csv')
+        if human_readable:
+            input_data = self.input_data
+            if 'age_weights' in input_data:
+                # age weights loaded from columnar files are float arrays, which are stored as text in csv
+                import columnar
+                input_data = input_data.copy()
+                input_data['age_weights'] = columnar.ragged_text(input_data['age_weights'])
+            input_data.to_csv(path + '/input_data.csv')
+            self.output_template.to_csv(path + '/output_template.csv')
+            json.dump(dict(nodes=[[n, self.hierarchy.node[n]] for n in sorted(self.hierarchy.nodes())],
+                           edges=[[u, v, self.hierarchy.edge[u][v]] for u,v in sorted(self.hierarchy.edges())]),
+                      open(path + '/hierarchy.json', 'w'), indent=2)
         json.dump(self.parameters, open(path + '/parameters.json', 'w'), indent=2)
-        json.dump(dict(nodes=[[n, self.hierarchy.node[n]] for n in sorted(self.hierarchy.nodes())],
-                       edges=[[u, v, self.hierarchy.edge[u][v]] for u,v in sorted(self.hierarchy.edges())]),
-                  open(path + '/hierarchy.json', 'w'), indent=2)
         json.dump(self.nodes_to_fit, open(path + '/nodes_to_fit.json', 'w'), indent=2)
 
+        if binary or not human_readable:
+            import columnar
+            columnar.save_frame(self.input_data, path + '/columnar/input_data', ragged=['age_weights'])
+            columnar.save_frame(self.output_template, path + '/columnar/output_template')
+            columnar.save_hierarchy(self.hierarchy, path + '/columnar/hierarchy')
+
     @staticmethod
-    def load(path):
+    def load(path, columns=None):
         """ Load all model data
         
         :Parameters:
           - `path` : str, directory to save in
+          - `columns` : list of str, optional, columns of input data to load, all by default
           
         :Results:
           - ModelData with all input data
@@ -235,8 +257,19 @@ class ModelData:
             - :ref:`hierarchy-label`
             - :ref:`parameters-label`
             - :ref:`nodes_to_fit-label`
+
+          If path/columnar holds a copy of the input data, output
+          template, and hierarchy that is newer than the csv and json
+          files, they are read from there instead of parsed (each
+          column is memory-mapped and copied once into the DataFrame)
         
         """
+        try:
+            return ModelData.load_binary(path, columns)
+        except (IOError, OSError):
+            # the columnar copy is missing or stale
+            pass
+
         d = ModelData()
 
         # TODO: catch _csv.Error and retry, to give j drive time to sync
@@ -258,6 +291,44 @@ class ModelData:
 
         d.nodes_to_fit = json.load(open(path + '/nodes_to_fit.json'))
 
+        if columns != None:
+            missing = set(columns) - set(d.input_data.columns)
+            assert not missing, 'columns %s not found in %s/input_data.csv' % (', '.join(missing), path)
+            d.input_data = d.input_data.filter(columns)
+
+        return d
+
+    @staticmethod
+    def load_binary(path, columns=None):
+        """ Load model data saved with save(path, binary=True) from path/columnar
+
+        :Parameters:
+          - `path` : str, directory to load from
+          - `columns` : list of str, optional, columns of input data to load, all by default
+
+        :Results:
+          - ModelData with all input data
+
+        :Notes:
+          - Raises IOError or OSError if the columnar files are missing, or older
+            than the csv and json files they were saved with
+          - Raises AssertionError if any of columns is not in the input data
+        """
+        import os
+        import columnar
+
+        saved = min([os.path.getmtime('%s/columnar/%s/meta.json' % (path, name)) for name in ['input_data', 'output_template', 'hierarchy']])
+        for fname in ['input_data.csv', 'output_template.csv', 'hierarchy.json', 'parameters.json']:
+            if os.path.exists('%s/%s' % (path, fname)) and os.path.getmtime('%s/%s' % (path, fname)) > saved:
+                raise IOError, '%s/%s has changed since columnar copy was saved' % (path, fname)
+
+        d = ModelData()
+        d.input_data = columnar.load_frame(path + '/columnar/input_data', columns)
+        d.output_template = columnar.load_frame(path + '/columnar/output_template')
+        d.parameters = json.load(open(path + '/parameters.json'))
+        d.hierarchy = columnar.load_hierarchy(path + '/columnar/hierarchy')
+        d.nodes_to_fit = json.load(open(path + '/nodes_to_fit.json'))
+
         return d
 
     @staticmethod
@@ -294,12 +365,7 @@ class ModelData:
         dm['countries_for'] = dict(
             [[dismod3.utils.clean(x[0]), x[1:]] for x in csv.reader(open(dismod3.settings.CSV_PATH + 'country_region.csv'))]
             )
-        dm['population_by_age'] = dict(
-            [[(r['Country Code'], r['Year'], r['Sex']),
-              [max(.001,float(r['Age %d Population' % i])) for i in range(dismod3.settings.MAX_AGE)]] 
-             for r in csv.DictReader(open(dismod3.settings.CSV_PATH + 'population.csv'))
-             if len(r['Country Code']) == 3]
-            )
+        dm['population_by_age'] = dismod3.population.population_by_age()
 
 
         cov_list = []
@@ -391,8 +457,8 @@ class ModelData:
         d = ModelData()
         d.input_data = ModelData._input_data_from_gbd_json(dm, covs)
         d.output_template = ModelData._output_template_from_gbd_json(dm, covs)
-        d.parameters = ModelData._parameters_from_gbd_json(dm)
         d.hierarchy, d.nodes_to_fit = ModelData._hierarchy_from_gbd_json(dm)
+        d.parameters = ModelData._parameters_from_gbd_json(dm, d.hierarchy)
 
         print 'load completed successfully'
 
@@ -570,8 +636,9 @@ class ModelData:
 
 
     @staticmethod
-    def _parameters_from_gbd_json(dm):
-        """ copy expert priors"""
+    def _parameters_from_gbd_json(dm, hierarchy):
+        """ copy expert priors, with a sigma_alpha prior for each level of hierarchy"""
+        n_levels = hierarchy_index.levels(hierarchy_index.build(hierarchy))
         parameters = ModelData().parameters
         old_name = dict(i='incidence', p='prevalence', rr='relative_risk', r='remission', f='excess_mortality', X='duration', pf='prevalence_x_excess-mortality')
         for t in 'i p r f rr X pf'.split():
@@ -604,7 +671,7 @@ class ModelData:
                     parameters[t]['random_effects'][iso3] = dict(dist='TruncatedNormal', mu=0., sigma=prior['std'], lower=-2*prior['std'], upper=2*prior['std'])
 
             # include alternative prior on sigma_alpha based on heterogeneity
-            for i in range(5):  # max depth of hierarchy is 5
+            for i in range(n_levels):
                 effect = 'sigma_alpha_%s_%d'%(t,i)
                 #parameters[t]['random_effects'][effect] = dict(dist='TruncatedNormal', mu=.01, sigma=.01, lower=.01, upper=.05)
                 #if 'heterogeneity' in parameters[t]:
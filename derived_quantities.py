@@ -0,0 +1,96 @@
+""" Derived quantities of the consistent model
+
+Vectorized kernels for the age patterns that ism.consistent derives
+from prevalence, remission and excess-mortality.  Each function works
+on a single vector of values by age, or on a (draws x ages) array, so
+the same code is used for MCMC steps and for post-processing traces.
+"""
+
+import pylab as pl
+
+
+def other_mortality(pf, m_all):
+    """ Mortality from causes other than the condition, m = m_all - p*f"""
+    return (m_all - pf).clip(1.e-6, 1.e6)
+
+def relative_risk(m, f):
+    """ Relative risk of mortality, rr = (m+f)/m"""
+    return (m + f) / m
+
+def standardized_mortality_ratio(m, f, m_all):
+    """ Standardized mortality ratio, smr = (m+f)/m_all"""
+    return (m + f) / m_all
+
+def with_condition_mortality(m, f):
+    """ Mortality of those with the condition, m_with = m+f"""
+    return m + f
+
+def duration(r, m, f):
+    """ Find expected time in the with-condition compartment, by age
+
+    :Parameters:
+      - `r, m, f` : arrays with last dimension the number of ages, remission, other mortality and excess-mortality
+
+    :Results:
+      - Returns array of durations, with the same shape as r
+
+    .. note::
+      - with hazard h = r+m+f and q = exp(-h), duration satisfies
+        X[a] = q[a] X[a+1] + (1-q[a])/h[a], and X[-1] = 1/h[-1]
+      - this linear recurrence is solved with a log-depth scan over
+        compositions of the affine maps, which stays stable when
+        cumulative products of q underflow
+
+    """
+    hazard = pl.array(r + m + f, dtype=float)
+    pr_not_exit = pl.exp(-hazard)
+
+    old_settings = pl.seterr(divide='ignore', invalid='ignore')
+    stay = -pl.expm1(-hazard) / hazard
+    stay[hazard == 0.] = 1.
+    X_last = 1. / hazard[..., -1]
+    pl.seterr(**old_settings)
+
+    # affine maps x -> a x + b, from the oldest age down
+    a = pr_not_exit[..., -2::-1].copy()
+    b = stay[..., -2::-1].copy()
+    d = 1
+    while d < a.shape[-1]:
+        b[..., d:] = a[..., d:] * b[..., :-d] + b[..., d:]
+        a[..., d:] = a[..., d:] * a[..., :-d]
+        d *= 2
+
+    X = pl.empty(hazard.shape)
+    X[..., -1] = X_last
+    X[..., -2::-1] = a * X_last[..., pl.newaxis] + b
+    return X
+
+def all_derived(p, r, f, m_all):
+    """ Find all derived quantities at once
+
+    :Parameters:
+      - `p, r, f` : arrays with last dimension the number of ages, prevalence, remission and excess-mortality
+      - `m_all` : array, all-cause mortality by age
+
+    :Results:
+      - Returns dict of arrays, with keys 'pf', 'm', 'rr', 'smr', 'm_with', and 'X'
+
+    """
+    pf = p * f
+    m = other_mortality(pf, m_all)
+    m_with = with_condition_mortality(m, f)
+    return dict(pf=pf, m=m, rr=m_with/m, smr=m_with/m_all, m_with=m_with,
+                X=duration(r, m, f))
+
+def from_traces(vars):
+    """ Recompute derived quantities for every posterior draw in one batch
+
+    :Parameters:
+      - `vars` : dict, from ism.consistent, after sampling
+
+    :Results:
+      - Returns dict of (draws x ages) arrays, from all_derived
+
+    """
+    p, r, f = [vars[t]['mu_age'].trace() for t in 'prf']
+    return all_derived(p, r, f, vars['m_all'])
@@ -0,0 +1,270 @@
+""" Convergence diagnostics for MCMC draws
+
+All functions work on every traced dimension at once: the draws of a
+chain are stacked in a (draws x dims) matrix, with one column for each
+entry of each stoch (see stack_traces), and several chains in a
+(chains x draws x dims) array, so that checking a model with hundreds
+of random effects is a few array operations rather than a loop in
+Python.  The autocorrelations of all columns are computed together
+with one FFT, and the effective sample size, integrated
+autocorrelation time, and Geweke scores are all derived from them.
+
+Example
+-------
+>>> import diagnostics
+>>> report = diagnostics.convergence_report(mc.MCMC(vars).stochastics)
+>>> report[report['converged'] == False]
+>>> chains = pl.array([trace_1, trace_2, trace_3, trace_4])  # chains x draws x dims
+>>> diagnostics.split_rhat(chains)
+>>> diagnostics.effective_sample_size(diagnostics.split_chains(chains))
+"""
+
+import pylab as pl
+import pandas
+
+def stack_traces(stochs):
+    """ Stack the traces of stochs in one matrix
+
+    :Parameters:
+      - `stochs` : list of PyMC nodes, with traces of the same length
+
+    :Results:
+      - Returns tuple of the draws x dims array, with the columns for
+        each stoch in the order of its raveled value, and lists of the
+        name of the stoch and the index in its raveled value for each column
+
+    """
+    columns = []
+    names = []
+    dims = []
+    for s in stochs:
+        tr = pl.asarray(s.trace())
+        tr = tr.reshape((len(tr), -1))
+        columns.append(tr)
+        names += [s.__name__] * tr.shape[1]
+        dims += range(tr.shape[1])
+    return pl.hstack(columns), names, dims
+
+def autocovariance(x):
+    """ Autocovariance of each column of x at every lag, computed with the FFT
+
+    :Parameters:
+      - `x` : array, draws x dims (or a vector of draws)
+
+    :Results:
+      - Returns array, lags x dims, with the biased estimate (divided by
+        the number of draws) at lags 0 to draws-1
+
+    """
+    x = pl.array(x, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape((len(x), 1))
+    n = len(x)
+    x -= x.mean(axis=0)
+
+    # zero-pad to a power of two at least 2n-1 long, so that the circular correlation is not wrapped
+    size = 2**int(pl.ceil(pl.log2(max(2*n-1, 1))))
+    f = pl.np.fft.rfft(x, n=size, axis=0)
+    return pl.np.fft.irfft(f * f.conj(), n=size, axis=0)[:n] / n
+
+def autocorrelation(x, maxlags=None):
+    """ Autocorrelation of each column of x, normalized as in pl.acorr
+
+    :Parameters:
+      - `x` : array, draws x dims (or a vector of draws)
+      - `maxlags` : int, optional, largest lag to return, all lags by default
+
+    :Results:
+      - Returns array, lags x dims, with autocorrelation 1 at lag 0; columns
+        that are constant have autocorrelation 0 at all other lags
+
+    """
+    acov = autocovariance(x)
+    if maxlags != None:
+        acov = acov[:maxlags+1]
+
+    acorr = pl.zeros(acov.shape)
+    acorr[0] = 1.
+    moving = acov[0] > 0
+    acorr[1:, moving] = acov[1:, moving] / acov[0, moving]
+    return acorr
+
+def split_chains(chains):
+    """ Split each chain into its first and second half, to detect
+    chains that have not stopped drifting
+
+    :Parameters:
+      - `chains` : array, chains x draws x dims
+
+    :Results:
+      - Returns array, 2*chains x draws/2 x dims (a middle draw of an
+        odd-length chain is dropped)
+
+    """
+    chains = pl.asarray(chains)
+    half = chains.shape[1] / 2
+    return pl.concatenate([chains[:, :half], chains[:, -half:]])
+
+def _as_chains(chains):
+    chains = pl.array(chains, dtype=float)
+    if chains.ndim == 2:
+        chains = chains.reshape(chains.shape + (1,))
+    return chains
+
+def split_rhat(chains):
+    """ Potential scale reduction factor of the split chains, as in
+    Gelman et al, Bayesian Data Analysis, 3rd ed, section 11.4
+
+    :Parameters:
+      - `chains` : array, chains x draws x dims, or chains x draws for a scalar
+
+    :Results:
+      - Returns array with R-hat for each dim, which goes to 1 as the
+        chains converge; dims that are constant in all chains have R-hat 1
+
+    """
+    chains = split_chains(_as_chains(chains))
+    m, n, d = chains.shape
+    assert n > 1, 'need at least 4 draws in each chain'
+
+    W = chains.var(axis=1, ddof=1).mean(axis=0)
+    B_over_n = chains.mean(axis=1).var(axis=0, ddof=1)
+    var_plus = (n - 1.) / n * W + B_over_n
+
+    rhat = pl.ones(d)
+    moving = W > 0
+    rhat[moving] = pl.sqrt(var_plus[moving] / W[moving])
+    rhat[(W == 0) & (var_plus > 0)] = pl.inf
+    return rhat
+
+def effective_sample_size(chains):
+    """ Effective sample size of the draws of several chains, combining
+    the within-chain autocorrelation and the between-chain variance, as
+    in Gelman et al, Bayesian Data Analysis, 3rd ed, section 11.5
+
+    :Parameters:
+      - `chains` : array, chains x draws x dims, or chains x draws for a scalar
+
+    :Results:
+      - Returns array with the effective sample size for each dim; dims
+        that are constant in all chains count every draw as effective
+
+    .. note::
+      - the autocorrelation sum is truncated with Geyer's initial
+        monotone sequence estimator, so it is stable for long chains
+
+    """
+    chains = _as_chains(chains)
+    m, n, d = chains.shape
+
+    acov = pl.array([autocovariance(c) for c in chains])
+    W = acov[:, 0, :].mean(axis=0) * n / (n - 1.)
+    var_plus = W * (n - 1.) / n
+    if m > 1:
+        var_plus += chains.mean(axis=1).var(axis=0, ddof=1)
+
+    moving = var_plus > 0
+    ess = m * n * pl.ones(d)
+    if not pl.any(moving):
+        return ess
+
+    rho = 1. - (W[moving] - acov[:, :, moving].mean(axis=0)) / var_plus[moving]
+    rho[0] = 1.
+
+    # sum autocorrelations in pairs while the pair sums are positive, and
+    # force the pair sums to be decreasing
+    K = n / 2
+    P = rho[0:2*K:2] + rho[1:2*K:2]
+    positive = pl.cumprod(P > 0, axis=0).astype(bool)
+    P = pl.minimum.accumulate(P, axis=0)
+    tau = -1. + 2. * pl.sum(P * positive, axis=0)
+
+    ess[moving] = m * n / pl.maximum(tau, 1. / pl.log10(max(m*n, 10)))
+    return ess
+
+def integrated_autocorrelation_time(x):
+    """ Integrated autocorrelation time of each column of x, the number
+    of draws that are worth one independent draw
+
+    :Parameters:
+      - `x` : array, draws x dims (or a vector of draws) from one chain
+
+    :Results:
+      - Returns array with tau for each dim, so that the effective sample size is draws / tau
+
+    """
+    x = pl.array(x, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape((len(x), 1))
+    return len(x) / effective_sample_size(x.reshape((1,) + x.shape))
+
+def geweke(x, first=.1, last=.5):
+    """ Geweke z-score of each column of x, comparing the mean of the
+    first part of the chain to the mean of the last part
+
+    :Parameters:
+      - `x` : array, draws x dims (or a vector of draws) from one chain
+      - `first`, `last` : float, fraction of the draws at the start and end of the chain to compare
+
+    :Results:
+      - Returns array with z for each dim, approximately standard normal for a
+        chain that has converged; columns that are constant have z 0
+
+    .. note::
+      - the variance of each mean is corrected for autocorrelation with
+        the integrated autocorrelation time of its part of the chain
+
+    """
+    x = pl.array(x, dtype=float)
+    if x.ndim == 1:
+        x = x.reshape((len(x), 1))
+    n = len(x)
+    a = x[:int(first*n)]
+    b = x[n-int(last*n):]
+    assert len(a) > 1, 'need more draws to compare the start and end of the chain'
+
+    var_a = a.var(axis=0) * integrated_autocorrelation_time(a) / len(a)
+    var_b = b.var(axis=0) * integrated_autocorrelation_time(b) / len(b)
+    se = pl.sqrt(var_a + var_b)
+
+    z = pl.zeros(x.shape[1])
+    moving = se > 0
+    z[moving] = (a.mean(axis=0)[moving] - b.mean(axis=0)[moving]) / se[moving]
+    return z
+
+def convergence_report(stochs, lags=range(50, 100), max_acorr=.5):
+    """ Diagnose the convergence of every dimension of the traces of stochs
+
+    :Parameters:
+      - `stochs` : list of PyMC nodes, with traces of the same length
+      - `lags` : list of int, lags at which to check the autocorrelation
+      - `max_acorr` : float, largest absolute autocorrelation at these lags for a converged dimension
+
+    :Results:
+      - Returns pandas.DataFrame with a row for each dimension of each
+        stoch, and columns stoch, dim, ess, iat (integrated
+        autocorrelation time), geweke (z-score), acorr (largest absolute
+        autocorrelation at lags), and converged (acorr at most max_acorr)
+
+    """
+    columns = ['stoch', 'dim', 'ess', 'iat', 'geweke', 'acorr', 'converged']
+    if len(stochs) == 0:
+        return pandas.DataFrame(columns=columns)
+
+    x, names, dims = stack_traces(stochs)
+    acorr = autocorrelation(x, max(lags))
+    lags = [k for k in lags if k < len(acorr)]
+    if lags:
+        max_abs_acorr = abs(acorr[lags]).max(axis=0)
+    else:
+        max_abs_acorr = pl.zeros(x.shape[1])
+
+    iat = integrated_autocorrelation_time(x)
+    if len(x) >= 20:
+        z = geweke(x)
+    else:
+        z = pl.nan * pl.ones(x.shape[1])
+
+    return pandas.DataFrame(dict(stoch=names, dim=dims, ess=len(x) / iat, iat=iat, geweke=z,
+                                 acorr=max_abs_acorr, converged=(max_abs_acorr <= max_acorr)),
+                            columns=columns)
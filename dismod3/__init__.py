@@ -4,36 +4,75 @@ modeling system, as well as all of the parameters and functions
 specific to the statistical modeling and plotting of generic disease.
 
 see ``../docs/tutorial.rst`` for more details on the interface.
+
+Submodules are imported the first time they are used, so that
+``import dismod3`` is fast, and a script that only needs ``ism``,
+``fit``, and ``data`` does not pay for plotting, table, and web
+dependencies.  Set ``settings.RELOAD_MODULES`` to import and reload
+all of them up front, as when developing interactively.
 """
+import sys
+import types
+
 import settings
-reload(settings)
+if settings.RELOAD_MODULES:
+    reload(settings)
 
 from settings import gbd_regions, gbd_years, gbd_sexes
 
-from disease_json import get_job_queue, remove_from_job_queue, \
-    try_posting_disease_model, load_disease_model, add_covariates_to_disease_model
-
-import neg_binom_model, normal_model, log_normal_model, generic_disease_model, gbd_disease_model, regional_similarity_matrices
-import plotting, table, utils
-
-import age_integrating_model as age_group
-import age_pattern
-import covariate_model as covariates
-import rate_model
-import data
-import data_model
-import fit_model
-import graphics
-
-import ism
-import fit
-
-reload(data)
-reload(data_model)
-reload(age_pattern)
-reload(covariates)
-reload(rate_model)
-reload(age_group)
-reload(ism)
-reload(fit)
-reload(graphics)
+# attributes of the package that are imported on first use, and the modules they come from
+_submodules = dict(neg_binom_model='dismod3.neg_binom_model',
+                   normal_model='dismod3.normal_model',
+                   log_normal_model='dismod3.log_normal_model',
+                   generic_disease_model='dismod3.generic_disease_model',
+                   gbd_disease_model='dismod3.gbd_disease_model',
+                   regional_similarity_matrices='dismod3.regional_similarity_matrices',
+                   disease_json='dismod3.disease_json',
+                   population='dismod3.population',
+                   plotting='dismod3.plotting',
+                   table='dismod3.table',
+                   utils='dismod3.utils',
+                   age_group='age_integrating_model',
+                   age_pattern='age_pattern',
+                   covariates='covariate_model',
+                   rate_model='rate_model',
+                   data='data',
+                   data_model='data_model',
+                   fit_model='fit_model',
+                   graphics='graphics',
+                   ism='ism',
+                   fit='fit')
+
+_functions = dict(get_job_queue='dismod3.disease_json',
+                  remove_from_job_queue='dismod3.disease_json',
+                  try_posting_disease_model='dismod3.disease_json',
+                  load_disease_model='dismod3.disease_json',
+                  add_covariates_to_disease_model='dismod3.disease_json')
+
+class _LazyPackage(types.ModuleType):
+    """ The dismod3 package, importing submodules when they are first accessed"""
+    def __getattr__(self, name):
+        if name in _submodules:
+            __import__(_submodules[name])
+            value = sys.modules[_submodules[name]]
+        elif name in _functions:
+            __import__(_functions[name])
+            value = getattr(sys.modules[_functions[name]], name)
+        else:
+            raise AttributeError, "'module' object has no attribute '%s'" % name
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys() + _submodules.keys() + _functions.keys()))
+
+# replace this module with a lazy one; keep a reference to the
+# original, so that its globals, used by _LazyPackage, stay alive
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(globals())
+_package._original_module = sys.modules[__name__]
+sys.modules[__name__] = _package
+
+if settings.RELOAD_MODULES:
+    for _name in ['data', 'data_model', 'age_pattern', 'covariates', 'rate_model', 'age_group', 'ism', 'fit', 'graphics']:
+        reload(getattr(_package, _name))
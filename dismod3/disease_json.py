@@ -1,7 +1,6 @@
 import os
 import random
 
-import twill.commands as twc
 import simplejson as json
 import pylab as pl
 
@@ -680,6 +679,7 @@ def load_disease_model(id, verbose=False):
 
 
 def fetch_disease_model(id):
+    import twill.commands as twc
     from twill import set_output
     set_output(open('/dev/null', 'w'))
 
@@ -696,6 +696,7 @@ def fetch_disease_model(id):
 def try_posting_disease_model(dm, ntries):
     """ error handling: in case post fails try again, but stop after
     some specified number of tries"""
+    import twill.commands as twc
     from twill.errors import TwillAssertionError
     import random
     import time
@@ -722,6 +723,7 @@ def post_disease_model(disease):
     post specificed disease model data to
     dismod server given in settings.py
     """
+    import twill.commands as twc
     dismod_server_login()
 
     # don't upload the disease data, since it is already on the server
@@ -740,6 +742,7 @@ def add_covariates_to_disease_model(dm):
     submit request to dismod server to add covariates to disease model dm
     wait for response (which can take a while)
     """
+    import twill.commands as twc
     dismod_server_login()
 
     twc.go(DISMOD_BASE_URL + 'dismod/run/%d' % dm)
@@ -752,6 +755,7 @@ def get_job_queue():
     fetch list of disease model jobs waiting to run from dismod server
     given in settings.py.
     """
+    import twill.commands as twc
     dismod_server_login()
     twc.go(DISMOD_LIST_JOBS_URL)
     return json.loads(twc.show())
@@ -762,6 +766,7 @@ def remove_from_job_queue(id):
     remove a disease model from the job queue on the dismod server
     given in dismod3/settings.py
     """
+    import twill.commands as twc
     dismod_server_login()
     
     twc.go(DISMOD_REMOVE_JOB_URL)
@@ -772,6 +777,7 @@ def remove_from_job_queue(id):
 
 def dismod_server_login():
     """ login to the dismod server given in dismod3/settings.py."""
+    import twill.commands as twc
     
     twc.go(DISMOD_LOGIN_URL)
     twc.fv('1', 'username', DISMOD_USERNAME)
@@ -301,27 +301,17 @@ def covariates(d, covariates_dict):
 from dismod3.utils import clean
 import csv
 import settings
+import population
 countries_for = dict(
     [[clean(x[0]), x[1:]] for x in csv.reader(open(settings.CSV_PATH + 'country_region.csv'))]
     )
-population_by_age = dict(
-    [[(d['Country Code'], d['Year'], d['Sex']),
-      [max(.001,float(d['Age %d Population' % i])) for i in range(dismod3.settings.MAX_AGE)]] for d in csv.DictReader(open(settings.CSV_PATH + 'population.csv'))
-     if len(d['Country Code']) == 3]
-    )
+# views into the memory-mapped population cube, keyed by (iso3, year, sex)
+population_by_age = population.population_by_age()
 
 def regional_population(key):
     """ calculate regional population for a gbd key"""
     t,r,y,s = dismod3.utils.type_region_year_sex_from_key(key)
-    pop = pl.zeros(dismod3.settings.MAX_AGE)
-    for c in countries_for[clean(r)]:
-        if y == 'all' and s == 'all':
-            for yy in dismod3.settings.gbd_years:
-                for ss in dismod3.settings.gbd_sexes:
-                    pop += population_by_age[(c, yy, dismod3.utils.clean(ss))]
-        else:
-            pop += population_by_age[(c, y, s)]
-    return pop
+    return population.regional_population(r, y, s)
 
 def regional_average(derived_covariate, key, region, year, sex):
     """ handle region = iso3 code or region = clean(gbd_region)"""
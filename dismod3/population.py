@@ -0,0 +1,259 @@
+""" Population by area, year, sex, and age, stored as a dense array
+
+population.csv is parsed once into a cube of shape (areas, years,
+sexes, ages) and saved next to it as a binary .npy file, with the
+area, year, and sex labels in a small json index.  Later imports
+memory-map the binary file instead of parsing the csv, and rebuild it
+only when the csv changes.  Regional, super-regional, and world
+populations are sums over the area axis, computed for many groups at
+once as a single matrix product.
+
+Example
+-------
+>>> from dismod3 import population
+>>> population.population_by_age()['USA', '2005', 'male'][:5]
+>>> population.regional_population('north_america_high_income', '2005', 'total')
+"""
+
+import os
+
+import numpy as np
+import pylab as pl
+import simplejson as json
+
+import settings
+from utils import clean
+
+_cube = {}
+
+def build(csv_fname, min_pop=.001):
+    """ Parse population.csv into a population cube
+
+    :Parameters:
+      - `csv_fname` : str, path of csv with columns 'Country Code', 'Year', 'Sex',
+        and 'Age %d Population' for ages 0 to MAX_AGE-1
+      - `min_pop` : float, optional, lower bound on population of each age
+
+    :Results:
+      - Returns dict with pop, an array of shape (areas, years, sexes, ages),
+        present, a boolean array of shape (areas, years, sexes) that is
+        True for the rows found in the csv, and the lists of areas, years,
+        and sexes that label the axes
+    """
+    import csv
+    age_cols = ['Age %d Population' % a for a in range(settings.MAX_AGE)]
+
+    rows = {}
+    for r in csv.DictReader(open(csv_fname)):
+        rows[r['Country Code'], r['Year'], r['Sex']] = [float(r[c]) for c in age_cols]
+
+    areas = sorted(set([k[0] for k in rows]))
+    years = sorted(set([k[1] for k in rows]))
+    sexes = sorted(set([k[2] for k in rows]))
+    cube = dict(areas=areas, years=years, sexes=sexes)
+    index(cube)
+
+    pop = pl.zeros((len(areas), len(years), len(sexes), settings.MAX_AGE))
+    present = pl.zeros((len(areas), len(years), len(sexes)), dtype=bool)
+    for (a, y, s), vals in rows.items():
+        i, j, k = cube['area_index'][a], cube['year_index'][y], cube['sex_index'][s]
+        pop[i, j, k] = vals
+        present[i, j, k] = True
+    cube['pop'] = pl.maximum(min_pop, pop)
+    cube['present'] = present
+
+    return cube
+
+def index(cube):
+    """ Add dicts mapping each area, year, and sex label to its position in the cube"""
+    for axis, labels in [['area', 'areas'], ['year', 'years'], ['sex', 'sexes']]:
+        cube['%s_index' % axis] = dict([(label, i) for i, label in enumerate(cube[labels])])
+    return cube
+
+def _replace(fname, write):
+    """ Call write on a file with a temporary name in the same
+    directory as fname, then rename it to fname, so that a process
+    reading or memory-mapping fname never sees a half-written file"""
+    tmp = '%s.tmp%d' % (fname, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        write(f)
+        f.close()
+        os.rename(tmp, fname)
+    except:
+        f.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def save(cube, fname):
+    """ Save cube as fname.npy, fname-present.npy, and fname.json
+
+    .. note::
+      - each file is replaced atomically, and the json index is written
+        last, so that it marks a complete cube; processes that already
+        have the old .npy memory-mapped keep reading the old file
+    """
+    _replace(fname + '.npy', lambda f: np.save(f, cube['pop']))
+    _replace(fname + '-present.npy', lambda f: np.save(f, cube['present']))
+    _replace(fname + '.json', lambda f: json.dump(dict([(k, cube.get(k)) for k in ['areas', 'years', 'sexes', 'source']]), f))
+
+def load(fname):
+    """ Load a cube saved by save(), with pop memory-mapped from disk"""
+    f = open(fname + '.json')
+    cube = json.load(f)
+    f.close()
+    cube['areas'] = [str(a) for a in cube['areas']]
+    cube['years'] = [str(y) for y in cube['years']]
+    cube['sexes'] = [str(s) for s in cube['sexes']]
+    cube['pop'] = np.load(fname + '.npy', mmap_mode='r')
+    cube['present'] = np.load(fname + '-present.npy')
+    return index(cube)
+
+def get_cube(csv_fname=None):
+    """ Get the population cube for csv_fname, from memory, from its
+    binary file, or by parsing the csv, in that order of preference
+
+    :Parameters:
+      - `csv_fname` : str, optional, settings.CSV_PATH + 'population.csv' by default
+
+    :Results:
+      - Returns cube dict, as described in build()
+
+    :Notes:
+      - The binary file is rebuilt when the size or modification time
+        of the csv differs from those recorded in it
+    """
+    if csv_fname == None:
+        csv_fname = settings.CSV_PATH + 'population.csv'
+    if csv_fname in _cube:
+        return _cube[csv_fname]
+
+    st = os.stat(csv_fname)
+    source = [st.st_size, int(st.st_mtime)]
+    fname = os.path.splitext(csv_fname)[0] + '-cube'
+
+    cube = None
+    try:
+        cube = load(fname)
+        if cube.get('source') != source:
+            cube = None
+    except (IOError, ValueError):
+        pass
+
+    if cube == None:
+        cube = build(csv_fname)
+        cube['source'] = source
+        try:
+            save(cube, fname)
+            cube = load(fname)
+        except IOError:
+            print 'WARNING: could not save binary population cube %s, using it from memory' % fname
+
+    _cube[csv_fname] = cube
+    return cube
+
+def population_by_age(cube=None):
+    """ Get population age patterns keyed by (area, year, sex)
+
+    :Parameters:
+      - `cube` : dict, optional, from get_cube() by default
+
+    :Results:
+      - Returns dict of arrays of population at each age, keyed by
+        (iso3, str year, sex) for each country in the csv; the arrays
+        are views into the cube, so no data is copied
+    """
+    if cube == None:
+        cube = get_cube()
+    pop = cube['pop']
+    return dict([((a, y, s), pop[i, j, k])
+                 for a, i in cube['area_index'].items() if len(a) == 3
+                 for y, j in cube['year_index'].items()
+                 for s, k in cube['sex_index'].items()
+                 if cube['present'][i, j, k]])
+
+def aggregate(groups, cube=None):
+    """ Sum the population of areas into groups, such as regions or super-regions
+
+    :Parameters:
+      - `groups` : dict of lists of areas, keyed by group name
+      - `cube` : dict, optional, from get_cube() by default
+
+    :Results:
+      - Returns dict of arrays of shape (years, sexes, ages), keyed by
+        group name; areas not in the cube contribute nothing
+    """
+    if cube == None:
+        cube = get_cube()
+    names = sorted(groups)
+    pop = cube['pop']
+
+    # one row of zeros and ones for each group, multiplied into the area axis
+    G = pl.zeros((len(names), len(cube['areas'])))
+    for g, name in enumerate(names):
+        for a in groups[name]:
+            if a in cube['area_index']:
+                G[g, cube['area_index'][a]] = 1.
+    totals = pl.dot(G, pop.reshape(len(cube['areas']), -1)).reshape((len(names),) + pop.shape[1:])
+
+    return dict(zip(names, totals))
+
+def hierarchy_groups(hierarchy, areas=None):
+    """ Group the areas in the cube by every node of an area hierarchy
+
+    :Parameters:
+      - `hierarchy` : nx.DiGraph, with edges from each area to the areas it contains,
+        e.g. all -> super-region -> region -> country
+      - `areas` : list, optional, the areas that have population, the areas of the cube by default
+
+    :Results:
+      - Returns dict of lists of areas, keyed by hierarchy node,
+        suitable for aggregate()
+    """
+    import networkx as nx
+    if areas == None:
+        areas = get_cube()['areas']
+    areas = set(areas)
+    return dict([(n, [a for a in nx.dfs_preorder_nodes(hierarchy, n) if a in areas]) for n in hierarchy])
+
+def region_groups():
+    """ Group the countries of country_region.csv by GBD region, plus 'world' for all of them"""
+    from neg_binom_model import countries_for
+    groups = dict([(clean(r), countries_for[clean(r)]) for r in settings.gbd_regions])
+    groups['world'] = sorted(set(sum(groups.values(), [])))
+    return groups
+
+def regional_population(region, year, sex, cube=None):
+    """ Calculate the population of a region, year, and sex
+
+    :Parameters:
+      - `region` : str, a GBD region, 'world', or an area of the cube
+      - `year` : str, a year of the cube, or 'all' for the sum over settings.gbd_years
+      - `sex` : str, a sex of the cube, or 'all' or 'total' for the sum over sexes
+      - `cube` : dict, optional, from get_cube() by default
+
+    :Results:
+      - Returns array of population at each age
+    """
+    if cube == None:
+        cube = get_cube()
+    region = clean(region)
+    year = str(year)
+    sex = clean(sex)
+
+    if region in cube['area_index']:
+        areas = [cube['area_index'][region]]
+    else:
+        areas = [cube['area_index'][a] for a in region_groups()[region]]
+    if year == 'all':
+        years = [cube['year_index'][y] for y in settings.gbd_years]
+    else:
+        years = [cube['year_index'][year]]
+    if sex in ['all', 'total']:
+        sexes = [cube['sex_index'][clean(s)] for s in settings.gbd_sexes]
+    else:
+        sexes = [cube['sex_index'][sex]]
+
+    pop = cube['pop'][pl.ix_(areas, years, sexes)]
+    return pl.asarray(pop.reshape(-1, pop.shape[-1]).sum(axis=0))
@@ -23,6 +23,16 @@ DISMOD_LOG_STATUS_URL = DISMOD_BASE_URL + 'dismod/log_status/%d/%s/%s/%s'
 
 
 ON_SGE = 0
+
+# reload the modules of the package and the fitting scripts when they
+# are imported again, which is handy while editing them in an
+# interactive session, but slow for everything else
+RELOAD_MODULES = False
+
+# path of the unix socket of a warm_worker.py serve process to run
+# jobs in when not on SGE, or '' to start a new python for each job
+WORKER_SOCKET = ''
+
 SERVER_LOAD_STATUS_HOST = 'omak.ihme.washington.edu'
 SERVER_LOAD_STATUS_PORT = 1723
 SERVER_LOAD_STATUS_SIZE = 20480
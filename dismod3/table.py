@@ -277,15 +277,5 @@ def population_by_region_year_sex(region, year, sex):
     -------
     population : list of float numbers
     """
-    region = dismod3.utils.clean(region)
-    year = str(year)
-    sex = dismod3.utils.clean(sex)
-    population = pl.zeros(dismod3.settings.MAX_AGE)
-    for iso in countries_for[region]:
-        if sex == 'all' or sex == 'total':
-            population += population_by_age[(iso, year, 'male')]
-            population += population_by_age[(iso, year, 'female')]
-        else:
-            population += population_by_age[(iso, year, sex)]
-    return population
+    return dismod3.population.regional_population(region, year, sex)
 
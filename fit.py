@@ -7,11 +7,15 @@ import pylab as pl
 import dismod3
 
 import fit_model
-reload(fit_model)
+import multi_chain
+if dismod3.settings.RELOAD_MODULES:
+    reload(fit_model)
+    reload(multi_chain)
 
 import sys
 
-def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False):
+def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False, map_method='fmin_l_bfgs_b',
+            chains=1, max_iter=None, min_ess=400, max_rhat=1.05, db='ram'):
     """ Fit data model for one epidemiologic parameter using MCMC
     
     :Parameters:
@@ -22,13 +26,29 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
       - `thin` : int, samples thinned by this number
       - `tune_interval` : int
       - `verbose` : boolean
+      - `map_method` : str, optimizer for the initial values, 'fmin_l_bfgs_b' or 'fmin_tnc' (one joint
+        gradient-based fit of all stochs, see fit_model.find_joint_map), or 'fmin_powell' (sequential fits
+        of the knots, random effects, fixed effects, and dispersion)
+      - `chains` : int, number of chains; with more than one, the chains run in parallel processes from
+        dispersed starting values, and are checked for convergence every `iter` minus `burn` iterations,
+        until every stoch has split R-hat below `max_rhat` and effective sample size above `min_ess`,
+        or each chain has run `max_iter` iterations (see multi_chain.sample)
+      - `max_iter` : int, optional, maximum number of iterations of each chain, 10 times `iter` by default
+      - `min_ess` : float, target effective sample size, for more than one chain
+      - `max_rhat` : float, target split R-hat, for more than one chain
+      - `db` : str or database, PyMC trace backend for the MCMC, e.g. a trace_db.Database to keep
+        the draws on disk (see trace_db.tally_only to choose which nodes to keep draws of)
 
     :Results:
       - returns a pymc.MCMC object created from vars, that has been fit with MCMC
+      - the pymc.MAP object used for the initial values is returned with it, and is None
+        when `map_method` is gradient-based, since the joint fit does not use one
 
     .. note::
       - `burn` must be less than `iter`
       - `thin` must be less than `iter` minus `burn`
+      - with more than one chain, the merged draws of all chains are in the traces,
+        and the convergence diagnostics are in the `convergence` attribute of the pymc.MCMC object
 
     """
     assert burn < iter, 'burn must be less than iter'
@@ -37,29 +57,38 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     vars = model.vars[data_type]
     
     start_time = time.time()
-    map = mc.MAP(vars)
-    m = mc.MCMC(vars)
+    map = None
+    m = mc.MCMC(vars, db=db)
 
     ## use MAP to generate good initial conditions
     try:
-        method='fmin_powell'
+        method=map_method
         tol=.001
 
-        fit_model.logger.info('finding initial values')
-        fit_model.find_asr_initial_vals(vars, method, tol, verbose)
+        if method in fit_model.gradient_methods:
+            fit_model.logger.info('finding MAP estimate')
+            fit_model.find_joint_map(vars, method, tol, verbose)
+        else:
+            fit_model.logger.info('finding initial values')
+            fit_model.find_asr_initial_vals(vars, method, tol, verbose)
 
-        fit_model.logger.info('\nfinding MAP estimate')
-        map.fit(method=method, tol=tol, verbose=verbose)
+            fit_model.logger.info('\nfinding MAP estimate')
+            map = mc.MAP(vars)
+            map.fit(method=method, tol=tol, verbose=verbose)
         
         if verbose:
             fit_model.print_mare(vars)
         fit_model.logger.info('\nfinding step covariances estimate')
         fit_model.setup_asr_step_methods(m, vars)
 
-        fit_model.logger.info('\nresetting initial values (1)')
-        fit_model.find_asr_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('\nresetting initial values (2)\n')
-        map.fit(method=method, tol=tol, verbose=verbose)
+        if method in fit_model.gradient_methods:
+            fit_model.logger.info('\nresetting initial values\n')
+            fit_model.find_joint_map(vars, method, tol, verbose)
+        else:
+            fit_model.logger.info('\nresetting initial values (1)')
+            fit_model.find_asr_initial_vals(vars, method, tol, verbose)
+            fit_model.logger.info('\nresetting initial values (2)\n')
+            map.fit(method=method, tol=tol, verbose=verbose)
     except KeyboardInterrupt:
         fit_model.logger.warning('Initial condition calculation interrupted')
 
@@ -67,16 +96,21 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     fit_model.print_mare(vars)
 
     fit_model.logger.info('sampling from posterior\n')
-    m.iter=iter
-    m.burn=burn
-    m.thin=thin
-    if verbose:
-        try:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
-        except TypeError:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
+    if chains > 1:
+        if max_iter == None:
+            max_iter = 10*iter
+        multi_chain.sample(m, vars, chains, burn, thin, iter-burn, max_iter, min_ess, max_rhat, tune_interval)
     else:
-        m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
+        m.iter=iter
+        m.burn=burn
+        m.thin=thin
+        if verbose:
+            try:
+                m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
+            except TypeError:
+                m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
+        else:
+            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
 
     m.wall_time = time.time() - start_time
     
@@ -86,7 +120,8 @@ def fit_asr(model, data_type, iter=2000, burn=1000, thin=1, tune_interval=100, v
     return model.map, model.mcmc
 
 # TODO: move fit_model.fit_consistent_model to fit.fit_consistent
-def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False):
+def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbose=False, map_method='fmin_l_bfgs_b',
+                   chains=1, max_iter=None, min_ess=400, max_rhat=1.05, db='ram'):
     """Fit data model for all epidemiologic parameters using MCMC
     
     :Parameters:
@@ -96,9 +131,17 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
       - `thin` : int, samples thinned by this number
       - `tune_interval` : int
       - `verbose` : boolean
+      - `map_method` : str, optimizer for the initial values, 'fmin_l_bfgs_b' or 'fmin_tnc' (one joint
+        gradient-based fit of all stochs, with the ODE linearized, see fit_model.find_joint_map),
+        or 'fmin_powell' (sequential fits of the knots, random effects, fixed effects, and dispersion)
+      - `chains`, `max_iter`, `min_ess`, `max_rhat` : sample with several chains in parallel until they
+        converge, as in fit_asr
+      - `db` : str or database, PyMC trace backend for the MCMC, as in fit_asr
 
     :Results:
       - returns a pymc.MCMC object created from vars, that has been fit with MCMC
+      - the pymc.MAP object used for the initial values is returned with it, and is None
+        when `map_method` is gradient-based, since the joint fit does not use one
 
     .. note::
       - `burn` must be less than `iter`
@@ -113,37 +156,42 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
     vars = model.vars
     
     start_time = time.time()
-    map = mc.MAP(vars)
-    m = mc.MCMC(vars)
+    map = None
+    m = mc.MCMC(vars, db=db)
 
     ## use MAP to generate good initial conditions
     try:
         method='fmin_powell'
         tol=.001
 
-        fit_model.logger.info('fitting submodels')
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
+        if map_method in fit_model.gradient_methods:
+            fit_model.logger.info('fitting all stochs jointly\n')
+            fit_model.find_joint_map(vars, map_method, tol, verbose)
+        else:
+            fit_model.logger.info('fitting submodels')
+            fit_model.find_consistent_spline_initial_vals(vars, map_method, tol, verbose)
 
-        for t in param_types:
-            fit_model.find_re_initial_vals(vars[t], method, tol, verbose)
-            fit_model.logger.info('.')
-
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('.')
+            for t in param_types:
+                fit_model.find_re_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
 
-        for t in param_types:
-            fit_model.find_fe_initial_vals(vars[t], method, tol, verbose)
+            fit_model.find_consistent_spline_initial_vals(vars, map_method, tol, verbose)
             fit_model.logger.info('.')
 
-        fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
-        fit_model.logger.info('.')
+            for t in param_types:
+                fit_model.find_fe_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
 
-        for t in param_types:
-            fit_model.find_dispersion_initial_vals(vars[t], method, tol, verbose)
+            fit_model.find_consistent_spline_initial_vals(vars, map_method, tol, verbose)
             fit_model.logger.info('.')
 
-        fit_model.logger.info('\nfitting all stochs\n')
-        map.fit(method=method, tol=tol, verbose=verbose)
+            for t in param_types:
+                fit_model.find_dispersion_initial_vals(vars[t], method, tol, verbose)
+                fit_model.logger.info('.')
+
+            fit_model.logger.info('\nfitting all stochs\n')
+            map = mc.MAP(vars)
+            map.fit(method=method, tol=tol, verbose=verbose)
 
         if verbose:
             from fit_posterior import inspect_vars
@@ -183,24 +231,29 @@ def fit_consistent(model, iter=2000, burn=1000, thin=1, tune_interval=100, verbo
             fit_model.setup_asr_step_methods(m, vars[t], vars_to_fit)
 
             # reset values to MAP
-            fit_model.find_consistent_spline_initial_vals(vars, method, tol, verbose)
+            fit_model.find_consistent_spline_initial_vals(vars, map_method, tol, verbose)
             fit_model.logger.info('.')
-        map.fit(method=method, tol=tol, verbose=verbose)
+        fit_model.find_map(vars, vars, map_method, tol, verbose, map)
         fit_model.logger.info('.')
     except KeyboardInterrupt:
         fit_model.logger.warning('Initial condition calculation interrupted')
 
     fit_model.logger.info('\nsampling from posterior distribution\n')
-    m.iter=iter
-    m.burn=burn
-    m.thin=thin
-    if verbose:
-        try:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
-        except TypeError:
-            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
+    if chains > 1:
+        if max_iter == None:
+            max_iter = 10*iter
+        multi_chain.sample(m, vars, chains, burn, thin, iter-burn, max_iter, min_ess, max_rhat, tune_interval)
     else:
-        m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
+        m.iter=iter
+        m.burn=burn
+        m.thin=thin
+        if verbose:
+            try:
+                m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=True, progress_bar_fd=sys.stdout)
+            except TypeError:
+                m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False, verbose=verbose)
+        else:
+            m.sample(m.iter, m.burn, m.thin, tune_interval=tune_interval, progress_bar=False)
     m.wall_time = time.time() - start_time
 
     model.map = map
@@ -13,13 +13,16 @@ import subprocess
 
 import dismod3
 import data
-reload(data)
+import job_queue
+if dismod3.settings.RELOAD_MODULES:
+    reload(data)
 
 def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
             posteriors_only=False, posterior_types='p i r', fast=False,
             zero_re=True,
             alt_prior=True,
-            global_heterogeneity='Slightly'):
+            global_heterogeneity='Slightly',
+            max_procs=None, retries=1, use_cache=True, worker=None):
     """ Enqueues all jobs necessary to fit specified model
     to the cluster
 
@@ -27,6 +30,16 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
     ----------
     id : int
       The model id number for the job to fit
+    max_procs : int, optional
+      When not on SGE, the number of jobs to run at once, the number of processors by default
+    retries : int, optional
+      When not on SGE, the number of times to rerun a failed job
+    use_cache : bool, optional
+      Restore posteriors from the fit cache when their inputs are unchanged,
+      so that only the region/sex/years with new data or priors are refit
+    worker : str, optional
+      When not on SGE, the socket of a warm_worker.py process to run the jobs in,
+      dismod3.settings.WORKER_SOCKET by default
 
     Example
     -------
@@ -40,6 +53,7 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
         print 'loaded data from new format from %s' % dir
 
         # if we make it here, this model has already been run, so clean out the stdout/stderr dirs to make room for fresh messages
+        # (results in dir/cache are kept, and fit_posterior restores them for any region/sex/year whose inputs are unchanged)
         call_str = 'rm -rf %s/empirical_priors/stdout/* %s/empirical_priors/stderr/* %s/posterior/stdout/* %s/posterior/stderr/* %s/json/dm-*-*.json' % (dir, dir, dir, dir, dir)
         print call_str
         subprocess.call(call_str, shell=True)
@@ -79,6 +93,7 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
     f.close()
 
     # fit empirical priors (by pooling data from all regions)
+    jobs = []
     emp_names = []
 
     if not posteriors_only:
@@ -89,17 +104,11 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
             e = '%s/empirical_priors/stderr/dismod_log_%s' % (dir, t)
             name_str = '%s-%d' %(t[0], id)
             emp_names.append(name_str)
-            if dismod3.settings.ON_SGE:
-                call_str = 'qsub -cwd -o %s -e %s ' % (o, e) \
-                    + '-N %s ' % name_str \
-                    + 'run_on_cluster.sh '
-            else:
-                call_str = 'python '
-            call_str += 'fit_world.py %d' % id
+            call_str = 'fit_world.py %d' % id
 
             call_str += options(fast, zero_re, alt_prior, global_heterogeneity)
             
-            subprocess.call(call_str, shell=True)
+            jobs.append(job_queue.job(name_str, call_str, o, e))
 
         else:
             for t in ['excess-mortality', 'remission', 'incidence', 'prevalence']:
@@ -107,24 +116,24 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
                 e = '%s/empirical_priors/stderr/dismod_log_%s' % (dir, t)
                 name_str = '%s-%d' %(t[0], id)
                 emp_names.append(name_str)
-                if dismod3.settings.ON_SGE:
-                    call_str = 'qsub -cwd -o %s -e %s ' % (o, e) \
-                        + '-N %s ' % name_str \
-                        + 'run_on_cluster.sh '
-                else:
-                    call_str = 'python '
-                call_str += 'fit_emp_prior.py %d -t %s' % (id, t)
+                call_str = 'fit_emp_prior.py %d -t %s' % (id, t)
 
                 call_str += options(fast, zero_re, alt_prior, global_heterogeneity)
-                subprocess.call(call_str, shell=True)
+                jobs.append(job_queue.job(name_str, call_str, o, e))
 
     # directory to save the country level posterior csv files
     temp_dir = dir + '/posterior/country_level_posterior_dm-' + str(id) + '/'
 
-    #fit each region/year/sex individually for this model
-    hold_str = '-hold_jid %s ' % ','.join(emp_names)
+    # select the data and priors of each region/year/sex once, for all of the posterior jobs to load
+    o = '%s/posterior/stdout/dismod_log_prepare' % dir
+    e = '%s/posterior/stderr/dismod_log_prepare' % dir
+    prep_name = 'prep-%d' % id
+    call_str = 'fit_posterior.py %d --prepare=true' % id
     if posteriors_only:
-        hold_str = ''
+        call_str += ' --onlyposterior=True'
+    jobs.append(job_queue.job(prep_name, call_str, o, e, hold=emp_names))
+
+    #fit each region/year/sex individually for this model
     post_names = []
     for ii, r in enumerate(dismod3.gbd_regions):
         for s in dismod3.gbd_sexes:
@@ -135,14 +144,7 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
                 name_str = '%s%d%s%s%d' % (r[0], ii+1, s[0], str(y)[-1], id)
                 post_names.append(name_str)
 
-                if dismod3.settings.ON_SGE:
-                    call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-                        + hold_str \
-                        + '-N %s ' % name_str \
-                        + 'run_on_cluster.sh '
-                else:
-                    call_str = 'python '
-                call_str += 'fit_posterior.py %d -r %s -s %s -y %s' % (id, dismod3.utils.clean(r), dismod3.utils.clean(s), y)
+                call_str = 'fit_posterior.py %d -r %s -s %s -y %s' % (id, dismod3.utils.clean(r), dismod3.utils.clean(s), y)
 
                 if not consistent_posterior:
                     call_str += ' --inconsistent=True --types="%s"' % posterior_types
@@ -155,21 +157,21 @@ def fit_all(id, consistent_empirical_prior=True, consistent_posterior=True,
 
                 call_str += ' --zerore=%s'%zero_re
 
-                subprocess.call(call_str, shell=True)
+                if not use_cache:
+                    call_str += ' --cache=false'
+
+                # the prepare job only saves work, since each posterior job prepares its own
+                # data and priors if they are missing, so wait for it without requiring success
+                jobs.append(job_queue.job(name_str, call_str, o, e, hold=emp_names, after=[prep_name]))
 
     # after all posteriors have finished running, upload disease model json
-    hold_str = '-hold_jid %s ' % ','.join(post_names)
     o = '%s/empirical_priors/stdout/%d_upload.txt' % (dir, id)
     e = '%s/empirical_priors/stderr/%d_upload.txt' % (dir, id)
-    if dismod3.settings.ON_SGE:
-        call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-            + hold_str \
-            + '-N upld-%s ' % id \
-            + 'run_on_cluster.sh '
-    else:
-        call_str = 'python '
-    call_str += 'upload_fits.py %d' % id
-    subprocess.call(call_str, shell=True)
+    call_str = 'upload_fits.py %d' % id
+    jobs.append(job_queue.job('upld-%s' % id, call_str, o, e, after=post_names))
+
+    # run on the cluster, or on this machine with up to max_procs jobs at once
+    job_queue.run(jobs, max_procs, retries, worker)
 
     return dm
 
@@ -192,6 +194,14 @@ def main():
                       help='use alternative aggregation for empirical prior')
     parser.add_option('-g', '--globalheterogeneity', default='Slightly',
                       help='negative binomial heterogeneity for global estimate')
+    parser.add_option('-p', '--procs', default='0',
+                      help='number of jobs to run at once when not on SGE (0 for the number of processors)')
+    parser.add_option('-R', '--retries', default='1',
+                      help='number of times to rerun a failed job when not on SGE')
+    parser.add_option('-k', '--cache', default='true',
+                      help='reuse cached posteriors for region/sex/years whose inputs are unchanged')
+    parser.add_option('-w', '--worker', default='',
+                      help='socket of warm_worker.py process to run jobs in when not on SGE')
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
@@ -210,7 +220,11 @@ def main():
                  fast=(options.fast.lower() == 'true'),
                  zero_re=options.zerore.lower() == 'true',
                  alt_prior=options.altprior.lower() == 'true',
-                 global_heterogeneity=options.globalheterogeneity)
+                 global_heterogeneity=options.globalheterogeneity,
+                 max_procs=(int(options.procs) or None),
+                 retries=int(options.retries),
+                 use_cache=options.cache.lower() == 'true',
+                 worker=(options.worker or None))
 
 if __name__ == '__main__':
     dm = main()
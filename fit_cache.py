@@ -0,0 +1,162 @@
+""" Content-addressed cache of fit results
+
+Each posterior job is keyed by a hash of everything that goes into
+it: the data rows selected for the region/sex/year, the empirical
+priors, the model parameters, the output template rows used for
+predictions, and the fit settings.  After a fit, its output files
+are copied into dir/cache/<key>/, and a later job with the same key
+copies them back instead of refitting, so rerunning a model only
+refits the cells whose inputs changed.
+
+Example
+-------
+>>> import fit_cache
+>>> key = fit_cache.input_hash(model.input_data, emp_priors, model.parameters, settings)
+>>> if not fit_cache.restore(dir, key):
+...     # fit the model and write the output files
+...     fit_cache.store(dir, key, fit_cache.output_files(dir, id, 'asia_east', 'male', 2005))
+"""
+
+import hashlib
+import glob
+import os
+import shutil
+
+import pylab as pl
+import pandas
+import simplejson as json
+
+# increment to invalidate the cache when the fitting code changes what it outputs
+CACHE_VERSION = 1
+
+def canonical(obj):
+    """ Convert an input of a fit to plain python types in a stable order
+
+    :Parameters:
+      - `obj` : DataFrame, Series, array, dict, list, or scalar
+
+    :Results:
+      - Returns lists, dicts with str keys, floats, and strs, which
+        json encodes the same way whenever the inputs are the same
+    """
+    if isinstance(obj, pandas.DataFrame):
+        return dict(columns=[str(c) for c in obj.columns],
+                    index=canonical(list(obj.index)),
+                    values=[canonical(list(obj[c])) for c in obj.columns])
+    elif isinstance(obj, pandas.Series):
+        return dict(index=canonical(list(obj.index)),
+                    values=canonical(list(obj)))
+    elif isinstance(obj, pl.ndarray):
+        return canonical(obj.tolist())
+    elif isinstance(obj, dict):
+        return dict([(str(k), canonical(v)) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    elif isinstance(obj, (bool, pl.bool_)):
+        return bool(obj)
+    elif isinstance(obj, (int, long, float, pl.number)):
+        x = float(obj)
+        if pl.isnan(x):
+            return 'nan'
+        elif pl.isinf(x):
+            return x > 0 and 'inf' or '-inf'
+        return repr(x)
+    elif obj is None:
+        return None
+    else:
+        return str(obj)
+
+def input_hash(*inputs):
+    """ Hash the inputs of a fit
+
+    :Parameters:
+      - `inputs` : any number of objects that canonical() accepts
+
+    :Results:
+      - Returns a hex str that changes whenever any input changes
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([CACHE_VERSION, canonical(list(inputs))], sort_keys=True))
+    return h.hexdigest()
+
+def cache_dir(dir, key):
+    """ Directory holding the cached outputs for key"""
+    return '%s/cache/%s' % (dir, key)
+
+def output_files(dir, id, region, sex, year):
+    """ Find the output files of the posterior fit for a region/sex/year
+
+    :Parameters:
+      - `dir` : str, the job working directory
+      - `id` : int, the model id
+      - `region`, `sex`, `year` : the cleaned region, sex, and year of the fit
+
+    :Results:
+      - Returns list of paths of existing files, relative to dir
+    """
+    patterns = ['json/dm-%d-posterior-%s-%s-%s.json' % (id, region, sex, year),
+                'image/posterior-%s+%s+%s*.png' % (region, sex, year),
+                'posterior/*-%s+%s+%s.csv' % (region, sex, year),
+                'posterior/dm-%d-*-%s-%s-%s.csv' % (id, region, sex, year)]
+
+    files = []
+    for p in patterns:
+        files += [os.path.relpath(f, dir) for f in sorted(glob.glob('%s/%s' % (dir, p)))]
+    return files
+
+def store(dir, key, files):
+    """ Copy the output files of a fit into the cache
+
+    :Parameters:
+      - `dir` : str, the job working directory
+      - `key` : str, from input_hash()
+      - `files` : list of paths relative to dir, from output_files()
+
+    :Results:
+      - Writes dir/cache/<key>/ with a copy of each file and a
+        manifest listing them, which is written last so that an
+        interrupted store is never restored
+    """
+    cdir = cache_dir(dir, key)
+    if os.path.exists(cdir):
+        shutil.rmtree(cdir)
+    os.makedirs(cdir)
+
+    for f in files:
+        dest = '%s/%s' % (cdir, f)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copy2('%s/%s' % (dir, f), dest)
+
+    f = open('%s/manifest.json' % cdir, 'w')
+    json.dump(files, f)
+    f.close()
+
+def restore(dir, key):
+    """ Copy the cached output files of a fit back into place
+
+    :Parameters:
+      - `dir` : str, the job working directory
+      - `key` : str, from input_hash()
+
+    :Results:
+      - Returns True if outputs for key were in the cache and have been
+        restored, False if the fit must be run
+    """
+    cdir = cache_dir(dir, key)
+    try:
+        f = open('%s/manifest.json' % cdir)
+        files = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return False
+
+    if not files or not all(os.path.exists('%s/%s' % (cdir, f)) for f in files):
+        return False
+
+    for f in files:
+        dest = '%s/%s' % (dir, f)
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copy2('%s/%s' % (cdir, f), dest)
+    return True
@@ -13,20 +13,23 @@ import dismod3
 import pylab as pl
 import pymc as mc
 import pandas
-import networkx as nx
 
 import ism
 import covariate_model
+import rate_model
+import hierarchy_index
 import fit_model
+import trace_db
 import graphics
 
-reload(ism)
-reload(covariate_model)
-reload(fit_model)
-reload(graphics)
+if dismod3.settings.RELOAD_MODULES:
+    reload(ism)
+    reload(covariate_model)
+    reload(fit_model)
+    reload(graphics)
 
 def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
-                  zero_re=True, alt_prior=False, global_heterogeneity='Slightly'):
+                  zero_re=True, alt_prior=False, global_heterogeneity='Slightly', plot_emp_priors=True):
     """ Fit empirical prior of specified type for specified model
 
     Parameters
@@ -35,6 +38,8 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
       The model id number for the job to fit
     param_type : str, one of incidence, prevalence, remission, excess-mortality, prevalence_x_excess-mortality
       The disease parameter to generate empirical priors for
+    plot_emp_priors : bool, optional
+      Add the empirical prior means to the plot of the fit
 
     Example
     -------
@@ -47,7 +52,8 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
     ## load the model from disk or from web
     import simplejson as json
     import data
-    reload(data)
+    if dismod3.settings.RELOAD_MODULES:
+        reload(data)
 
     dm = dismod3.load_disease_model(id)
     
@@ -124,11 +130,14 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
     if fast_fit:
         dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=101, burn=0, thin=1, tune_interval=100)
     else:
-        dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True)
+        # keep the draws on disk, and only of the stochs and the outputs used below
+        trace_db.tally_only(model.vars[t])
+        db = trace_db.Database(dir + '/traces/prior-%s' % param_type, float32=True)
+        dm.map, dm.mcmc = dismod3.fit.fit_asr(model, t, iter=50000, burn=10000, thin=40, tune_interval=1000, verbose=True, db=db)
 
-    stats = dm.vars['p_pred'].stats(batches=5)
-    dm.vars['data']['mu_pred'] = stats['mean']
-    dm.vars['data']['sigma_pred'] = stats['standard deviation']
+    p_pred = rate_model.predict(dm.vars['p_pred'])
+    dm.vars['data']['mu_pred'] = p_pred.mean(axis=0)
+    dm.vars['data']['sigma_pred'] = p_pred.std(axis=0)
 
     stats = dm.vars['pi'].stats(batches=5)
     dm.vars['data']['mc_error'] = stats['mc error']
@@ -138,35 +147,10 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
 
     graphics.plot_fit(model, data_types=[t], ylab=['PY'], plot_config=(1,1), fig_size=(8,8))
     if generate_emp_priors:
-        for a in [dismod3.utils.clean(a) for a in dismod3.settings.gbd_regions]:
-            print 'generating empirical prior for %s' % a
-            for s in dismod3.settings.gbd_sexes:
-                for y in dismod3.settings.gbd_years:
-                    key = dismod3.utils.gbd_key_for(param_type, a, y, s)
-                    if t in model.parameters and 'level_bounds' in model.parameters[t]:
-                        lower=model.parameters[t]['level_bounds']['lower']
-                        upper=model.parameters[t]['level_bounds']['upper']
-                    else:
-                        lower=0
-                        upper=pl.inf
-
-                    emp_priors = covariate_model.predict_for(model,
-                                                             model.parameters[t],
-                                                             'all', 'total', 'all',
-                                                             a, dismod3.utils.clean(s), int(y),
-                                                             alt_prior,
-                                                             vars, lower, upper)
-                    dm.set_mcmc('emp_prior_mean', key, emp_priors.mean(0))
-
-                    if 'eta' in vars:
-                        N,A = emp_priors.shape  # N samples, for A age groups
-                        delta_trace = pl.transpose([pl.exp(vars['eta'].trace()) for _ in range(A)])  # shape delta matrix to match prediction matrix
-                        emp_prior_std = pl.sqrt(emp_priors.var(0) + (emp_priors**2 / delta_trace).mean(0))
-                    else:
-                        emp_prior_std = emp_priors.std(0)
-                    dm.set_mcmc('emp_prior_std', key, emp_prior_std)
-
-                    pl.plot(model.parameters['ages'], dm.get_mcmc('emp_prior_mean', key), color='grey', label=a, zorder=-10, alpha=.5)
+        priors = empirical_priors(model, t, vars, alt_prior)
+        store_empirical_priors(dm, param_type, priors)
+        if plot_emp_priors:
+            plot_empirical_priors(model, priors)
     pl.savefig(dir + '/prior-%s.png'%param_type)
 
     store_effect_coefficients(dm, vars, param_type)
@@ -192,6 +176,105 @@ def fit_emp_prior(id, param_type, fast_fit=False, generate_emp_priors=True,
 
 
 
+def empirical_priors(model, t, vars, alt_prior=False, regions=None, sexes=None, years=None):
+    """ Generate empirical prior mean and std for every region, sex, and year
+
+    Parameters
+    ----------
+    model : data.ModelData
+      The model that vars were fit for, with 'all', 'total', 'all' as the reference node
+    t : str
+      The rate type of vars, used for the level bounds in model.parameters
+    vars : dict
+      The fitted PyMC objects for rate type t
+    alt_prior : bool, optional
+      Combine countries in linear-space with population weights, instead of in log-space
+    regions, sexes, years : lists, optional
+      The gbd regions, sexes, and years to generate priors for, from dismod3.settings by default
+
+    Results
+    -------
+    Returns dict of dicts with keys 'mean' and 'std', keyed by (region, year, sex)
+
+    Notes
+    -----
+    The covariate shifts for all countries are found once for each
+    sex and year, and the predictions for all regions are combined
+    into one (regions x draws x ages) array, so the mean and std,
+    including the negative binomial dispersion, are computed together
+    """
+    if regions == None:
+        regions = [dismod3.utils.clean(a) for a in dismod3.settings.gbd_regions]
+    if sexes == None:
+        sexes = dismod3.settings.gbd_sexes
+    if years == None:
+        years = dismod3.settings.gbd_years
+
+    if t in model.parameters and 'level_bounds' in model.parameters[t]:
+        lower=model.parameters[t]['level_bounds']['lower']
+        upper=model.parameters[t]['level_bounds']['upper']
+    else:
+        lower=0
+        upper=pl.inf
+
+    mu_age_trace = covariate_model.age_pattern_trace(vars)
+    if 'eta' in vars:
+        delta_trace = pl.exp(vars['eta'].trace())
+    output_template = model.output_template.groupby(['area', 'sex', 'year']).mean()
+    index = hierarchy_index.build(model.hierarchy)
+    region_leaves = [hierarchy_index.leaves(index, a) for a in regions]
+
+    priors = {}
+    for s in sexes:
+        for y in years:
+            print 'generating empirical priors for %s %s' % (s, y)
+            shifts = covariate_model.leaf_covariate_shifts(model, model.parameters.get(t, {}),
+                                                           'all', 'all', dismod3.utils.clean(s), int(y),
+                                                           vars, len(mu_age_trace), output_template, index)
+            covariate_shifts = covariate_model.aggregate_covariate_shifts(shifts, region_leaves, alt_prior)
+
+            # predictions for all regions, with shape (regions, draws, ages)
+            predictions = (covariate_shifts[:, :, pl.newaxis] * mu_age_trace[pl.newaxis, :, :]).clip(lower, upper)
+
+            mean = predictions.mean(axis=1)
+            if 'eta' in vars:
+                std = pl.sqrt(predictions.var(axis=1) + (predictions**2 / delta_trace[pl.newaxis, :, pl.newaxis]).mean(axis=1))
+            else:
+                std = predictions.std(axis=1)
+
+            for k, a in enumerate(regions):
+                priors[a, y, s] = dict(mean=mean[k], std=std[k])
+
+    return priors
+
+def store_empirical_priors(dm, param_type, priors):
+    """ Save empirical priors in the disease model
+
+    Parameters
+    ----------
+    dm : DiseaseJson
+    param_type : str
+      The disease parameter the priors are for, e.g. incidence
+    priors : dict
+      From empirical_priors
+    """
+    for (a, y, s), prior in priors.items():
+        key = dismod3.utils.gbd_key_for(param_type, a, y, s)
+        dm.set_mcmc('emp_prior_mean', key, prior['mean'])
+        dm.set_mcmc('emp_prior_std', key, prior['std'])
+
+def plot_empirical_priors(model, priors):
+    """ Plot the mean of each empirical prior on the current axes
+
+    Parameters
+    ----------
+    model : data.ModelData
+    priors : dict
+      From empirical_priors
+    """
+    for (a, y, s), prior in sorted(priors.items()):
+        pl.plot(model.parameters['ages'], prior['mean'], color='grey', label=a, zorder=-10, alpha=.5)
+
 def store_effect_coefficients(dm, vars, param_type):
     """ store effect coefficients"""
     # save the results in the param_hash
@@ -205,14 +288,23 @@ def store_effect_coefficients(dm, vars, param_type):
             if isinstance(n, mc.Node):
                 res.append(n.trace())
             else:
-                res.append([n for _ in vars['p_pred'].trace()])
+                res.append([n for _ in vars['mu_age'].trace()])
         stats = pl.vstack(res)
         stats = pandas.DataFrame(dict(mean=stats.mean(1), std=stats.std(1)), index=vars['U'].columns)
     else:
         stats = pandas.DataFrame(dict(mean=[], std=[]))
 
-    prior_vals['alpha'] = [sum([0] + [stats['mean'][n] for n in nx.shortest_path(dm.model.hierarchy, 'all', dismod3.utils.clean(a)) if n in stats['mean']]) for a in dismod3.settings.gbd_regions]
-    prior_vals['sigma_alpha'] = [sum([0] + [stats['std'][n] for n in nx.shortest_path(dm.model.hierarchy, 'all', dismod3.utils.clean(a)) if n in stats['mean']]) for a in dismod3.settings.gbd_regions]
+    # sum the effects on the path from the root to each region, with a trailing zero for the padding of the paths
+    index = hierarchy_index.build(dm.model.hierarchy)
+    node_mean = pl.zeros(len(index['nodes']) + 1)
+    node_std = pl.zeros(len(index['nodes']) + 1)
+    for n in stats.index:
+        if n in index['id']:
+            node_mean[index['id'][n]] = stats['mean'][n]
+            node_std[index['id'][n]] = stats['std'][n]
+    paths = hierarchy_index.row_ancestors(index, [dismod3.utils.clean(a) for a in dismod3.settings.gbd_regions])
+    prior_vals['alpha'] = list(node_mean[paths].sum(axis=1))
+    prior_vals['sigma_alpha'] = list(node_std[paths].sum(axis=1))
 
     index = []
     for level in ['Country_level', 'Study_level']:
@@ -288,8 +380,12 @@ def store_effect_coefficients(dm, vars, param_type):
         prior_vals['sigma_delta'] = stats.std()
 
     try:
-        prior_vals['aic'] = dm.map.AIC
-        prior_vals['bic'] = dm.map.BIC
+        map = dm.map
+        if map is None:
+            # fit_asr makes no pymc.MAP when the initial values come from a gradient-based fit
+            map = mc.MAP(vars)
+        prior_vals['aic'] = map.AIC
+        prior_vals['bic'] = map.BIC
     except AttributeError, e:
         print 'Saving AIC/BIC failed', e
 
@@ -2,10 +2,12 @@
 import sys
 import time
 
-import pylab as pl
+import numpy as np
 import pymc as mc
 import pandas
-import networkx as nx
+
+import hierarchy_index
+import flat_model
 
 ## set number of threads to avoid overburdening cluster computers
 try:
@@ -15,8 +17,8 @@ except ImportError:
     pass
 def print_mare(vars):
     if 'p_obs' in vars:
-        are = pl.atleast_1d(pl.absolute((vars['p_obs'].value - vars['pi'].value)/vars['pi'].value))
-        print 'mare:', pl.round_(pl.median(are), 2)
+        are = np.atleast_1d(np.absolute((vars['p_obs'].value - vars['pi'].value)/vars['pi'].value))
+        print 'mare:', np.round_(np.median(are), 2)
 
 class Log:
     def info(self, msg):
@@ -29,6 +31,9 @@ logger = Log()
 
 param_types = 'i r f p pf rr smr m_with X'.split()
 
+# optimizers that use find_gradient_map, the rest are passed to mc.MAP
+gradient_methods = ['fmin_l_bfgs_b', 'fmin_tnc']
+
 def find_consistent_spline_initial_vals(vars, method, tol, verbose):
     ## generate initial value by fitting knots sequentially
     vars_to_fit = [vars['logit_C0']]
@@ -41,7 +46,7 @@ def find_consistent_spline_initial_vals(vars, method, tol, verbose):
         if verbose:
             print 'fitting first %d knots of %d' % (i, max_knots)
         vars_to_fit += [vars[t]['gamma'][:i] for t in 'irf']
-        mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+        find_map(vars, vars_to_fit, method, tol, verbose)
 
         if verbose:
             from fit_posterior import inspect_vars
@@ -50,6 +55,184 @@ def find_consistent_spline_initial_vals(vars, method, tol, verbose):
             logger.info('.')
 
 
+def find_gradient_map(vars, vars_to_fit, method='fmin_l_bfgs_b', tol=.001, verbose=False, eps=1.e-6):
+    """ Find MAP values of the stochs in vars_to_fit with a gradient-based optimizer
+
+    :Parameters:
+      - `vars` : dict, from ism.consistent
+      - `vars_to_fit` : list of PyMC nodes and lists of nodes
+      - `method` : str, one of 'fmin_l_bfgs_b' or 'fmin_tnc'
+      - `tol` : float, tolerance on the relative change in logp
+      - `verbose` : boolean
+      - `eps` : float, step size for the gradient
+
+    :Results:
+      - Returns the number of evaluations of the model logp
+
+    .. note::
+      - the logp is evaluated by flat_model.flatten(vars_to_fit), which
+        computes the priors of the scalar stochs in vectorized form
+      - the gradient is found by forward differences, with the ODE
+        linearized at x (see ism.linearize_ode), so that the stochs
+        that feed the ODE each take one directional derivative of its
+        tape instead of an integration, and the other stochs only
+        recompute the nodes downstream of them
+      - outside the support of the model, L-BFGS-B would take a zero
+        gradient for a stationary point, so the objective there is a
+        finite penalty that grows with the distance from the last point
+        inside the support, with a gradient pointing back toward it
+
+    """
+    import scipy.optimize
+    import ism
+
+    flat = flat_model.flatten(vars_to_fit, transform=False)
+    bounds = flat['bounds']
+    x0 = flat['x0']
+    if len(x0) == 0:
+        return 0
+
+    evals = [0]
+    set_values = flat['set_values']
+    def neg_logp(x):
+        evals[0] += 1
+        return -flat['logp'](x)
+
+    # the last point inside the support of the model
+    feasible = dict(x=x0.copy(), f=neg_logp(x0))
+    if np.isinf(feasible['f']):
+        raise mc.ZeroProbability, 'initial values of %s have zero probability' % ', '.join([s.__name__ for s in flat['stochs']])
+    penalty = 1.e10
+
+    def neg_logp_and_grad(x):
+        f0 = neg_logp(x)
+        if np.isinf(f0):
+            d = x - feasible['x']
+            return feasible['f'] + penalty * (1. + np.dot(d, d)), 2. * penalty * d
+        feasible['x'] = x.copy()
+        feasible['f'] = f0
+
+        g = np.zeros(len(x))
+        ism.linearize_ode(vars)
+        try:
+            for k in range(len(x)):
+                step = eps
+                if bounds[k][1] != None and x[k] + eps > bounds[k][1]:
+                    step = -eps
+                x_k = x.copy()
+                x_k[k] += step
+                f_k = neg_logp(x_k)
+                if np.isinf(f_k):
+                    # difference in the other direction, toward the inside of the support
+                    step = -step
+                    x_k[k] = x[k] + step
+                    f_k = neg_logp(x_k)
+                g[k] = (f_k - f0) / step
+        finally:
+            ism.linearize_ode(vars, False)
+            set_values(x)
+        return f0, g
+
+    if method == 'fmin_l_bfgs_b':
+        x, f, info = scipy.optimize.fmin_l_bfgs_b(neg_logp_and_grad, x0, bounds=bounds,
+                                                  factr=tol/np.finfo(float).eps, iprint=(verbose and 1 or -1))
+    elif method == 'fmin_tnc':
+        x, nfeval, rc = scipy.optimize.fmin_tnc(neg_logp_and_grad, x0, bounds=bounds,
+                                                ftol=tol, messages=(verbose and 15 or 0))
+    else:
+        raise ValueError, 'Unrecognized gradient method: %s' % method
+    set_values(x)
+
+    if verbose:
+        print '%s: %d logp evaluations' % (method, evals[0])
+    return evals[0]
+
+def find_data_initial_vals(vars):
+    """ Start the age pattern at the level of the data: set each knot of
+    gamma to the log of the median of the data whose age intervals
+    are nearest to the knot
+
+    :Parameters:
+      - `vars` : dict, from ism.age_specific_rate, or one rate type of ism.consistent
+
+    .. note::
+      - models with an empirical prior (parent_similarity) already start
+        at the prior age pattern, and are left unchanged
+
+    """
+    data = vars.get('data')
+    if 'gamma' not in vars or 'parent_similarity' in vars or data is None or len(data.index) == 0:
+        return
+
+    value = np.array(data['value'], dtype=float)
+    age_mid = .5 * (np.array(data['age_start'], dtype=float) + np.array(data['age_end'], dtype=float))
+    ok = (value > 0) & ~np.isnan(value)
+    if not np.any(ok):
+        return
+    value = value[ok]
+    age_mid = age_mid[ok]
+
+    # each datum counts toward the knots on either side of its midpoint, and knots without data take the overall median
+    knots = np.array(vars['knots'], dtype=float)
+    edges = np.hstack([-np.inf, .5*(knots[1:] + knots[:-1]), np.inf])
+    nearest = np.searchsorted(edges, age_mid) - 1
+    overall = np.median(value)
+    for k, gamma_k in enumerate(vars['gamma']):
+        if not isinstance(gamma_k, mc.Stochastic):
+            continue
+        near = value[(nearest >= k-1) & (nearest <= k+1)]
+        level = len(near) > 0 and np.median(near) or overall
+        gamma_k.value = np.log(level).clip(-12, 6)
+
+def find_joint_map(vars, method='fmin_l_bfgs_b', tol=.001, verbose=False):
+    """ Find MAP values of all stochs in vars jointly, starting from
+    data-driven initial values, in two gradient-based optimizations:
+    first the age pattern knots with the effects held at their
+    initial values, then every stoch at once
+
+    :Parameters:
+      - `vars` : dict, from ism.age_specific_rate (one rate type) or ism.consistent
+      - `method` : str, one of 'fmin_l_bfgs_b' or 'fmin_tnc'
+      - `tol` : float, tolerance on the relative change in logp
+      - `verbose` : boolean
+
+    :Results:
+      - Returns the number of evaluations of the model logp
+
+    .. note::
+      - this replaces the nested passes of find_asr_initial_vals,
+        which run a derivative-free optimization for each added knot
+        and for each parent node in the area hierarchy
+
+    """
+    if 'gamma' in vars:
+        types = [vars]
+    else:
+        types = [vars[t] for t in param_types if t in vars]
+
+    for vars_t in types:
+        find_data_initial_vals(vars_t)
+
+    vars_to_fit = [vars.get('logit_C0')]
+    for vars_t in types:
+        vars_to_fit += [vars_t.get('p_obs'), vars_t.get('pi_sim'), vars_t.get('smooth_gamma'), vars_t.get('parent_similarity'),
+                        vars_t.get('mu_sim'), vars_t.get('mu_age_derivative_potential'), vars_t.get('covariate_constraint'),
+                        vars_t.get('gamma')]
+    evals = find_gradient_map(vars, vars_to_fit, method, tol, verbose)
+    evals += find_gradient_map(vars, vars, method, tol, verbose)
+    return evals
+
+def find_map(vars, vars_to_fit, method, tol, verbose, map=None):
+    """ Find MAP values of the stochs in vars_to_fit, with find_gradient_map
+    for the gradient-based methods 'fmin_l_bfgs_b' and 'fmin_tnc', and
+    with mc.MAP (or map, if it is given) for the rest"""
+    if method in gradient_methods:
+        find_gradient_map(vars, vars_to_fit, method, tol, verbose)
+    else:
+        if map is None:
+            map = mc.MAP(vars_to_fit)
+        map.fit(method=method, tol=tol, verbose=verbose)
+
 def find_asr_initial_vals(vars, method, tol, verbose):
     for outer_reps in range(3):
         find_spline_initial_vals(vars, method, tol, verbose)
@@ -69,7 +252,7 @@ def find_spline_initial_vals(vars, method, tol, verbose):
         if verbose:
             print 'fitting first %d knots of %d' % (i+1, len(vars['gamma']))
         vars_to_fit.append(n)
-        mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+        find_map(vars, vars_to_fit, method, tol, verbose)
         if verbose:
             print_mare(vars)
 
@@ -78,10 +261,11 @@ def find_re_initial_vals(vars, method, tol, verbose):
         return
 
     col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
+    index = hierarchy_index.build(vars['hierarchy'])
 
     for reps in range(3):
-        for p in nx.traversal.bfs_tree(vars['hierarchy'], 'all'):
-            successors = vars['hierarchy'].successors(p)
+        for p in hierarchy_index.breadth_first(index):
+            successors = [index['nodes'][c] for c in index['children'][index['id'][p]]]
             if successors:
                 #print successors
 
@@ -92,17 +276,17 @@ def find_re_initial_vals(vars, method, tol, verbose):
                 re_vars = [vars['alpha'][col_map[n]] for n in successors + [p] if n in vars['U']]
                 vars_to_fit += re_vars
                 if len(re_vars) > 0:
-                    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+                    find_map(vars, vars_to_fit, method, tol, verbose)
 
-                #print pl.round_([re.value for re in re_vars if isinstance(re, mc.Node)], 2)
+                #print np.round_([re.value for re in re_vars if isinstance(re, mc.Node)], 2)
                 #print_mare(vars)
 
     #print 'sigma_alpha'
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('sigma_alpha')]
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
-    #print pl.round_([s.value for s in vars['sigma_alpha']])
+    find_map(vars, vars_to_fit, method, tol, verbose)
+    #print np.round_([s.value for s in vars['sigma_alpha']])
     #print_mare(vars)
 
 
@@ -110,14 +294,14 @@ def find_fe_initial_vals(vars, method, tol, verbose):
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('beta')]  # include fixed effects in sequential fit
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+    find_map(vars, vars_to_fit, method, tol, verbose)
     #print_mare(vars)
 
 def find_dispersion_initial_vals(vars, method, tol, verbose):
     vars_to_fit = [vars.get('p_obs'), vars.get('pi_sim'), vars.get('smooth_gamma'), vars.get('parent_similarity'),
                    vars.get('mu_sim'), vars.get('mu_age_derivative_potential'), vars.get('covariate_constraint')]
     vars_to_fit += [vars.get('eta'), vars.get('zeta')]
-    mc.MAP(vars_to_fit).fit(method=method, tol=tol, verbose=verbose)
+    find_map(vars, vars_to_fit, method, tol, verbose)
     #print_mare(vars)
 
 
@@ -128,13 +312,15 @@ def setup_asr_step_methods(m, vars, additional_stochs=[]):
     ap_group = [n for n in vars.get('gamma', []) if isinstance(n, mc.Stochastic)]
     groups += [[g_i, g_j] for g_i, g_j in zip(ap_group[1:], ap_group[:-1])] + [fe_group, ap_group, fe_group+ap_group]
 
+    if 'hierarchy' in vars:
+        index = hierarchy_index.build(vars['hierarchy'])
+        col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
+
     for a in vars.get('hierarchy', []):
         group = []
 
-        col_map = dict([[key, i] for i,key in enumerate(vars['U'].columns)])
-        
         if a in vars['U']:
-            for b in nx.shortest_path(vars['hierarchy'], 'all', a):
+            for b in hierarchy_index.path(index, a):
                 if b in vars['U']:
                     n = vars['alpha'][col_map[b]]
                     if isinstance(n, mc.Stochastic):
@@ -147,7 +333,7 @@ def setup_asr_step_methods(m, vars, additional_stochs=[]):
             #groups.append(group)
                     
     for stoch in groups:
-        if len(stoch) > 0 and pl.all([isinstance(n, mc.Stochastic) for n in stoch]):
+        if len(stoch) > 0 and np.all([isinstance(n, mc.Stochastic) for n in stoch]):
             # only step certain stochastics, for understanding convergence
             #if 'gamma_i' not in stoch[0].__name__:
             #    print 'no stepper for', stoch
@@ -165,10 +351,10 @@ def setup_asr_step_methods(m, vars, additional_stochs=[]):
                 raise ValueError
                 na = mc.NormApprox(vars_to_fit + stoch)
                 na.fit(method='fmin_powell', verbose=0)
-                cov = pl.array(pl.inv(-na.hess), order='F')
-                #print 'opt:', pl.round_([n.value for n in stoch], 2)
+                cov = np.array(np.linalg.inv(-na.hess), order='F')
+                #print 'opt:', np.round_([n.value for n in stoch], 2)
                 #print 'cov:\n', cov.round(4)
-                if pl.all(pl.eigvals(cov) >= 0):
+                if np.all(np.linalg.eigvals(cov) >= 0):
                     m.use_step_method(mc.AdaptiveMetropolis, stoch, cov=cov)
                 else:
                     raise ValueError
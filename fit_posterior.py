@@ -10,24 +10,35 @@ import sys
 
 import pylab as pl
 import pymc as mc
-import networkx as nx
 import pandas
+import simplejson as json
 
+import data
 import ism
 import covariate_model
+import rate_model
+import derived_quantities
 import fit_model
+import fit_cache
+import hierarchy_index
+import trace_db
 import graphics
 
-reload(covariate_model)
-reload(ism)
-reload(fit_model)
-
 import dismod3
 
+if dismod3.settings.RELOAD_MODULES:
+    reload(data)
+    reload(covariate_model)
+    reload(ism)
+    reload(fit_model)
+
 iter=50000
 burn=10000
 thin=40
 
+# names of the rate types in the keys of a DiseaseJson
+param_type = dict(i='incidence', p='prevalence', r='remission', f='excess-mortality', rr='relative-risk', pf='prevalence_x_excess-mortality', m_with='mortality')
+
 def inspect_vars(results, vars):
     for k in vars:
         if isinstance(vars[k], mc.Node):
@@ -55,7 +66,7 @@ def inspect_node(n):
 
 def fit_posterior(dm, region, sex, year, fast_fit=False, 
                   inconsistent_fit=False, params_to_fit=['p', 'r', 'i'], zero_re=True,
-                  posteriors_only=False):
+                  posteriors_only=False, use_cache=True):
     """ Fit posterior of specified region/sex/year for specified model
 
     Parameters
@@ -72,6 +83,8 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
 
     zero_re : bool, if true, enforce constraint that sibling area REs sum to zero
     posteriors_only : bool, if tru use data from 1997-2007 for 2005 and from 2007 on for 2010
+    use_cache : bool, if true, restore the results from dir/cache instead of fitting when
+      the data, priors, parameters, and settings are unchanged since an earlier fit
 
     Example
     -------
@@ -80,134 +93,33 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
     """
     dir = dismod3.settings.JOB_WORKING_DIR % dm.id
 
-    ## load the model from disk or from web
-    import simplejson as json
-    import data
-    reload(data)
-
-    try:
-        model = data.ModelData.load(dir)
-        print 'loaded data from new format from %s' % dir
-    except (IOError, AssertionError):
-        model = data.ModelData.from_gbd_jsons(json.loads(dm.to_json()))
-        #model.save(dir)
-        print 'loaded data from json, saved in new format for next time in %s' % dir
-
-    # TODO: check for missing covariates, and have them fixed, instead of filling them with zeros
-
-    ## next block fills in missing covariates with zero
-    for col in model.input_data.columns:
-        if col.startswith('x_'):
-            model.input_data[col] = model.input_data[col].fillna(0.)
-    # also fill all covariates missing in output template with zeros
-    model.output_template = model.output_template.fillna(0)
-
     predict_area = dismod3.utils.clean(region)
     predict_sex = dismod3.utils.clean(sex)
     predict_year = int(year)
 
-    ## load emp_priors dict from dm.params
-    param_type = dict(i='incidence', p='prevalence', r='remission', f='excess-mortality', rr='relative-risk', pf='prevalence_x_excess-mortality', m_with='mortality')
-    emp_priors = {}
-    for t in 'i r p f'.split():
-
-        # uncomment below to not use empirical prior for rate with zero data
-        # if pl.all(model.input_data['data_type'] != t):
-        #     continue
-
-        #key = dismod3.utils.gbd_key_for(param_type[t], model.hierarchy.predecessors(predict_area)[0], year, sex)
-        key = dismod3.utils.gbd_key_for(param_type[t], predict_area, year, sex)
-        mu = dm.get_mcmc('emp_prior_mean', key)
-        #mu = dm.get_mcmc('emp_prior_median', key)
-        sigma = dm.get_mcmc('emp_prior_std', key)
-        
-        if len(mu) == 101 and len(sigma) == 101:
-            emp_priors[t, 'mu'] = mu
-
-            # TODO: determine best way to propagate prior on function
-            emp_priors[t, 'sigma'] = sigma
-            
-            # ALT 1: scale so that the joint probability is not a
-            # function of the length of the age function
-            # emp_priors[t, 'sigma'] = sigma * pl.sqrt(len(sigma))
-
-        ## update model.parameters['random_effects'] if there is information in the disease model
-        expert_priors = model.parameters[t].get('random_effects', {})
-        model.parameters[t]['random_effects'] = dm.get_empirical_prior(param_type[t]).get('new_alpha', {})
-        model.parameters[t]['random_effects'].update(expert_priors)
-
-        # shift random effects to make REs for observed children of predict area have mean zero
-        re_mean = pl.mean([model.parameters[t]['random_effects'][area]['mu'] \
-                           for area in model.hierarchy.neighbors(predict_area) \
-                           if area in model.parameters[t]['random_effects']])
-        for area in model.hierarchy.neighbors(predict_area):
-            if area in model.parameters[t]['random_effects']:
-                model.parameters[t]['random_effects'][area]['mu'] -= re_mean
-            
-
-        ## update model.parameters['fixed_effects'] if there is information in the disease model
-        expert_fe_priors = model.parameters[t].get('fixed_effects', {})
-        model.parameters[t]['fixed_effects'].update(dm.get_empirical_prior(param_type[t]).get('new_beta', {}))
-
-
-    ## create model and priors for region/sex/year
-    # select data that is about areas in this region, recent years, and sex of male or total only
-    assert predict_area in model.hierarchy, 'region %s not found in area hierarchy' % predict_area
-    subtree = nx.traversal.bfs_tree(model.hierarchy, predict_area)
-
-    def is_relevant(r):
-        if (r['area'] not in subtree) and r['area'] != 'all':
-            return False
-
-
-        if predict_year == 1990:
-            if r['year_start'] > 1997:
-                return False
-        elif predict_year == 2005:
-            if posteriors_only:
-                if r['year_end'] < 1997 or r['year_start'] > 2007:
-                    return False
-            else:
-                if r['year_end'] < 1997:
-                    return False
-        elif predict_year == 2010:
-            if posteriors_only:
-                if r['data_type'] == 'm_all':
-                    # include m_all data from 2005, since 2010 is not loaded
-                    if r['year_end'] < 1997:
-                        return False
-                else:
-                    if r['year_end'] < 2007:
-                        return False
-            else:
-                if r['year_end'] < 1997:
-                    return False
-        else:
-            assert 0, 'Predictions for year %d not yet implemented' % predict_year
-
-        if r['sex'] not in [predict_sex, 'total']:
-            return False
-
-        return True
-    
-    old_relevant_rows = [i for i, r in model.input_data.T.iteritems() \
-                         if (r['area'] in subtree or r['area'] == 'all')\
-                         and ((predict_year >= 1997 and r['year_end'] >= 1997) or
-                              (predict_year <= 1997 and r['year_start'] <= 1997)) \
-                         and r['sex'] in [predict_sex, 'total']]
-
-    relevant_rows = model.input_data.index[model.input_data.apply(is_relevant, axis=1)]
-
-    if predict_year == 1990:
-        assert pl.all(relevant_rows == old_relevant_rows), "relevant rows should be the same in new and old implementation for 1990"
-
-    if not posteriors_only:
-        assert pl.all(relevant_rows == old_relevant_rows), "relevant rows should be the same in new and old implementation when posteriors_only is False"
-    
-    model.input_data = model.input_data.ix[relevant_rows]
-
-    # replace area 'all' with predict_area
-    model.input_data['area'][model.input_data['area'] == 'all'] = predict_area
+    ## load the data and priors prepared for this region/sex/year by prepare_all, or prepare them now
+    try:
+        model, emp_priors = load_prepared(prepared_dir(dir, predict_area, predict_sex, predict_year), posteriors_only,
+                                          prepared_key(dm, predict_area, predict_sex, predict_year))
+        print 'loaded prepared data and priors from %s' % prepared_dir(dir, predict_area, predict_sex, predict_year)
+    except (IOError, OSError, ValueError, KeyError, AssertionError):
+        model = load_model(dm)
+        model, emp_priors = prepare_model(dm, model, predict_area, predict_sex, predict_year, posteriors_only)
+    subtree = hierarchy_index.build(model.hierarchy, predict_area)
+    subtree_edges = [(subtree['nodes'][p], n) for n, p in zip(subtree['nodes'][1:], subtree['parent'][1:])]
+
+    # key the results by everything that goes into the fit, and skip the fit if they are already cached
+    cache_key = fit_cache.input_hash(model.input_data, emp_priors, model.parameters,
+                                     sorted(subtree_edges),
+                                     model.output_template[hierarchy_index.ids(subtree, model.output_template['area']) >= 0],
+                                     dict(region=predict_area, sex=predict_sex, year=predict_year,
+                                          fast_fit=fast_fit, inconsistent_fit=inconsistent_fit,
+                                          params_to_fit=inconsistent_fit and params_to_fit or [],
+                                          zero_re=zero_re, posteriors_only=posteriors_only,
+                                          iter=iter, burn=burn, thin=thin))
+    if use_cache and fit_cache.restore(dir, cache_key):
+        print 'inputs unchanged, restored results from %s' % fit_cache.cache_dir(dir, cache_key)
+        return dm
 
     if inconsistent_fit:
         # generate fits for requested parameters inconsistently
@@ -222,7 +134,10 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
             if fast_fit:
                 dismod3.fit.fit_asr(model, t, iter=101, burn=0, thin=1, tune_interval=100)
             else:
-                dismod3.fit.fit_asr(model, t, iter=iter, burn=burn, thin=thin, tune_interval=100)
+                # keep the draws on disk, and only of the stochs and the outputs used below
+                trace_db.tally_only(model.vars[t])
+                db = trace_db.Database(dir + '/traces/%s-%s+%s+%s' % (t, predict_area, predict_sex, predict_year), float32=True)
+                dismod3.fit.fit_asr(model, t, iter=iter, burn=burn, thin=thin, tune_interval=100, db=db)
 
     else:
         model.vars += ism.consistent(model,
@@ -233,9 +148,19 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
         if fast_fit:
             dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, 105, 0, 1, 100)
         else:
-            dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=iter, burn=burn, thin=thin, tune_interval=100, verbose=True)
+            # keep the draws on disk, and only of the stochs and the outputs used below
+            trace_db.tally_only(model.vars)
+            db = trace_db.Database(dir + '/traces/%s+%s+%s' % (predict_area, predict_sex, predict_year), float32=True)
+            dm.map, dm.mcmc = dismod3.fit.fit_consistent(model, iter=iter, burn=burn, thin=thin, tune_interval=100, verbose=True, db=db)
 
 
+    # recompute derived age patterns from the traces of p, r, and f in one batch
+    if 'X' in model.vars:
+        for t, trace in derived_quantities.from_traces(model.vars).items():
+            if t in ['rr', 'smr', 'm_with', 'X'] \
+                   and not [s for s in ['pf', 'm', t] if 'unconstrained_mu_age' in model.vars[s]]:
+                model.vars[t]['mu_age_trace'] = trace
+
     # generate estimates
     posteriors = {}
     for t in 'i r f p rr pf m_with X'.split():
@@ -272,9 +197,9 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
             continue
         print 'saving tables for', t
         if 'data' in dm.vars[t] and 'p_pred' in dm.vars[t]:
-            stats = dm.vars[t]['p_pred'].stats(batches=5)
-            dm.vars[t]['data']['mu_pred'] = stats['mean']
-            dm.vars[t]['data']['sigma_pred'] = stats['standard deviation']
+            p_pred = rate_model.predict(dm.vars[t]['p_pred'])
+            dm.vars[t]['data']['mu_pred'] = p_pred.mean(axis=0)
+            dm.vars[t]['data']['sigma_pred'] = p_pred.std(axis=0)
 
             stats = dm.vars[t]['pi'].stats(batches=5)
             dm.vars[t]['data']['mc_error'] = stats['mc error']
@@ -407,6 +332,12 @@ def fit_posterior(dm, region, sex, year, fast_fit=False,
     except IOError, e:
         print 'WARNING: could not save file'
         print e
+
+    try:
+        fit_cache.store(dir, cache_key, fit_cache.output_files(dir, dm.id, predict_area, predict_sex, predict_year))
+    except (IOError, OSError), e:
+        print 'WARNING: could not cache results'
+        print e
         
     return dm
 
@@ -440,26 +371,23 @@ def save_country_level_posterior(dm, model, vars, region, sex, year, rate_type_l
                  'prevalence_x_excess-mortality': 'pf', 'duration': 'X'}[rate_type]
 
             if t in vars:
-
-                # loop over countries and rate_types
-                for a in nx.traversal.bfs_tree(model.hierarchy, region):
-                    if len(model.hierarchy.successors(a)) != 0:
-                        continue # only store hierarchy leaves
-                    if t in model.parameters and 'level_bounds' in model.parameters[t]:
-                        lower=model.parameters[t]['level_bounds']['lower']
-                        upper=model.parameters[t]['level_bounds']['upper']
-                    else:
-                        lower=0
-                        upper=pl.inf
-
-                    posterior = covariate_model.predict_for(model,
-                                                            model.parameters[t],
-                                                            region, sex, year,
-                                                            a, sex, year,
-                                                            True,  # population weighted averages
-                                                            vars[t],
-                                                            lower, upper)
-
+                if t in model.parameters and 'level_bounds' in model.parameters[t]:
+                    lower=model.parameters[t]['level_bounds']['lower']
+                    upper=model.parameters[t]['level_bounds']['upper']
+                else:
+                    lower=0
+                    upper=pl.inf
+
+                # predict for all countries at once
+                prediction = covariate_model.predict_for_leaves(model,
+                                                                model.parameters[t],
+                                                                region, sex, year,
+                                                                region, sex, year,
+                                                                vars[t],
+                                                                lower, upper)
+
+                # loop over countries (only hierarchy leaves are stored)
+                for a, posterior in zip(prediction['leaves'], prediction['draws']):
                     # write a row
                     pop = dismod3.neg_binom_model.population_by_age[(a, str(year), sex)]
                     ages = model.parameters['ages']
@@ -471,6 +399,253 @@ def save_country_level_posterior(dm, model, vars, region, sex, year, rate_type_l
         except IOError, e:
             print 'WARNING: could not save country level output for %s' % rate_type
             print e
+def load_model(dm):
+    """ Load the data of a disease model, with missing covariates filled with zeros
+
+    Parameters
+    ----------
+    dm : DiseaseJson
+
+    Results
+    -------
+    Returns data.ModelData
+    """
+    dir = dismod3.settings.JOB_WORKING_DIR % dm.id
+
+    ## load the model from disk or from web
+    try:
+        model = data.ModelData.load(dir)
+        print 'loaded data from new format from %s' % dir
+    except (IOError, AssertionError):
+        model = data.ModelData.from_gbd_jsons(json.loads(dm.to_json()))
+        #model.save(dir)
+        print 'loaded data from json, saved in new format for next time in %s' % dir
+
+    # TODO: check for missing covariates, and have them fixed, instead of filling them with zeros
+
+    ## next block fills in missing covariates with zero
+    for col in model.input_data.columns:
+        if col.startswith('x_'):
+            model.input_data[col] = model.input_data[col].fillna(0.)
+    # also fill all covariates missing in output template with zeros
+    model.output_template = model.output_template.fillna(0)
+
+    return model
+
+def relevant_rows(input_data, subtree, predict_sex, predict_year, posteriors_only=False):
+    """ Select the rows of input data about areas in a subtree, recent years, and sex of predict_sex or total
+
+    Parameters
+    ----------
+    input_data : pandas.DataFrame
+    subtree : dict, hierarchy_index.build(model.hierarchy, predict_area), the areas in the region being predicted
+    predict_sex : str
+    predict_year : int, one of 1990, 2005, 2010
+    posteriors_only : bool, if true use data from 1997-2007 for 2005 and from 2007 on for 2010
+
+    Results
+    -------
+    Returns index of the relevant rows
+    """
+    year_start = pl.array(input_data['year_start'], dtype=float)
+    year_end = pl.array(input_data['year_end'], dtype=float)
+
+    relevant = (hierarchy_index.ids(subtree, input_data['area']) >= 0) | pl.array(input_data['area'] == 'all', dtype=bool)
+
+    if predict_year == 1990:
+        relevant &= (year_start <= 1997)
+    elif predict_year == 2005:
+        if posteriors_only:
+            relevant &= (year_end >= 1997) & (year_start <= 2007)
+        else:
+            relevant &= (year_end >= 1997)
+    elif predict_year == 2010:
+        if posteriors_only:
+            # include m_all data from 2005, since 2010 is not loaded
+            m_all = pl.array(input_data['data_type'] == 'm_all', dtype=bool)
+            relevant &= pl.where(m_all, year_end >= 1997, year_end >= 2007)
+        else:
+            relevant &= (year_end >= 1997)
+    else:
+        assert 0, 'Predictions for year %d not yet implemented' % predict_year
+
+    relevant &= pl.array([s in [predict_sex, 'total'] for s in input_data['sex']], dtype=bool)
+
+    return input_data.index[relevant]
+
+def prepare_model(dm, model, predict_area, predict_sex, predict_year, posteriors_only=False):
+    """ Select the data and set the priors for the posterior of one region/sex/year
+
+    Parameters
+    ----------
+    dm : DiseaseJson, with empirical priors
+    model : data.ModelData, from load_model(); it is not changed
+    predict_area, predict_sex : str, cleaned region and sex
+    predict_year : int
+    posteriors_only : bool, if true use data from 1997-2007 for 2005 and from 2007 on for 2010
+
+    Results
+    -------
+    Returns (prepared, emp_priors), where prepared is a data.ModelData with
+    the relevant rows of input data and parameters updated with the
+    random and fixed effects of the empirical priors, and emp_priors is a
+    dict of empirical prior age patterns keyed by (type, 'mu') and (type, 'sigma')
+    """
+    import copy
+    parameters = copy.deepcopy(model.parameters)
+
+    ## load emp_priors dict from dm.params
+    emp_priors = {}
+    for t in 'i r p f'.split():
+
+        # uncomment below to not use empirical prior for rate with zero data
+        # if pl.all(model.input_data['data_type'] != t):
+        #     continue
+
+        #key = dismod3.utils.gbd_key_for(param_type[t], model.hierarchy.predecessors(predict_area)[0], year, sex)
+        key = dismod3.utils.gbd_key_for(param_type[t], predict_area, str(predict_year), predict_sex)
+        mu = dm.get_mcmc('emp_prior_mean', key)
+        #mu = dm.get_mcmc('emp_prior_median', key)
+        sigma = dm.get_mcmc('emp_prior_std', key)
+        
+        if len(mu) == 101 and len(sigma) == 101:
+            emp_priors[t, 'mu'] = mu
+
+            # TODO: determine best way to propagate prior on function
+            emp_priors[t, 'sigma'] = sigma
+            
+            # ALT 1: scale so that the joint probability is not a
+            # function of the length of the age function
+            # emp_priors[t, 'sigma'] = sigma * pl.sqrt(len(sigma))
+
+        ## update parameters['random_effects'] if there is information in the disease model
+        expert_priors = parameters[t].get('random_effects', {})
+        parameters[t]['random_effects'] = dm.get_empirical_prior(param_type[t]).get('new_alpha', {})
+        parameters[t]['random_effects'].update(expert_priors)
+
+        # shift random effects to make REs for observed children of predict area have mean zero
+        re_mean = pl.mean([parameters[t]['random_effects'][area]['mu'] \
+                           for area in model.hierarchy.neighbors(predict_area) \
+                           if area in parameters[t]['random_effects']])
+        for area in model.hierarchy.neighbors(predict_area):
+            if area in parameters[t]['random_effects']:
+                parameters[t]['random_effects'][area]['mu'] -= re_mean
+            
+
+        ## update parameters['fixed_effects'] if there is information in the disease model
+        expert_fe_priors = parameters[t].get('fixed_effects', {})
+        parameters[t]['fixed_effects'].update(dm.get_empirical_prior(param_type[t]).get('new_beta', {}))
+
+
+    ## create model and priors for region/sex/year
+    # select data that is about areas in this region, recent years, and sex of male or total only
+    assert predict_area in model.hierarchy, 'region %s not found in area hierarchy' % predict_area
+    subtree = hierarchy_index.build(model.hierarchy, predict_area)
+
+    prepared = data.ModelData()
+    prepared.input_data = model.input_data.ix[relevant_rows(model.input_data, subtree, predict_sex, predict_year, posteriors_only)]
+
+    # replace area 'all' with predict_area
+    prepared.input_data['area'][prepared.input_data['area'] == 'all'] = predict_area
+
+    prepared.output_template = model.output_template
+    prepared.parameters = parameters
+    prepared.hierarchy = model.hierarchy
+    prepared.nodes_to_fit = model.nodes_to_fit
+
+    return prepared, emp_priors
+
+def prepared_dir(dir, predict_area, predict_sex, predict_year):
+    """ Directory for the prepared data and priors of a region/sex/year"""
+    return '%s/prepared/%s+%s+%s' % (dir, predict_area, predict_sex, predict_year)
+
+def prepared_key(dm, predict_area, predict_sex, predict_year):
+    """ Hash of the priors in dm that prepare_model() uses for a region/sex/year
+
+    Parameters
+    ----------
+    dm : DiseaseJson, with empirical priors
+    predict_area, predict_sex : str, cleaned region and sex
+    predict_year : int
+
+    Results
+    -------
+    Returns a hex str, from fit_cache.input_hash, of the empirical prior
+    age patterns and effects, and the expert priors that set the model
+    parameters, which changes whenever new priors are generated
+    """
+    expert_priors = dict([(k, v) for k, v in dm.params.items()
+                          if k == 'global_priors' or k.startswith('sex_effect_') or k.startswith('region_effect_')])
+    inputs = [expert_priors]
+    for t in 'i r p f'.split():
+        key = dismod3.utils.gbd_key_for(param_type[t], predict_area, str(predict_year), predict_sex)
+        inputs += [dm.get_mcmc('emp_prior_mean', key), dm.get_mcmc('emp_prior_std', key),
+                   dm.get_empirical_prior(param_type[t])]
+    return fit_cache.input_hash(*inputs)
+
+def save_prepared(model, emp_priors, path, posteriors_only=False, key=None):
+    """ Save data and priors from prepare_model() in path, in columnar format,
+    with the key of the priors they were prepared from (see prepared_key)"""
+    import os
+    if not os.path.exists(path):
+        os.makedirs(path)
+    model.save(path, human_readable=False)
+    json.dump(dict(posteriors_only=posteriors_only, key=key,
+                   emp_priors=[[t, s, list(emp_priors[t, s])] for t, s in sorted(emp_priors)]),
+              open(path + '/emp_priors.json', 'w'))
+
+def load_prepared(path, posteriors_only=False, key=None):
+    """ Load data and priors saved by save_prepared()
+
+    Results
+    -------
+    Returns (model, emp_priors), as from prepare_model(); raises IOError
+    if there are no prepared files, if they were prepared with a
+    different posteriors_only setting, or if they were prepared from
+    priors with a different key, e.g. before the empirical priors were
+    refit
+    """
+    settings = json.load(open(path + '/emp_priors.json'))
+    if settings['posteriors_only'] != posteriors_only:
+        raise IOError, 'data in %s was prepared with posteriors_only=%s' % (path, settings['posteriors_only'])
+    if settings.get('key') != key:
+        raise IOError, 'data in %s was prepared from different priors' % path
+    model = data.ModelData.load_binary(path)
+    emp_priors = dict([((str(t), str(s)), pl.array(v)) for t, s, v in settings['emp_priors']])
+    return model, emp_priors
+
+def prepare_all(id, posteriors_only=False):
+    """ Prepare the data and priors of every region/sex/year, so that
+    each posterior job loads only its own, instead of loading and
+    processing the whole model
+
+    Parameters
+    ----------
+    id : int
+      The model id number
+    posteriors_only : bool, if true use data from 1997-2007 for 2005 and from 2007 on for 2010
+    """
+    import shutil
+    import os
+    dir = dismod3.settings.JOB_WORKING_DIR % id
+
+    # remove stale preparations first, so that if this fails the posterior jobs prepare their own data
+    if os.path.exists(dir + '/prepared'):
+        shutil.rmtree(dir + '/prepared')
+
+    dm = dismod3.load_disease_model(id)
+    dm.id = id
+    model = load_model(dm)
+
+    for r in dismod3.gbd_regions:
+        for s in dismod3.gbd_sexes:
+            for y in dismod3.gbd_years:
+                predict_area, predict_sex, predict_year = dismod3.utils.clean(r), dismod3.utils.clean(s), int(y)
+                prepared, emp_priors = prepare_model(dm, model, predict_area, predict_sex, predict_year, posteriors_only)
+                save_prepared(prepared, emp_priors, prepared_dir(dir, predict_area, predict_sex, predict_year), posteriors_only,
+                              prepared_key(dm, predict_area, predict_sex, predict_year))
+                print 'prepared %d rows of data for %s+%s+%s' % (len(prepared.input_data.index), predict_area, predict_sex, predict_year)
+
 def main():
     import optparse
 
@@ -492,6 +667,10 @@ def main():
                       help='enforce zero constraint on random effects')
     parser.add_option('-o', '--onlyposterior', default='False',
                       help='skip empirical prior phase')
+    parser.add_option('-c', '--cache', default='true',
+                      help='reuse cached results if the inputs of the fit are unchanged')
+    parser.add_option('-p', '--prepare', default='false',
+                      help='prepare data and priors for all regions/sexes/years, instead of fitting one')
     
     (options, args) = parser.parse_args()
 
@@ -503,6 +682,9 @@ def main():
     except ValueError:
         parser.error('disease_model_id must be an integer')
 
+    if options.prepare.lower() == 'true':
+        prepare_all(id, posteriors_only=(options.onlyposterior.lower()=='true'))
+        return
 
     dm = dismod3.load_disease_model(id)
 
@@ -515,7 +697,8 @@ def main():
                        inconsistent_fit=options.inconsistent.lower() == 'true',
                        params_to_fit=options.types.split(),
                        posteriors_only=(options.onlyposterior.lower()=='true'),
-                       zero_re=options.zerore.lower() == 'true')
+                       zero_re=options.zerore.lower() == 'true',
+                       use_cache=options.cache.lower() == 'true')
     
     return dm
 
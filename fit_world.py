@@ -19,10 +19,12 @@ import networkx as nx
 import ism
 import fit
 import covariate_model
+import rate_model
 import fit_model
 import graphics
 
-reload(fit_model)
+if dismod3.settings.RELOAD_MODULES:
+    reload(fit_model)
 
 
 def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heterogeneity='Slightly'):
@@ -45,7 +47,8 @@ def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heteroge
     ## load the model from disk or from web
     import simplejson as json
     import data
-    reload(data)
+    if dismod3.settings.RELOAD_MODULES:
+        reload(data)
 
     try:
         model = data.ModelData.load(dir)
@@ -113,32 +116,9 @@ def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heteroge
     for t in 'p i r f rr pf m_with'.split():
         param_type = dict(i='incidence', r='remission', f='excess-mortality', p='prevalence', rr='relative-risk', pf='prevalence_x_excess-mortality', m_with='mortality')[t]
         #graphics.plot_one_type(model, model.vars[t], {}, t)
-        for a in [dismod3.utils.clean(a) for a in dismod3.settings.gbd_regions]:
-            print 'generating empirical prior for %s' % a
-            for s in dismod3.settings.gbd_sexes:
-                for y in dismod3.settings.gbd_years:
-                    key = dismod3.utils.gbd_key_for(param_type, a, y, s)
-                    if t in model.parameters and 'level_bounds' in model.parameters[t]:
-                        lower=model.parameters[t]['level_bounds']['lower']
-                        upper=model.parameters[t]['level_bounds']['upper']
-                    else:
-                        lower=0
-                        upper=pl.inf
-                        
-                    emp_priors = covariate_model.predict_for(model,
-                                                             model.parameters.get(t, {}),
-                                                             'all', 'total', 'all',
-                                                             a, dismod3.utils.clean(s), int(y),
-                                                             alt_prior,
-                                                             model.vars[t], lower, upper)
-                    dm.set_mcmc('emp_prior_mean', key, emp_priors.mean(0))
-                    if 'eta' in model.vars[t]:
-                        N,A = emp_priors.shape  # N samples, for A age groups
-                        delta_trace = pl.transpose([pl.exp(model.vars[t]['eta'].trace()) for _ in range(A)])  # shape delta matrix to match prediction matrix
-                        emp_prior_std = pl.sqrt(emp_priors.var(0) + (emp_priors**2 / delta_trace).mean(0))
-                    else:
-                        emp_prior_std = emp_priors.std(0)
-                    dm.set_mcmc('emp_prior_std', key, emp_prior_std)
+        from fit_emp_prior import empirical_priors, store_empirical_priors
+        priors = empirical_priors(model, t, model.vars[t], alt_prior)
+        store_empirical_priors(dm, param_type, priors)
 
 
         from fit_emp_prior import store_effect_coefficients
@@ -158,9 +138,9 @@ def fit_world(id, fast_fit=False, zero_re=True, alt_prior=False, global_heteroge
         fname = dir + '/empirical_priors/data-%s.csv'%t
         print 'saving tables for', t, 'to', fname
         if 'data' in model.vars[t] and 'p_pred' in model.vars[t]:
-            stats = model.vars[t]['p_pred'].stats(batches=5)
-            model.vars[t]['data']['mu_pred'] = stats['mean']
-            model.vars[t]['data']['sigma_pred'] = stats['standard deviation']
+            p_pred = rate_model.predict(model.vars[t]['p_pred'])
+            model.vars[t]['data']['mu_pred'] = p_pred.mean(axis=0)
+            model.vars[t]['data']['sigma_pred'] = p_pred.std(axis=0)
 
             stats = model.vars[t]['pi'].stats(batches=5)
             model.vars[t]['data']['mc_error'] = stats['mc error']
@@ -0,0 +1,245 @@
+""" Flattened log-posterior of a model, as a function of one parameter vector
+
+A model from ism.age_specific_rate or ism.consistent has hundreds of
+scalar stochs (one for each spline knot, random effect, and fixed
+effect), and evaluating mc.Model(vars).logp visits each of them, and
+its parents, in Python.  flatten() lays the free stochs out in one
+float vector x, and returns a logp(x) that computes the priors of
+all Normal, Uniform, and truncated normal stochs as a few vectorized
+array expressions, and only uses the PyMC graph for the terms that
+need the deterministic nodes: the data likelihoods, the potentials,
+and stochs of any other distribution.
+
+Values are only assigned to the stochs whose entries of x changed,
+so a finite-difference gradient, which changes one entry at a time,
+only recomputes the deterministics downstream of one stoch.
+
+With transform=True, every stoch with constant bounds (Uniform, and
+truncated normal with constant a and b) is represented in x on the
+logit scale, so that any x is inside the support of the model, which
+is convenient for unconstrained optimizers and samplers.
+
+Example
+-------
+>>> import flat_model
+>>> flat = flat_model.flatten(vars)
+>>> x = flat['x0']
+>>> flat['logp'](x) == mc.Model(vars).logp
+>>> flat['set_values'](x + .1)  # move the nodes to a new point
+"""
+
+import pylab as pl
+import pymc as mc
+
+# distributions whose log-likelihood is computed in vectorized form, and their parents
+kernels = {'normal': ['mu', 'tau'],
+           'uniform': ['lower', 'upper'],
+           'truncated_normal': ['mu', 'tau', 'a', 'b']}
+
+def stoch_kind(s):
+    """ Find which kernel computes the log-likelihood of stoch s, or
+    None if it must be computed by its logp attribute"""
+    if isinstance(s, mc.Normal):
+        return 'normal'
+    elif isinstance(s, mc.Uniform):
+        return 'uniform'
+    else:
+        # covariate_model.MyTruncatedNormal marks its stochs
+        return getattr(s, 'logp_kind', None)
+
+def _is_constant(p):
+    """ Test if a parent is a fixed value, rather than a node or container of nodes"""
+    if isinstance(p, pl.ndarray):
+        return p.dtype != object
+    return isinstance(p, (int, long, float, pl.number))
+
+def _parent_value(s, key):
+    """ Get the current value of a parent of s"""
+    p = s.parents[key]
+    if isinstance(p, mc.Node):
+        return p.value
+    elif _is_constant(p):
+        return p
+    else:
+        return s.parents.value[key]
+
+def normal_logp(x, mu, tau):
+    """ Sum of the normal log-likelihoods, equal to mc.normal_like(x, mu, tau)
+    for vectors of values and parents"""
+    if pl.any(tau <= 0):
+        return -pl.inf
+    return pl.sum(-.5 * tau * (x - mu)**2 + .5 * pl.log(.5 * tau / pl.pi))
+
+def uniform_logp(x, lower, upper):
+    """ Sum of the uniform log-likelihoods, equal to mc.uniform_like(x, lower, upper)"""
+    if pl.any(x < lower) or pl.any(x > upper):
+        return -pl.inf
+    return -pl.sum(pl.log(upper - lower))
+
+def truncated_normal_logp(x, mu, tau, a, b):
+    """ Sum of the log-likelihoods of covariate_model.MyTruncatedNormal,
+    which is the normal log-likelihood inside the bounds, without renormalization"""
+    if pl.any(x < a) or pl.any(x > b):
+        return -pl.inf
+    return normal_logp(x, mu, tau)
+
+kernel_logp = {'normal': normal_logp, 'uniform': uniform_logp, 'truncated_normal': truncated_normal_logp}
+
+def flatten(vars, transform=True):
+    """ Compile the log-posterior of a model into a function of one vector
+
+    :Parameters:
+      - `vars` : dict, or list of PyMC nodes and lists of nodes, as for mc.Model
+      - `transform` : bool, optional, represent stochs with constant bounds on the logit scale
+
+    :Results:
+      - Returns dict with
+
+        - 'stochs' : list of the free stochs, sorted by name, in the order they are laid out in x
+        - 'slices' : list of the slice of x for each stoch
+        - 'x0' : array, x for the current values of the stochs
+        - 'bounds' : list of (lower, upper) bounds on each entry of x, None for unbounded
+        - 'logp' : function of x and optional jacobian flag, the log-posterior of the
+          model at x; with jacobian=True, it includes the log-Jacobian of the
+          logit transforms, for sampling in x
+        - 'set_values' : function of x that assigns the corresponding values to the stochs
+        - 'values' : function of x, returns list of the corresponding value of each stoch
+        - 'get_x' : function that returns x for the current values of the stochs
+
+    .. note::
+      - logp(x) equals mc.Model(vars).logp after set_values(x), except that
+        it returns -inf where PyMC raises mc.ZeroProbability
+
+    """
+    model = mc.Model(vars)
+    stochs = sorted(model.stochastics, key=lambda s: s.__name__)
+
+    slices = []
+    shapes = []
+    n = 0
+    for s in stochs:
+        size = pl.size(s.value)
+        slices.append(slice(n, n+size))
+        shapes.append(pl.shape(s.value))
+        n += size
+
+    # group the entries of x by kernel, with an array for each parent;
+    # constant parents are filled in now, and node parents are
+    # listed so that they can be filled in at each evaluation
+    groups = {}
+    graph_terms = list(model.observed_stochastics) + list(model.potentials)
+    for s, ix in zip(stochs, slices):
+        kind = stoch_kind(s)
+        if kind == None:
+            graph_terms.append(s)
+            continue
+        g = groups.setdefault(kind, dict(ix=[], parents=dict([(k, []) for k in kernels[kind]]), dynamic=[]))
+        start = len(g['ix'])
+        g['ix'] += range(ix.start, ix.stop)
+        for k in kernels[kind]:
+            if _is_constant(s.parents[k]):
+                g['parents'][k] += list(pl.ones(ix.stop - ix.start) * pl.ravel(s.parents[k]))
+            else:
+                g['parents'][k] += [pl.nan] * (ix.stop - ix.start)
+                g['dynamic'].append((k, slice(start, len(g['ix'])), s))
+    for g in groups.values():
+        g['ix'] = pl.array(g['ix'], dtype=int)
+        for k in g['parents']:
+            g['parents'][k] = pl.array(g['parents'][k], dtype=float)
+
+    # bounds of each entry, and the logit transform for the entries with constant bounds
+    lower = -pl.inf * pl.ones(n)
+    upper = pl.inf * pl.ones(n)
+    for kind, lb, ub in [['uniform', 'lower', 'upper'], ['truncated_normal', 'a', 'b']]:
+        if kind in groups:
+            g = groups[kind]
+            lower[g['ix']] = g['parents'][lb]
+            upper[g['ix']] = g['parents'][ub]
+    lower[pl.isnan(lower)] = -pl.inf
+    upper[pl.isnan(upper)] = pl.inf
+    if transform:
+        logit = pl.where(pl.isfinite(lower) & pl.isfinite(upper) & (upper > lower))[0]
+    else:
+        logit = pl.array([], dtype=int)
+    width = upper[logit] - lower[logit]
+
+    def to_value(x):
+        v = pl.array(x, dtype=float)
+        if len(logit) > 0:
+            v[logit] = lower[logit] + width / (1. + pl.exp(-x[logit]))
+        return v
+
+    def to_x(v):
+        x = pl.array(v, dtype=float)
+        if len(logit) > 0:
+            # keep values on the bounds a finite distance inside them
+            q = ((v[logit] - lower[logit]) / width).clip(1.e-12, 1. - 1.e-12)
+            x[logit] = pl.log(q) - pl.log(1. - q)
+        return x
+
+    def current_values():
+        v = pl.zeros(n)
+        for s, ix in zip(stochs, slices):
+            v[ix] = pl.ravel(s.value)
+        return v
+
+    def assign(v):
+        old = current_values()
+        changed = pl.where(old != v)[0]
+        if len(changed) > 0:
+            # only reassign stochs with changed entries, so cached deterministics stay valid
+            owner = pl.searchsorted([ix.stop for ix in slices], changed, side='right')
+            for j in sorted(set(owner)):
+                s = stochs[j]
+                s.value = pl.reshape(v[slices[j]], shapes[j])
+
+    def logp(x, jacobian=False):
+        v = to_value(x)
+        assign(v)
+
+        total = 0.
+        for kind, g in groups.items():
+            parents = g['parents']
+            if g['dynamic']:
+                parents = dict([(k, p.copy()) for k, p in parents.items()])
+                for k, ix, s in g['dynamic']:
+                    parents[k][ix] = pl.ravel(_parent_value(s, k))
+            total += kernel_logp[kind](v[g['ix']], *[parents[k] for k in kernels[kind]])
+            if total == -pl.inf:
+                return -pl.inf
+
+        try:
+            for term in graph_terms:
+                total += term.logp
+        except mc.ZeroProbability:
+            return -pl.inf
+
+        if jacobian and len(logit) > 0:
+            # log of d value / d x = width * q * (1-q), for q = invlogit(x)
+            total += pl.sum(pl.log(width) - pl.log1p(pl.exp(-x[logit])) - pl.log1p(pl.exp(x[logit])))
+        return total
+
+    def set_values(x):
+        assign(to_value(x))
+
+    def values(x):
+        v = to_value(x)
+        return [pl.reshape(v[ix], shape) for ix, shape in zip(slices, shapes)]
+
+    def get_x():
+        return to_x(current_values())
+
+    # logit-transformed entries are unbounded in x
+    bounds = []
+    is_logit = pl.zeros(n, dtype=bool)
+    is_logit[logit] = True
+    for k in range(n):
+        lb, ub = None, None
+        if pl.isfinite(lower[k]) and not is_logit[k]:
+            lb = lower[k]
+        if pl.isfinite(upper[k]) and not is_logit[k]:
+            ub = upper[k]
+        bounds.append((lb, ub))
+
+    return dict(stochs=stochs, slices=slices, x0=get_x(), bounds=bounds,
+                logp=logp, set_values=set_values, values=values, get_x=get_x)
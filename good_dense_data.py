@@ -186,7 +186,8 @@ def generate_disease_data(condition, cov):
     f_file.close()
 
     # upload data file
-    from dismod3.disease_json import dismod_server_login, twc, DISMOD_BASE_URL
+    import twill.commands as twc
+    from dismod3.disease_json import dismod_server_login, DISMOD_BASE_URL
     dismod_server_login()
     twc.go(DISMOD_BASE_URL + 'dismod/data/upload/')
     twc.formvalue(1, 'tab_separated_values', open(f_name).read())
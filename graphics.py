@@ -5,6 +5,8 @@ import pymc as mc
 import pandas
 import networkx as nx
 
+import diagnostics
+import rate_model
 from pand3 import scatter
 colors = ['#e41a1c', '#377eb8', '#4daf4a', '#984ea3', '#ff7f0', '#ffff33']
 
@@ -162,17 +164,19 @@ def plot_one_ppc(model, t):
       - `t` : str, data type of 'i', 'r', 'f', 'p', 'rr', 'm', 'X', 'pf', 'csmr'
     
     """
-    stats = model.vars[t]['p_pred'].stats()
-    if stats == None:
+    p_pred = pl.sort(rate_model.predict(model.vars[t]['p_pred']), axis=0)
+    n = len(p_pred)
+    if n == 0:
         return
 
     pl.figure()
     pl.title(t)
 
     x = model.vars[t]['p_obs'].value.__array__()
-    y = x - stats['quantiles'][50]
-    yerr = [stats['quantiles'][50] - pl.atleast_2d(stats['95% HPD interval'])[:,0],
-            pl.atleast_2d(stats['95% HPD interval'])[:,1] - stats['quantiles'][50]]
+    median = p_pred[n/2]
+    y = x - median
+    yerr = [median - p_pred[int(.025*n)],
+            p_pred[int(.975*n)-1] - median]
     pl.errorbar(x, y, yerr=yerr, fmt='ko', mec='w', capsize=0,
                 label='Obs vs Residual (Obs - Pred)')
 
@@ -289,7 +293,7 @@ def plot_hists(vars):
       - `vars` : data.ModelData.vars
 
     """
-    def hist(trace):
+    def hist(trace, key):
         pl.hist(trace, histtype='stepfilled', normed=True)
         pl.yticks([])
         ticks, labels = pl.xticks()
@@ -300,9 +304,19 @@ def plot_hists(vars):
 
 
 def plot_acorr(model):
-    def acorr(trace):
+    # compute the autocorrelation of every dimension of every stoch at once,
+    # keyed by (stoch name, dim)
+    cells, stochs = tally_stochs(model.vars)
+    acorr_for = {}
+    if stochs:
+        traces, names, dims = diagnostics.stack_traces(stochs)
+        acorr_for = dict(zip(zip(names, dims), diagnostics.autocorrelation(traces, 50).T))
+
+    def acorr(trace, key):
+        rho = acorr_for[key]
         if len(trace) > 50:
-            pl.acorr(trace, normed=True, detrend=pl.mlab.detrend_mean, maxlags=50)
+            pl.vlines(range(-50, 51), 0, pl.hstack((rho[:0:-1], rho)))
+            pl.axhline(0, color='k')
         pl.xticks([])
         pl.yticks([])
         l,r,b,t = pl.axis()
@@ -313,7 +327,7 @@ def plot_acorr(model):
 
 
 def plot_trace(model):
-    def show_trace(trace):
+    def show_trace(trace, key):
         pl.plot(trace)
         pl.xticks([])
 
@@ -325,7 +339,8 @@ def plot_viz_of_stochs(vars, viz_func, figsize=(8,6)):
     
     :Parameters:
       - `vars` : dictionary
-      - `viz_func` : visualazation function such as ``acorr``, ``show_trace``, or ``hist``
+      - `viz_func` : visualazation function such as ``acorr``, ``show_trace``, or ``hist``,
+        called with the trace of one dimension of a stoch and the key (stoch name, dim)
       - `figsize` : tuple, size of figure
     
     """
@@ -344,7 +359,7 @@ def plot_viz_of_stochs(vars, viz_func, figsize=(8,6)):
             trace = trace.reshape((len(trace), 1))
         for d in range(len(pl.atleast_1d(s.value))):
             pl.subplot(rows, cols, tile)
-            viz_func(pl.atleast_2d(trace)[:, d])
+            viz_func(pl.atleast_2d(trace)[:, d], (s.__name__, d))
             pl.title('\n\n%s[%d]'%(s.__name__, d), va='top', ha='center', fontsize=8)
             tile += 1
 
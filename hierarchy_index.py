@@ -0,0 +1,191 @@
+""" Array index of an area hierarchy
+
+The area hierarchy is a networkx.DiGraph with edges from each area to
+the areas it contains, e.g. all -> super-region -> region -> country,
+and possibly further to subnational units.  Walking it with networkx
+for every row of data or every leaf makes the model setup and
+prediction quadratic in the number of areas, so this module walks it
+once and keeps the result in arrays:
+
+  - nodes are numbered in depth-first preorder from the root, so the
+    subtree below node i is the range of ids first[i] to last[i]
+    (the Euler-tour interval of the node), and "is b below a" is the
+    test first[a] <= b <= last[a]
+  - parent[i] and depth[i] are the parent id (-1 for the root) and the
+    number of edges from the root
+  - ancestors[i] holds the ids of the path from the root to node i,
+    with ancestors[i, depth[i]] == i, padded with -1
+  - leaf[i] is True for nodes with no children, and children[i] is
+    the list of ids of the children of i, in successor order
+
+The index is a snapshot: it must be built again after the hierarchy
+is changed.
+
+Example
+-------
+>>> import hierarchy_index
+>>> index = hierarchy_index.build(model.hierarchy)
+>>> hierarchy_index.leaves(index, 'asia_east')
+>>> hierarchy_index.in_subtree(index, model.input_data['area'], 'asia_east')
+"""
+
+import pylab as pl
+
+def build(hierarchy, root='all'):
+    """ Index the part of the area hierarchy below root
+
+    :Parameters:
+      - `hierarchy` : networkx.DiGraph, which must be a tree below root
+      - `root` : str, optional
+
+    :Results:
+      - Returns dict with the list of nodes in preorder, the dict id
+        mapping each node to its position, and the arrays parent, depth,
+        first, last, leaf, and ancestors, and the list of lists children,
+        as described above
+
+    """
+    nodes = []
+    parent = []
+    depth = []
+    children = []
+
+    # iterative depth-first search, so that deep hierarchies do not hit the recursion limit
+    stack = [(root, -1, 0)]
+    while stack:
+        node, p, d = stack.pop()
+        i = len(nodes)
+        nodes.append(node)
+        parent.append(p)
+        depth.append(d)
+        children.append([])
+        if p >= 0:
+            children[p].append(i)
+        # push in reverse so that children are visited in successor order
+        for c in reversed(hierarchy.successors(node)):
+            stack.append((c, i, d+1))
+
+    id = dict([(node, i) for i, node in enumerate(nodes)])
+    assert len(id) == len(nodes), 'area hierarchy must be a tree below %s' % root
+
+    n = len(nodes)
+    parent = pl.array(parent, dtype=int)
+    depth = pl.array(depth, dtype=int)
+    max_depth = depth.max()
+
+    # subtree sizes, accumulated from the deepest level up
+    size = pl.ones(n, dtype=int)
+    for d in range(max_depth, 0, -1):
+        level = pl.where(depth == d)[0]
+        size += pl.bincount(parent[level], weights=size[level], minlength=n).astype(int)
+
+    # path from root, copied down from the parent one level at a time
+    ancestors = -pl.ones((n, max_depth+1), dtype=int)
+    ancestors[0, 0] = 0
+    for d in range(1, max_depth+1):
+        level = pl.where(depth == d)[0]
+        ancestors[level] = ancestors[parent[level]]
+        ancestors[level, d] = level
+
+    first = pl.arange(n)
+    return dict(root=root, nodes=nodes, id=id, parent=parent, depth=depth, children=children,
+                first=first, last=first + size - 1, leaf=(size == 1), ancestors=ancestors)
+
+def ids(index, areas):
+    """ Find the id of each area, or -1 for areas not in the index
+
+    :Parameters:
+      - `index` : dict, from build()
+      - `areas` : list of str
+
+    :Results:
+      - Returns int array with one entry for each area
+
+    """
+    return pl.array([index['id'].get(a, -1) for a in areas], dtype=int)
+
+def in_subtree(index, areas, node):
+    """ Test which areas are in the subtree below node (including node itself)
+
+    :Parameters:
+      - `index` : dict, from build()
+      - `areas` : list of str, e.g. the area column of the input data
+      - `node` : str, a node of the index
+
+    :Results:
+      - Returns boolean array with one entry for each area
+
+    """
+    i = index['id'][node]
+    area_ids = ids(index, areas)
+    return (area_ids >= index['first'][i]) & (area_ids <= index['last'][i])
+
+def subtree(index, node):
+    """ Find the nodes of the subtree below node, in preorder, starting with node"""
+    i = index['id'][node]
+    return index['nodes'][index['first'][i]:index['last'][i]+1]
+
+def path(index, node, start=None):
+    """ Find the path to node from start, which must be one of its ancestors
+
+    :Parameters:
+      - `index` : dict, from build()
+      - `node` : str
+      - `start` : str, optional, the root of the index by default
+
+    :Results:
+      - Returns list of nodes from start to node, including both
+
+    """
+    i = index['id'][node]
+    d = 0
+    if start != None:
+        d = index['depth'][index['id'][start]]
+        assert index['ancestors'][i, d] == index['id'][start], '%s is not below %s' % (node, start)
+    return [index['nodes'][j] for j in index['ancestors'][i, d:index['depth'][i]+1]]
+
+def leaves(index, node):
+    """ Find the leaves of the subtree below node, in breadth-first order
+
+    :Parameters:
+      - `index` : dict, from build()
+      - `node` : str
+
+    :Results:
+      - Returns list of nodes, which is [node] if node is itself a leaf
+
+    """
+    i = index['id'][node]
+    ix = pl.arange(index['first'][i], index['last'][i]+1)
+    ix = ix[index['leaf'][ix]]
+
+    # breadth-first order is preorder stably sorted by depth
+    ix = ix[pl.argsort(index['depth'][ix], kind='mergesort')]
+    return [index['nodes'][j] for j in ix]
+
+def levels(index):
+    """ Number of levels of the hierarchy, from the root to the deepest
+    node, which is the number of sigma_alpha random effect priors"""
+    return index['depth'].max() + 1
+
+def breadth_first(index):
+    """ List all nodes of the index in breadth-first order"""
+    return [index['nodes'][j] for j in pl.argsort(index['depth'], kind='mergesort')]
+
+def row_ancestors(index, areas):
+    """ Find the ancestors of the area of each row of data at once
+
+    :Parameters:
+      - `index` : dict, from build()
+      - `areas` : list of str, e.g. the area column of the input data
+
+    :Results:
+      - Returns int array with a row for each area, holding the ids of
+        the path from the root to the area, padded with -1 (rows for
+        areas not in the index are all -1)
+
+    """
+    area_ids = ids(index, areas)
+    A = index['ancestors'][pl.maximum(area_ids, 0)]
+    A[area_ids < 0] = -1
+    return A
@@ -13,18 +13,46 @@ import rate_model
 import age_pattern
 import age_integrating_model
 import covariate_model
+import derived_quantities
 import similarity_prior_model
 import expert_prior_model
-reload(expert_prior_model)
-reload(similarity_prior_model)
-reload(age_pattern)
-reload(covariate_model)
-reload(rate_model)
+if dismod3.settings.RELOAD_MODULES:
+    reload(expert_prior_model)
+    reload(similarity_prior_model)
+    reload(age_pattern)
+    reload(covariate_model)
+    reload(rate_model)
+
+# columns that determine pi for a row of data, along with the x_ covariates
+design_columns = ['area', 'sex', 'age_start', 'age_end', 'year_start', 'year_end']
+
+def design_groups(data):
+    """ Group the rows of data that have identical design, which have
+    the same expected value pi in the model of age_specific_rate
+
+    :Parameters:
+      - `data` : pandas.DataFrame, with columns design_columns and covariates starting with 'x_'
+
+    :Results:
+      - Returns dict with 'index', an int array mapping each row to its group, and
+        'first', an int array with the position of the first row of each group
+
+    """
+    columns = design_columns + [c for c in data.columns if c.startswith('x_')]
+    index = pl.zeros(len(data), dtype=int)
+    first = []
+    group_for = {}
+    for i, key in enumerate(zip(*[data[c] for c in columns])):
+        if key not in group_for:
+            group_for[key] = len(first)
+            first.append(i)
+        index[i] = group_for[key]
+    return dict(index=index, first=pl.array(first, dtype=int))
 
 def age_specific_rate(model, data_type, reference_area='all', reference_sex='total', reference_year='all',
                       mu_age=None, mu_age_parent=None, sigma_age_parent=None, 
                       rate_type='neg_binom', lower_bound=None, interpolation_method='linear',
-                      include_covariates=True, zero_re=False):
+                      include_covariates=True, zero_re=False, compress=False):
     # TODO: expose (and document) interface for alternative rate_type as well as other options,
     # record reference values in the model
     """ Generate PyMC objects for model of epidemological age-interval data
@@ -36,15 +64,23 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
       - `mu_age` : pymc.Node, will be used as the age pattern, set to None if not needed
       - `mu_age_parent` : pymc.Node, will be used as the age pattern of the parent of the root area, set to None if not needed
       - `sigma_age_parent` : pymc.Node, will be used as the standard deviation of the age pattern, set to None if not needed
-      - `rate_type` : str, optional. One of 'beta_binom', 'binom', 'log_normal_model', 'neg_binom', 'neg_binom_lower_bound_model', 'neg_binom_model', 'normal_model', 'offest_log_normal', or 'poisson'
+      - `rate_type` : str, optional. One of 'beta_binom', 'binom', 'log_normal_model', 'marginal_beta_binom', 'neg_binom', 'neg_binom_lower_bound_model', 'neg_binom_model', 'normal_model', 'offest_log_normal', or 'poisson'
       - `lower_bound` : 
       - `interpolation_method` : str, optional, one of 'linear', 'nearest', 'zero', 'slinear', 'quadratic, or 'cubic'
       - `include_covariates` : boolean
       - `zero_re` : boolean, change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
+      - `compress` : boolean, compute the age integral and covariate adjustment once for each
+        group of rows with identical design (see design_groups), and pool the likelihoods
+        of each group for the binom and poisson rate types
 
     :Results:
       - Returns dict of PyMC objects, including 'pi', the covariate adjusted predicted values for each row of data
 
+    .. note::
+      - with compress=True, 'mu_interval', 'pi_design', 'U', and 'X' have a row
+        for each group, 'design_index' maps each row of data to its group, and
+        'compression_ratio' is the number of rows for each group
+
     """
     name = data_type
     import data
@@ -109,8 +145,16 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
 
     age_weights = pl.ones_like(vars['mu_age'].value) # TODO: use age pattern appropriate to the rate type
     if len(data) > 0:
+        design_data = data
+        if compress:
+            design = design_groups(data)
+            design_data = data.take(design['first'])
+            vars['design_index'] = design['index']
+            vars['compression_ratio'] = len(data) / float(len(design_data))
+            print 'compressed %d rows of %s data to %d groups with identical design (%.1fx)' % (len(data), name, len(design_data), vars['compression_ratio'])
+
         vars.update(
-            age_integrating_model.age_standardize_approx(name, age_weights, vars['mu_age'], data['age_start'], data['age_end'], ages)
+            age_integrating_model.age_standardize_approx(name, age_weights, vars['mu_age'], design_data['age_start'], design_data['age_end'], ages)
             )
 
         # uncomment the following to effectively remove alleffects
@@ -124,11 +168,16 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
 
         if include_covariates:
             vars.update(
-                covariate_model.mean_covariate_model(name, vars['mu_interval'], data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re)
+                covariate_model.mean_covariate_model(name, vars['mu_interval'], design_data, parameters, model, reference_area, reference_sex, reference_year, zero_re=zero_re)
                 )
         else:
             vars.update({'pi': vars['mu_interval']})
 
+        if compress:
+            # broadcast the value of each group to its rows
+            vars['pi_design'] = vars['pi']
+            vars['pi'] = mc.Lambda('pi_data_%s'%name, lambda pi=vars['pi_design'], index=vars['design_index']: pi[index])
+
         ## ensure that all data has uncertainty quantified appropriately
         # first replace all missing se from ci
         missing_se = pl.isnan(data['standard_error']) | (data['standard_error'] < 0)
@@ -197,16 +246,18 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
                 rate_model.normal_model(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'])
                 )
         elif rate_type == 'binom':
-            vars += rate_model.binom(name, vars['pi'], data['value'], data['effective_sample_size'])
+            vars += rate_model.binom(name, vars['pi'], data['value'], data['effective_sample_size'], vars.get('design_index'))
         elif rate_type == 'beta_binom':
             vars += rate_model.beta_binom(name, vars['pi'], data['value'], data['effective_sample_size'])
+        elif rate_type == 'marginal_beta_binom':
+            vars += rate_model.marginal_beta_binom(name, vars['pi'], data['value'], data['effective_sample_size'])
         elif rate_type == 'poisson':
             missing_ess = pl.isnan(data['effective_sample_size']) | (data['effective_sample_size'] < 0)
             if sum(missing_ess) > 0:
                 print 'WARNING: %d rows of %s data has invalid quantification of uncertainty.' % (sum(missing_ess), name)
                 data['effective_sample_size'][missing_ess] = 0.0
 
-            vars += rate_model.poisson(name, vars['pi'], data['value'], data['effective_sample_size'])
+            vars += rate_model.poisson(name, vars['pi'], data['value'], data['effective_sample_size'], vars.get('design_index'))
         elif rate_type == 'offset_log_normal':
             vars['sigma'] = mc.Uniform('sigma_%s'%name, lower=.0001, upper=10., value=.01)
             vars += rate_model.offset_log_normal(name, vars['pi'], vars['sigma'], data['value'], data['standard_error'])
@@ -258,7 +309,7 @@ def age_specific_rate(model, data_type, reference_area='all', reference_sex='tot
     result[data_type] = vars
     return result
     
-def consistent(model, reference_area='all', reference_sex='total', reference_year='all', priors={}, zero_re=True):
+def consistent(model, reference_area='all', reference_sex='total', reference_year='all', priors={}, zero_re=True, ode_solver='rk4', compress=False):
     """ Generate PyMC objects for consistent model of epidemological data
     
     :Parameters:
@@ -267,6 +318,8 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
       - `root_area, root_sex, root_year` : the node of the model to fit consistently
       - `priors` : dictionary, with keys for data types for lists of priors on age patterns
       - `zero_re` : boolean, change one stoch from each set of siblings in area hierarchy to a 'sum to zero' deterministic
+      - `ode_solver` : str, one of 'rk4' (Runge-Kutta 4 from dismod_ode) or 'closed_form' (exact solution from compartmental_model)
+      - `compress` : boolean, group the rows of each data type with identical design, see age_specific_rate
  
     :Results:
       - Returns dict of dicts of PyMC objects, including 'i', 'p', 'r', 'f', the covariate adjusted predicted values for each row of data
@@ -289,7 +342,7 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
     for t in 'irf':
         rate[t] = age_specific_rate(model, t, reference_area, reference_sex, reference_year,
                                     mu_age=None, mu_age_parent=priors.get((t, 'mu')), sigma_age_parent=priors.get((t, 'sigma')),
-                                    zero_re=zero_re)[t] # age_specific_rate()[t] is to create proper nesting of dict
+                                    zero_re=zero_re, compress=compress)[t] # age_specific_rate()[t] is to create proper nesting of dict
 
         # set initial values from data
         if t in priors:
@@ -337,13 +390,24 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
     logit_C0 = mc.Uniform('logit_C0', -15, 15, value=-10.)
 
 
-    # use Runge-Kutta 4 ODE solver
-    import dismod_ode
-
     N = len(m_all)
-    num_step = 10  # double until it works
     ages = pl.array(ages, dtype=float)
-    fun = dismod_ode.ode_function(num_step, ages, m_all)
+    if ode_solver == 'rk4':
+        # use Runge-Kutta 4 ODE solver
+        import dismod_ode
+
+        num_step = 10  # double until it works
+        fun = dismod_ode.ode_function(num_step, ages, m_all)
+
+        # when linear is set, prevalence is found from the linearization
+        # of the tape at x instead of by integrating (see linearize_ode)
+        ode = dict(fun=fun, x=None, y=None, linear=False)
+    elif ode_solver == 'closed_form':
+        # use exact solution for piecewise-constant rates, which does not depend on m_all
+        import compartmental_model
+        ode = None
+    else:
+        raise ValueError, 'Unrecognized ODE solver: %s' % ode_solver
 
     @mc.deterministic
     def mu_age_p(logit_C0=logit_C0,
@@ -359,8 +423,19 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
         
         C0 = mc.invlogit(logit_C0)
 
+        if ode_solver == 'closed_form':
+            return compartmental_model.prevalence(i, r, f, C0, ages)
+
         x = pl.hstack((i, r, f, 1-C0, C0))
-        y = fun.forward(0, x)
+        if ode['linear']:
+            # directional derivative of the tape at ode['x'], in one first order sweep
+            dx = x - ode['x']
+            if pl.any(dx):
+                y = ode['y'] + fun.forward(1, dx)
+            else:
+                y = ode['y']
+        else:
+            y = fun.forward(0, x)
 
         susceptible = y[:N]
         condition = y[N:]
@@ -374,7 +449,7 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                           mu_age_p,
                           mu_age_parent=priors.get(('p', 'mu')),
                           sigma_age_parent=priors.get(('p', 'sigma')),
-                          zero_re=zero_re)['p']
+                          zero_re=zero_re, compress=compress)['p']
 
     @mc.deterministic
     def mu_age_pf(p=p['mu_age'], f=rate['f']['mu_age']):
@@ -386,21 +461,21 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                            sigma_age_parent=priors.get(('pf', 'sigma')),
                            lower_bound='csmr',
                            include_covariates=False,
-                           zero_re=zero_re)['pf']
+                           zero_re=zero_re, compress=compress)['pf']
 
     @mc.deterministic
     def mu_age_m(pf=pf['mu_age'], m_all=m_all):
-        return (m_all - pf).clip(1.e-6, 1.e6)
+        return derived_quantities.other_mortality(pf, m_all)
     rate['m'] = age_specific_rate(model, 'm_wo',
                                   reference_area, reference_sex, reference_year,
                                   mu_age_m,
                                   None, None,
                                   include_covariates=False,
-                                  zero_re=zero_re)['m_wo']
+                                  zero_re=zero_re, compress=compress)['m_wo']
 
     @mc.deterministic
     def mu_age_rr(m=rate['m']['mu_age'], f=rate['f']['mu_age']):
-        return (m+f) / m
+        return derived_quantities.relative_risk(m, f)
     rr = age_specific_rate(model, 'rr',
                            reference_area, reference_sex, reference_year,
                            mu_age_rr,
@@ -408,11 +483,11 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                            sigma_age_parent=priors.get(('rr', 'sigma')),
                            rate_type='log_normal',
                            include_covariates=False,
-                           zero_re=zero_re)['rr']
+                           zero_re=zero_re, compress=compress)['rr']
 
     @mc.deterministic
     def mu_age_smr(m=rate['m']['mu_age'], f=rate['f']['mu_age'], m_all=m_all):
-        return (m+f) / m_all
+        return derived_quantities.standardized_mortality_ratio(m, f, m_all)
     smr = age_specific_rate(model, 'smr',
                             reference_area, reference_sex, reference_year,
                             mu_age_smr,
@@ -420,29 +495,23 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                             sigma_age_parent=priors.get(('smr', 'sigma')),
                             rate_type='log_normal',
                             include_covariates=False,
-                            zero_re=zero_re)['smr']
+                            zero_re=zero_re, compress=compress)['smr']
 
     @mc.deterministic
     def mu_age_m_with(m=rate['m']['mu_age'], f=rate['f']['mu_age']):
-        return m+f
+        return derived_quantities.with_condition_mortality(m, f)
     m_with = age_specific_rate(model, 'm_with',
                                reference_area, reference_sex, reference_year,
                                mu_age_m_with,
                                mu_age_parent=priors.get(('m_with', 'mu')),
                                sigma_age_parent=priors.get(('m_with', 'sigma')),
                                include_covariates=False,
-                               zero_re=zero_re)['m_with']
+                               zero_re=zero_re, compress=compress)['m_with']
     
     # duration = E[time in bin C]
     @mc.deterministic
     def mu_age_X(r=rate['r']['mu_age'], m=rate['m']['mu_age'], f=rate['f']['mu_age']):
-        hazard = r + m + f
-        pr_not_exit = pl.exp(-hazard)
-        X = pl.empty(len(hazard))
-        X[-1] = 1 / hazard[-1]
-        for i in reversed(range(len(X)-1)):
-            X[i] = pr_not_exit[i] * (X[i+1] + 1) + 1 / hazard[i] * (1 - pr_not_exit[i]) - pr_not_exit[i]
-        return X
+        return derived_quantities.duration(r, m, f)
     X = age_specific_rate(model, 'X',
                           reference_area, reference_sex, reference_year,
                           mu_age_X,
@@ -450,13 +519,50 @@ def consistent(model, reference_area='all', reference_sex='total', reference_yea
                           sigma_age_parent=priors.get(('X', 'sigma')),
                           rate_type='normal',
                           include_covariates=True,
-                          zero_re=zero_re)['X']
+                          zero_re=zero_re, compress=compress)['X']
 
     vars = rate
-    vars.update(logit_C0=logit_C0, p=p, pf=pf, rr=rr, smr=smr, m_with=m_with, X=X)
+    vars.update(logit_C0=logit_C0, p=p, pf=pf, rr=rr, smr=smr, m_with=m_with, X=X, ode=ode, m_all=m_all)
     return vars
 
 
+def linearize_ode(vars, linearize=True):
+    """ Replace the ODE solution in a consistent model with its linearization
+    at the current values, or restore the full solution
+
+    :Parameters:
+      - `vars` : dict, from consistent
+      - `linearize` : boolean, if False, go back to integrating the ODE
+
+    :Results:
+      - Returns True if the model has an ODE tape to linearize, False otherwise
+
+    .. note::
+      - the pycppad tape in dismod_ode is evaluated once at the current
+        values, and while the model is linearized each change to i, r,
+        f, or C0 is found from the exact directional derivative of the
+        tape, fun.forward(1, dx), instead of by integrating the ODE;
+        changes to nodes that do not feed the ODE do not touch the tape
+      - only use the linearized model near the values it was found at,
+        e.g. while finding a gradient
+
+    """
+    ode = vars.get('ode')
+    if ode is None:
+        return False
+
+    if not linearize:
+        ode['linear'] = False
+        return True
+
+    C0 = mc.invlogit(vars['logit_C0'].value)
+    x = pl.hstack([vars[t]['mu_age'].value for t in 'irf'] + [1-C0, C0])
+    ode['x'] = x
+    ode['y'] = ode['fun'].forward(0, x)
+    ode['linear'] = True
+    return True
+
+
 # TODO: refactor emp_priors into a class and document them
 def emp_priors(dm, reference_area, reference_sex, reference_year):
     import dismod3.utils
@@ -0,0 +1,195 @@
+""" Run a dependency graph of fitting jobs, on this machine or on the cluster
+
+Each job is a dict with a name, the command line of a python script
+to run, files for stdout and stderr, and lists of names of jobs it
+must wait for.  run() hands the jobs to a local process pool with a
+concurrency limit, or submits them to SGE with -hold_jid, depending
+on dismod3.settings.ON_SGE.
+
+SGE starts a job once the jobs it holds for have finished, whether
+they succeeded or not.  The local runner only does that for the jobs
+in after; a job is skipped if one of the jobs in its hold list fails,
+so that a failed empirical prior does not start fits that need it.
+Jobs that should run even if some of the jobs before them failed,
+like the upload of all the posterior fits that did finish, wait for
+those jobs with after.  Local jobs can be sent to a warm_worker.py
+process, which has the fitting code loaded already, instead of each
+starting a new python.
+
+Example
+-------
+>>> import job_queue
+>>> jobs = [job_queue.job('w-4222', 'fit_world.py 4222', 'out.txt', 'err.txt'),
+...         job_queue.job('upld-4222', 'upload_fits.py 4222', 'out2.txt', 'err2.txt', after=['w-4222'])]
+>>> job_queue.run(jobs, max_procs=8)
+"""
+
+import os
+import pipes
+import subprocess
+import time
+
+def job(name, cmd, o, e, hold=[], after=[]):
+    """ Describe a job to run
+
+    Parameters
+    ----------
+    name : str
+      A name for the job, unique among the jobs to run together
+    cmd : str
+      The script and arguments to run with python, e.g. 'fit_world.py 4222 --fast=True'
+    o, e : str
+      Paths of files for the stdout and stderr of the job
+    hold : list of str, optional
+      Names of jobs that must finish successfully before this one starts
+    after : list of str, optional
+      Names of jobs that must finish, successfully or not, before this one starts
+
+    Results
+    -------
+    Returns dict describing the job
+    """
+    return dict(name=name, cmd=cmd, o=o, e=e, hold=list(hold), after=list(after))
+
+def cpu_count():
+    """ Find the number of processors on this machine"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return int(os.sysconf('SC_NPROCESSORS_ONLN'))
+
+def run(jobs, max_procs=None, retries=1, worker=None):
+    """ Run jobs with the executor selected by dismod3.settings.ON_SGE
+
+    Parameters
+    ----------
+    jobs : list of dicts
+      From job(), in an order where every job comes after the jobs it waits for
+    max_procs : int, optional
+      Number of jobs to run at once on this machine, cpu_count() by default
+    retries : int, optional
+      Number of times to rerun a job that fails on this machine
+    worker : str, optional
+      Path of the unix socket of a warm_worker.py process to run the
+      jobs on this machine in, dismod3.settings.WORKER_SOCKET by default
+
+    Results
+    -------
+    Returns dict of return codes keyed by job name, or None for jobs
+    submitted to SGE
+    """
+    import dismod3
+    if dismod3.settings.ON_SGE:
+        return run_sge(jobs)
+    else:
+        if worker == None:
+            worker = dismod3.settings.WORKER_SOCKET
+        return run_local(jobs, max_procs, retries, worker=worker)
+
+def run_sge(jobs):
+    """ Submit jobs to SGE, using -hold_jid for the dependencies
+
+    Results
+    -------
+    Returns dict of None keyed by job name, since the jobs run later
+    """
+    for j in jobs:
+        call_str = 'qsub -cwd -o %s -e %s ' % (j['o'], j['e'])
+        if j['hold'] or j['after']:
+            call_str += '-hold_jid %s ' % ','.join(j['hold'] + j['after'])
+        call_str += '-N %s ' % j['name'] \
+            + 'run_on_cluster.sh ' \
+            + j['cmd']
+        subprocess.call(call_str, shell=True)
+    return dict([(j['name'], None) for j in jobs])
+
+def run_local(jobs, max_procs=None, retries=1, poll_interval=.5, worker=None):
+    """ Run jobs on this machine, up to max_procs at once, starting each
+    job when all of the jobs it holds for have succeeded and all of the
+    jobs it runs after have finished
+
+    Results
+    -------
+    Returns dict of return codes keyed by job name; jobs that were
+    skipped because a job they hold for failed have return code None
+
+    Notes
+    -----
+    A job that exits with a non-zero return code is started again, up
+    to retries times, with its stdout and stderr appended to the same
+    files
+    """
+    if max_procs == None:
+        max_procs = cpu_count()
+
+    names = [j['name'] for j in jobs]
+    assert len(set(names)) == len(names), 'job names must be unique'
+    for j in jobs:
+        for h in j['hold'] + j['after']:
+            assert h in names, 'job %s waits for unknown job %s' % (j['name'], h)
+
+    waiting = list(jobs)
+    running = {}
+    attempts = {}
+    results = {}
+
+    while waiting or running:
+        # skip jobs that hold for a job that failed
+        for j in list(waiting):
+            if [h for h in j['hold'] if h in results and results[h] != 0]:
+                print 'skipping %s, since a job it holds for failed' % j['name']
+                results[j['name']] = None
+                waiting.remove(j)
+
+        # start jobs that are ready, in order
+        for j in list(waiting):
+            if len(running) >= max_procs:
+                break
+            if [h for h in j['hold'] if results.get(h) != 0] \
+                    or [h for h in j['after'] if h not in results]:
+                continue
+            waiting.remove(j)
+            running[j['name']] = (j, start_local(j, attempts.get(j['name'], 0) > 0, worker))
+            attempts[j['name']] = attempts.get(j['name'], 0) + 1
+
+        # collect jobs that have finished
+        time.sleep(poll_interval)
+        for name, (j, proc) in running.items():
+            rc = proc.poll()
+            if rc == None:
+                continue
+            del running[name]
+            if rc != 0 and attempts[name] <= retries:
+                print 'job %s failed with return code %d, retrying' % (name, rc)
+                waiting.insert(0, j)
+            else:
+                if rc != 0:
+                    print 'job %s failed with return code %d' % (name, rc)
+                results[name] = rc
+
+    return results
+
+def start_local(j, append=False, worker=None):
+    """ Start a job as a subprocess, with stdout and stderr going to its files
+
+    If worker is the path of the socket of a warm_worker.py process,
+    the subprocess only submits the job to the worker and waits for it
+    """
+    if not append:
+        open(j['o'], 'w').close()
+        open(j['e'], 'w').close()
+
+    # the worker also appends to these files, so always open them to append
+    o = open(j['o'], 'a')
+    e = open(j['e'], 'a')
+    try:
+        if worker:
+            cmd = 'python -u warm_worker.py submit -s %s -o %s -e %s %s' \
+                % tuple([pipes.quote(s) for s in [worker, j['o'], j['e'], j['cmd']]])
+        else:
+            cmd = 'python -u ' + j['cmd']
+        return subprocess.Popen(cmd, shell=True, stdout=o, stderr=e)
+    finally:
+        o.close()
+        e.close()
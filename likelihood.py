@@ -0,0 +1,246 @@
+""" Log-likelihoods of the rate models, with the terms that depend
+only on the data computed once
+
+The PyMC likelihoods (mc.negative_binomial_like, mc.poisson_like, ...)
+recompute the log-factorials of the observed counts, and the p_obs
+functions of rate_model re-slice the rows with data, every time the
+likelihood is evaluated.  Each function here takes the data when the
+model is built, keeps the rows that are included, the observed
+values, and the constant part of the log-likelihood, and returns a
+function of the parameters that computes only the part that depends on
+them, in buffers that are allocated once.  The value it returns is the
+PyMC log-likelihood, constant included, up to rounding.
+
+When groups of rows are known to have equal expected values (see
+ism.design_groups), the poisson and binomial likelihoods pool the
+counts and sample sizes of each group, which gives the same value with
+one term for each group instead of one for each row.
+
+Example
+-------
+>>> import likelihood
+>>> logp = likelihood.neg_binom(p*n, n, rows=(n != 0))
+>>> @mc.observed(name='p_obs')
+... def p_obs(value=p, pi=pi, delta=delta):
+...     return logp(pi, delta)
+"""
+
+import pylab as pl
+import scipy.special
+
+def _rows(rows, length):
+    """ Indices of the included rows, all of them if rows is None"""
+    if rows is None:
+        return pl.arange(length)
+    return pl.where(rows)[0]
+
+def _counts(k):
+    """ Observed counts as the PyMC likelihoods use them, truncated to integers"""
+    return pl.array(pl.array(k, dtype=int), dtype=float)
+
+def _pool(groups, rows, *columns):
+    """ Sum columns over the included rows of each group
+
+    :Results:
+      - Returns list of the index of the first included row of each group,
+        followed by the sum of each column for each group
+
+    """
+    keys, first, inverse = pl.unique(pl.asarray(groups)[rows], return_index=True, return_inverse=True)
+    return [rows[first]] + [pl.bincount(inverse, weights=c) for c in columns]
+
+def _poisson_terms(x, mu, buf):
+    """ Sum of the terms of the poisson log-likelihood that depend on mu > 0"""
+    return pl.dot(x, pl.log(mu, out=buf)) - mu.sum()
+
+def _neg_binom_terms(x, mu, a, buf):
+    """ Sum of the terms of the negative binomial log-likelihood that
+    depend on mu > 0 and a > 0, overwriting mu, a, and buf"""
+    pl.divide(mu, a, out=mu)
+    pl.add(x, a, out=buf)
+    lp = -pl.sum(scipy.special.gammaln(a, out=a))
+    lp -= pl.dot(buf, pl.log1p(mu, out=a))
+    lp += pl.sum(scipy.special.gammaln(buf, out=buf))
+    lp += pl.dot(x, pl.log(mu, out=mu))
+    return lp
+
+def neg_binom(k, n, rows=None):
+    """ Negative binomial log-likelihood of counts with expected values pi*n
+
+    :Parameters:
+      - `k` : array, observed counts (p*n)
+      - `n` : array, effective sample sizes
+      - `rows` : array of bool, optional, the rows to include, all rows by default
+
+    :Results:
+      - Returns function logp(pi, delta) of the expected rates pi (array with an
+        entry for every row) and the dispersion delta (scalar, or array with an
+        entry for every row), equal to
+        mc.negative_binomial_like(k[rows], pi[rows]*n[rows]+1.e-9, delta[rows])
+
+    .. note::
+      - as in mc.negative_binomial_like, rows with delta > 1.e10 have the poisson likelihood
+
+    """
+    rows = _rows(rows, len(k))
+    x = _counts(pl.asarray(k)[rows])
+    n = pl.array(n, dtype=float)[rows]
+    valid = pl.all(x >= 0)
+    const = -pl.sum(scipy.special.gammaln(x+1))
+
+    mu = pl.zeros(len(x))
+    a = pl.zeros(len(x))
+    buf = pl.zeros(len(x))
+
+    def logp(pi, delta):
+        pl.take(pi, rows, out=mu)
+        pl.multiply(mu, n, out=mu)
+        pl.add(mu, 1.e-9, out=mu)
+        if pl.shape(delta) == ():
+            a.fill(delta)
+        else:
+            pl.take(delta, rows, out=a)
+
+        if not valid or pl.any(mu <= 0) or pl.any(a <= 0):
+            return -pl.inf
+
+        big = a > 1.e10
+        if pl.all(big):
+            return const + _poisson_terms(x, mu, buf)
+        elif pl.any(big):
+            small = ~big
+            return const + _poisson_terms(x[big], mu[big], buf[big]) \
+                + _neg_binom_terms(x[small], mu[small], a[small], buf[small])
+        return const + _neg_binom_terms(x, mu, a, buf)
+
+    return logp
+
+def poisson(k, n, rows=None, groups=None):
+    """ Poisson log-likelihood of counts with expected values pi*n
+
+    :Parameters:
+      - `k` : array, observed counts (p*n)
+      - `n` : array, effective sample sizes
+      - `rows` : array of bool, optional, the rows to include, all rows by default
+      - `groups` : array of int, optional, rows with the same group must have the
+        same pi, and their counts and sample sizes are pooled
+
+    :Results:
+      - Returns function logp(pi) of the expected rates pi (array with an entry
+        for every row), equal to mc.poisson_like(k[rows], pi[rows]*n[rows])
+
+    """
+    rows = _rows(rows, len(k))
+    x = _counts(pl.asarray(k)[rows])
+    n = pl.array(n, dtype=float)[rows]
+    valid = pl.all(x >= 0) and not pl.any((x > 0) & (n == 0))
+    const = -pl.sum(scipy.special.gammaln(x+1))
+
+    if groups is not None:
+        # sum of k log(pi n) over the rows of a group is K log(pi N) plus a constant
+        pos = (x > 0) & (n > 0)
+        const += pl.dot(x[pos], pl.log(n[pos]))
+        rows, x, n = _pool(groups, rows, x, n)
+        pos = (x > 0) & (n > 0)
+        const -= pl.dot(x[pos], pl.log(n[pos]))
+
+    mu = pl.zeros(len(x))
+    buf = pl.zeros(len(x))
+
+    def logp(pi):
+        pl.take(pi, rows, out=mu)
+        pl.multiply(mu, n, out=mu)
+
+        if not valid or pl.any(mu < 0):
+            return -pl.inf
+        if pl.all(mu > 0):
+            return const + _poisson_terms(x, mu, buf)
+
+        # rows with expected count 0 contribute nothing if their observed count is 0
+        zero = (mu == 0)
+        if pl.any(x[zero] > 0):
+            return -pl.inf
+        return const + _poisson_terms(x[~zero], mu[~zero], buf[~zero])
+
+    return logp
+
+def binom(k, n, rows=None, groups=None):
+    """ Binomial log-likelihood of counts in n trials with probabilities pi
+
+    :Parameters:
+      - `k` : array, observed counts (p*n)
+      - `n` : array, effective sample sizes
+      - `rows` : array of bool, optional, the rows to include, all rows by default
+      - `groups` : array of int, optional, rows with the same group must have the
+        same pi, and their counts and sample sizes are pooled
+
+    :Results:
+      - Returns function logp(pi) of the probabilities pi (array with an entry
+        for every row), equal to mc.binomial_like(k[rows], n[rows], pi[rows]+1.e-9)
+
+    """
+    rows = _rows(rows, len(k))
+    x = _counts(pl.asarray(k)[rows])
+    n = _counts(pl.asarray(n)[rows])
+    valid = pl.all(x >= 0) and pl.all(x <= n)
+    const = pl.sum(scipy.special.gammaln(n+1) - scipy.special.gammaln(x+1) - scipy.special.gammaln(n-x+1))
+    if groups is not None:
+        rows, x, n = _pool(groups, rows, x, n)
+    n_minus_x = n - x
+
+    p = pl.zeros(len(x))
+    buf = pl.zeros(len(x))
+
+    def logp(pi):
+        pl.take(pi, rows, out=p)
+        pl.add(p, 1.e-9, out=p)
+
+        if not valid or pl.any(p < 0) or pl.any(p > 1):
+            return -pl.inf
+
+        lp = pl.dot(x, pl.log(p, out=buf))
+        pl.negative(p, out=p)
+        lp += pl.dot(n_minus_x, pl.log1p(p, out=p))
+        return const + lp
+
+    return logp
+
+def log_normal(p, s, rows=None):
+    """ Normal log-likelihood of log rates, with standard error s/p
+    in log space plus dispersion sigma
+
+    :Parameters:
+      - `p` : array, observed rates, positive on the included rows
+      - `s` : array, standard errors of the rates
+      - `rows` : array of bool, optional, the rows to include, all rows by default
+
+    :Results:
+      - Returns function logp(pi, sigma) of the expected rates pi (array with an entry
+        for every row) and the scalar dispersion sigma, equal to
+        mc.normal_like(log(p[rows]), log(pi[rows]+1.e-9), 1./(sigma**2 + (s[rows]/p[rows])**2))
+
+    """
+    rows = _rows(rows, len(p))
+    p = pl.array(p, dtype=float)[rows]
+    y = pl.log(p)
+    se2 = (pl.array(s, dtype=float)[rows] / p)**2
+    const = -.5 * len(y) * pl.log(2*pl.pi)
+
+    mu = pl.zeros(len(y))
+    var = pl.zeros(len(y))
+
+    def logp(pi, sigma):
+        pl.take(pi, rows, out=mu)
+        pl.add(mu, 1.e-9, out=mu)
+        pl.add(se2, sigma**2., out=var)
+
+        if pl.any(mu <= 0) or pl.any(var <= 0):
+            return -pl.inf
+
+        pl.log(mu, out=mu)
+        pl.subtract(y, mu, out=mu)
+        pl.square(mu, out=mu)
+        pl.divide(mu, var, out=mu)
+        return const - .5 * (mu.sum() + pl.log(var, out=var).sum())
+
+    return logp
@@ -0,0 +1,212 @@
+""" Sample from the posterior with several MCMC chains in parallel,
+until they have converged
+
+fit.fit_asr and fit.fit_consistent find MAP values and set up the step
+methods of an mc.MCMC object; sample() then forks one process for each
+chain, each starting from a random perturbation of the MAP values.
+The chains run in blocks of check_interval iterations, and after each
+block the split R-hat and effective sample size of every entry of every
+stoch are computed from all of the draws so far (see diagnostics.py).
+Sampling stops when all of them meet the targets, or when the chains
+reach max_iter iterations, and the thinned draws of all chains are
+merged into the trace database of the MCMC object, so that node.trace()
+returns them for covariate_model.predict_for and the graphics.
+
+Example
+-------
+>>> import multi_chain
+>>> m = mc.MCMC(vars)
+>>> fit_model.setup_asr_step_methods(m, vars)
+>>> multi_chain.sample(m, vars, chains=4, burn=5000, thin=10, check_interval=5000)
+>>> m.convergence['rhat'].max(), m.convergence['ess'].min()
+"""
+
+import multiprocessing
+import os
+import traceback
+
+import pylab as pl
+
+import diagnostics
+import flat_model
+import fit_model
+import trace_db
+
+def disperse(flat, scale, max_tries=10):
+    """ Move the stochs to a random point near their current values, with
+    finite log-posterior
+
+    :Parameters:
+      - `flat` : dict, from flat_model.flatten with transform=True
+      - `scale` : float, standard deviation of the perturbation of each entry of x
+      - `max_tries` : int, number of times to halve the scale before
+        staying at the current values
+
+    """
+    x0 = flat['get_x']()
+    for i in range(max_tries):
+        x = x0 + scale * pl.randn(len(x0))
+        if pl.isfinite(flat['logp'](x)):
+            flat['set_values'](x)
+            return
+        scale /= 2.
+    flat['set_values'](x0)
+
+def run_chain(m, flat, conn, chain, seed, dispersion, thin, tune_interval):
+    """ Run one chain in a child process, sampling a block of iterations
+    each time the parent sends a number of iterations and burn-in, and
+    sending back the thinned draws of every tallied node
+
+    Messages from the parent are (iter, burn) tuples, or None to stop;
+    replies are ('draws', dict of arrays keyed by name), or ('error', str)
+    """
+    try:
+        if isinstance(m.db, trace_db.Database):
+            # keep the files of each chain apart from the others, and from the merged draws
+            m.db.dbname = os.path.join(m.db.dbname, 'chain_%d' % chain)
+            if not os.path.exists(m.db.dbname):
+                os.makedirs(m.db.dbname)
+
+        pl.seed(seed)
+        disperse(flat, dispersion)
+
+        while True:
+            msg = conn.recv()
+            if msg == None:
+                break
+            iter, burn = msg
+            m.sample(iter, burn, thin, tune_interval=tune_interval, progress_bar=False)
+            conn.send(('draws', dict([(name, m.trace(name)[:]) for name in m._funs_to_tally])))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+def store_traces(m, draws):
+    """ Store merged draws in the database of m as a new chain, so
+    that node.trace(), m.trace(name), and m.dic use them
+
+    :Parameters:
+      - `m` : mc.MCMC
+      - `draws` : dict of arrays keyed by the names of the tallied nodes, all of the same length
+
+    """
+    m.db._initialize(m._funs_to_tally, len(draws.values()[0]))
+    chain = m.db.chains - 1
+    for name, tr in draws.items():
+        if isinstance(m.db, trace_db.Database):
+            m.db._traces[name].store(chain, tr)
+        else:
+            m.db._traces[name]._trace[chain] = tr
+
+def sample(m, vars, chains=4, burn=5000, thin=10, check_interval=5000, max_iter=100000,
+           min_ess=400, max_rhat=1.05, tune_interval=100, dispersion=.5):
+    """ Sample from the posterior with several chains in parallel until they converge
+
+    :Parameters:
+      - `m` : mc.MCMC, with step methods set up, and stochs at their MAP values
+      - `vars` : dict of PyMC objects that m was created from
+      - `chains` : int, number of chains, each run in its own process
+      - `burn` : int, number of iterations of each chain to discard
+      - `thin` : int, draws thinned by this number
+      - `check_interval` : int, number of iterations of each chain between convergence checks
+      - `max_iter` : int, maximum number of iterations of each chain, including burn
+      - `min_ess` : float, target effective sample size of the draws, for every entry of every stoch
+      - `max_rhat` : float, target split R-hat, for every entry of every stoch
+      - `tune_interval` : int
+      - `dispersion` : float, standard deviation of the perturbation of the starting values,
+        on the logit scale for bounded stochs (see flat_model.flatten)
+
+    :Results:
+      - Returns dict with 'iter' (number of iterations of each chain), 'converged' (boolean),
+        'names' (name of the stoch of each tracked dim), and 'ess' and 'rhat' (array for each
+        tracked dim), which is also stored as m.convergence
+
+    .. note::
+      - the merged draws are in m's trace database, chain after chain,
+        and m.iter, m.burn, m.thin hold the settings of one chain
+      - the processes are forked, so each chain starts with a copy of
+        the model and the step methods, including their proposal covariances
+
+    """
+    assert burn + check_interval <= max_iter, 'max_iter must allow at least one check'
+    assert check_interval / thin >= 2, 'check_interval must allow at least 2 draws between checks'
+
+    flat = flat_model.flatten(vars, transform=True)
+    tracked = [s for s in flat['stochs'] if s.__name__ in m._funs_to_tally]
+
+    processes = []
+    connections = []
+    for i in range(chains):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=run_chain,
+                                    args=(m, flat, child_conn, i, pl.randint(2**30), dispersion, thin, tune_interval))
+        p.start()
+        processes.append(p)
+        connections.append(parent_conn)
+
+    blocks = [[] for i in range(chains)]
+    iter = 0
+    result = dict(iter=0, converged=False, names=[], ess=pl.array([]), rhat=pl.array([]))
+    try:
+        msg = (burn + check_interval, burn)
+        while True:
+            for conn in connections:
+                conn.send(msg)
+            for i, conn in enumerate(connections):
+                status, reply = conn.recv()
+                if status == 'error':
+                    raise RuntimeError, 'chain %d failed:\n%s' % (i, reply)
+                blocks[i].append(reply)
+            iter += msg[0]
+
+            # stack the draws of all tracked stochs, as chains x draws x dims
+            names = []
+            draws = []
+            for s in tracked:
+                tr = pl.array([pl.concatenate([b[s.__name__] for b in blocks[i]]) for i in range(chains)])
+                tr = tr.reshape(tr.shape[:2] + (-1,))
+                names += [s.__name__] * tr.shape[2]
+                draws.append(tr)
+            if not draws:
+                result = dict(iter=iter, converged=True, names=[], ess=pl.array([]), rhat=pl.array([]))
+                break
+            draws = pl.concatenate(draws, axis=2)
+
+            rhat = diagnostics.split_rhat(draws)
+            ess = diagnostics.effective_sample_size(diagnostics.split_chains(draws))
+            converged = pl.all(rhat <= max_rhat) and pl.all(ess >= min_ess)
+            result = dict(iter=iter, converged=converged, names=names, ess=ess, rhat=rhat)
+
+            fit_model.logger.info('%d iterations: min ess %.0f (%s), max rhat %.3f (%s)\n'
+                                  % (iter, ess.min(), names[ess.argmin()], rhat.max(), names[rhat.argmax()]))
+            if converged or iter + check_interval > max_iter:
+                break
+            msg = (check_interval, 0)
+    except KeyboardInterrupt:
+        fit_model.logger.warning('Sampling interrupted')
+    finally:
+        for conn in connections:
+            try:
+                conn.send(None)
+            except IOError:
+                pass
+        for p in processes:
+            p.join(1)
+            if p.is_alive():
+                p.terminate()
+
+    if not result['converged']:
+        fit_model.logger.warning('chains did not meet the convergence targets in %d iterations' % iter)
+
+    # merge the thinned draws of every tallied node, chain after chain
+    n_blocks = min([len(b) for b in blocks])
+    if n_blocks > 0:
+        store_traces(m, dict([(name, pl.concatenate([b[name] for i in range(chains) for b in blocks[i][:n_blocks]]))
+                              for name in blocks[0][0]]))
+
+    m.iter = iter
+    m.burn = burn
+    m.thin = thin
+    m.chains = chains
+    m.convergence = result
+    return result
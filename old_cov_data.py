@@ -3,6 +3,8 @@ import pylab as pl
 import pandas
 import networkx as nx
 
+import hierarchy_index
+
 def from_gbd_json(fname):
     """ Create ModelData object from old DM3 JSON file
 
@@ -38,20 +40,15 @@ def from_gbd_jsons(dm):
     dm['countries_for'] = dict(
         [[dismod3.utils.clean(x[0]), x[1:]] for x in csv.reader(open(dismod3.settings.CSV_PATH + 'country_region.csv'))]
         )
-    dm['population_by_age'] = dict(
-        [[(r['Country Code'], r['Year'], r['Sex']),
-          [max(.001,float(r['Age %d Population' % i])) for i in range(dismod3.settings.MAX_AGE)]] 
-         for r in csv.DictReader(open(dismod3.settings.CSV_PATH + 'population.csv'))
-         if len(r['Country Code']) == 3]
-        )
+    dm['population_by_age'] = dismod3.population.population_by_age()
 
 
     d = ModelData()
 
     d.input_data = _input_data_from_gbd_json(dm)
     d.output_template = _output_template_from_gbd_json(dm)
-    d.parameters = _parameters_from_gbd_json(dm)
     d.hierarchy, d.nodes_to_fit = _hierarchy_from_gbd_json(dm)
+    d.parameters = _parameters_from_gbd_json(dm, d.hierarchy)
 
     print 'load completed successfully'
 
@@ -198,8 +195,9 @@ def _output_template_from_gbd_json(dm):
 
 
 
-def _parameters_from_gbd_json(dm):
-    """ copy expert priors"""
+def _parameters_from_gbd_json(dm, hierarchy):
+    """ copy expert priors, with a sigma_alpha prior for each level of hierarchy"""
+    n_levels = hierarchy_index.levels(hierarchy_index.build(hierarchy))
     parameters = ModelData().parameters
     old_name = dict(i='incidence', p='prevalence', rr='relative_risk', r='remission', f='excess_mortality', X='duration', pf='prevalence_x_excess-mortality')
     for t in 'i p r f rr X pf'.split():
@@ -232,7 +230,7 @@ def _parameters_from_gbd_json(dm):
                 parameters[t]['random_effects'][iso3] = dict(dist='TruncatedNormal', mu=0., sigma=prior['std'], lower=-2*prior['std'], upper=2*prior['std'])
 
         # include alternative prior on sigma_alpha based on heterogeneity
-        for i in range(5):  # max depth of hierarchy is 5
+        for i in range(n_levels):
             effect = 'sigma_alpha_%s_%d'%(t,i)
             #parameters[t]['random_effects'][effect] = dict(dist='TruncatedNormal', mu=.01, sigma=.01, lower=.01, upper=.05)
             #if 'heterogeneity' in parameters[t]:
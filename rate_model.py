@@ -1,10 +1,94 @@
-""" Several rate models"""
+""" Several rate models
+
+Each model has a 'p_pred' deterministic, with a predicted value for
+each row of data drawn from the likelihood.  The draws are made by a
+kernel function (binom_pred, neg_binom_pred, ...) that works on one
+vector of parent values, or on (draws x rows) arrays of them, and is
+attached to the node as p_pred.pred_kernel.  After sampling,
+predict(p_pred) draws the predictions for all kept draws at once from
+the traces of the parents of p_pred.  So p_pred does not have to be
+tallied, and then it is never computed during MCMC.
+
+There are two beta-binomial models: beta_binom has a latent Beta stoch
+for the rate of each row, and marginal_beta_binom integrates the latent
+rates out of the likelihood in closed form, so that it has a single
+stoch p_n however many rows of data there are.
+
+The binomial, poisson, negative binomial, and lognormal likelihoods
+are evaluated with the functions in likelihood.py, which compute the
+terms that depend only on the data when the model is built.
+"""
 
 import pylab as pl
 import pymc as mc
+import scipy.special
 
+import likelihood
 
-def binom(name, pi, p, n):
+def binom_pred(pi, n):
+    """ Draw predicted rates from the binomial model"""
+    return mc.rbinomial(n, pi+1.e-9) / (1.*n)
+
+def beta_binom_pred(pi, p_n, n):
+    """ Draw predicted rates from the beta-binomial model, by drawing
+    a latent rate for each row and then a binomial count"""
+    pi = pl.clip(pi, 1.e-9, 1-1.e-9)
+    return binom_pred(mc.rbeta(pi*p_n, (1-pi)*p_n), n)
+
+def poisson_pred(pi, n):
+    """ Draw predicted rates from the poisson model"""
+    return mc.rpoisson((pi*n).clip(1.e-9, pl.inf)) / (1.*n)
+
+def neg_binom_pred(pi, delta, n):
+    """ Draw predicted rates from the negative binomial model"""
+    return mc.rnegative_binomial(pi*n+1.e-9, delta) / pl.array(n+1.e-9, dtype=float)
+
+def normal_pred(pi, sigma, s):
+    """ Draw predicted rates from the normal model"""
+    return mc.rnormal(pi, 1./(sigma**2. + s**2.))
+
+def log_normal_pred(pi, sigma, s):
+    """ Draw predicted rates from the lognormal model"""
+    return pl.exp(mc.rnormal(pl.log(pi+1.e-9), 1./(sigma**2. + (s/(pi+1.e-9))**2)))
+
+def offset_log_normal_pred(pi, sigma, s, p_zeta):
+    """ Draw predicted rates from the offset log-normal model"""
+    return pl.exp(mc.rnormal(pl.log(pi+p_zeta), 1./(sigma**2. + (s/(pi+p_zeta))**2.))) - p_zeta
+
+def predict(p_pred):
+    """ Draw posterior predictions for every row of data from every kept draw, in one batch
+
+    :Parameters:
+      - `p_pred` : pymc.Deterministic, the 'p_pred' of one of the models below, after sampling
+
+    :Results:
+      - Returns array of draws x rows, the predicted rate of each row for each draw of the parents of p_pred
+
+    .. note::
+      - the node parents of p_pred (pi, and delta, sigma, p_zeta, or p_n) must be tallied,
+        but p_pred itself need not be (see trace_db.tally_only)
+
+    """
+    args = {}
+    for key, parent in p_pred.parents.items():
+        if isinstance(parent, mc.Node):
+            tr = pl.asarray(parent.trace())
+        elif isinstance(parent, pl.ndarray) or pl.isscalar(parent):
+            args[key] = parent
+            continue
+        else:
+            # a list of stochs, one for each row
+            tr = pl.array([pl.asarray(n.trace()) for n in parent]).T
+
+        # a scalar parent takes a column, to broadcast against the rows
+        if tr.ndim == 1:
+            tr = tr.reshape((len(tr), 1))
+        args[key] = tr
+
+    return p_pred.pred_kernel(**args)
+
+
+def binom(name, pi, p, n, groups=None):
     """ Generate PyMC objects for a binomial model
 
     :Parameters:
@@ -12,6 +96,8 @@ def binom(name, pi, p, n):
       - `pi` : pymc.Node, expected values of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `groups` : array of int, optional, rows with the same group have the same pi
+        (see ism.design_groups), and their likelihoods are pooled
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -20,16 +106,18 @@ def binom(name, pi, p, n):
     assert pl.all(p >= 0), 'observed values must be non-negative'
     assert pl.all(n >= 0), 'effective sample size must non-negative'
 
+    logp = likelihood.binom(p*n, n, groups=groups)
     @mc.observed(name='p_obs_%s'%name)
-    def p_obs(value=p, pi=pi, n=n):
-        return mc.binomial_like(value*n, n, pi+1.e-9)
+    def p_obs(value=p, pi=pi):
+        return logp(pi)
 
     # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
     n_nonzero = pl.array(n.copy(), dtype=int)
     n_nonzero[n==0] = 1.e6
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, n=n_nonzero):
-        return mc.rbinomial(n, pi+1.e-9) / (1.*n)
+        return binom_pred(pi, n)
+    p_pred.pred_kernel = binom_pred
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
@@ -64,12 +152,67 @@ def beta_binom(name, pi, p, n):
     n_nonzero[n==0] = 1.e6
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi_latent, n=n_nonzero):
-        return mc.rbinomial(n, pi) / (1.*n)
+        return binom_pred(pl.array(pi), n)
+    p_pred.pred_kernel = binom_pred
 
     return dict(p_n=p_n, pi_latent=pi_latent, p_obs=p_obs, p_pred=p_pred)
 
 
-def poisson(name, pi, p, n):
+def marginal_beta_binom(name, pi, p, n):
+    """ Generate PyMC objects for a beta-binomial model, with the latent
+    rates of the rows integrated out
+
+    :Parameters:
+      - `name` : str
+      - `pi` : pymc.Node, expected values of rates
+      - `p` : array, observed values of rates
+      - `n` : array, effective sample sizes of rates
+
+    :Results:
+      - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
+
+    .. note::
+      - the likelihood of k = p*n successes in n trials with latent rate
+        Beta(pi*p_n, (1-pi)*p_n) is C(n,k) B(k + pi*p_n, n - k + (1-pi)*p_n) / B(pi*p_n, (1-pi)*p_n),
+        which is the same model as beta_binom, with one stoch p_n instead
+        of one for each row
+      - as in the binomial likelihood of beta_binom, k and n are truncated to integers
+
+    """
+    assert pl.all(p >= 0), 'observed values must be non-negative'
+    assert pl.all(n >= 0), 'effective sample size must non-negative'
+
+    p_n = mc.Uniform('p_n_%s'%name, lower=1.e4, upper=1.e9, value=1.e4)  # convergence requires getting these bounds right
+
+    i_nonzero = (n!=0.)
+    # truncate the counts to integers, as mc.binomial_like does in beta_binom
+    k = pl.array(pl.array((p*n)[i_nonzero], dtype=int), dtype=float)
+    n_i = pl.array(pl.array(n[i_nonzero], dtype=int), dtype=float)
+    # the binomial coefficients do not depend on the parameters, so sum them once
+    log_binom_coef = pl.sum(scipy.special.gammaln(n_i+1) - scipy.special.gammaln(k+1) - scipy.special.gammaln(n_i-k+1))
+    k_valid = pl.all(k <= n_i)
+
+    @mc.observed(name='p_obs_%s'%name)
+    def p_obs(value=p, pi=pi, p_n=p_n):
+        if not k_valid:
+            return -pl.inf
+        pi_i = pl.clip(pi[i_nonzero], 1.e-9, 1-1.e-9)
+        alpha = pi_i*p_n
+        beta = (1-pi_i)*p_n
+        return log_binom_coef + pl.sum(scipy.special.betaln(k+alpha, n_i-k+beta) - scipy.special.betaln(alpha, beta))
+
+    # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
+    n_nonzero = pl.array(n.copy(), dtype=int)
+    n_nonzero[n==0] = 1.e6
+    @mc.deterministic(name='p_pred_%s'%name)
+    def p_pred(pi=pi, p_n=p_n, n=n_nonzero):
+        return beta_binom_pred(pi, p_n, n)
+    p_pred.pred_kernel = beta_binom_pred
+
+    return dict(p_n=p_n, p_obs=p_obs, p_pred=p_pred)
+
+
+def poisson(name, pi, p, n, groups=None):
     """ Generate PyMC objects for a poisson model
 
     :Parameters:
@@ -77,6 +220,8 @@ def poisson(name, pi, p, n):
       - `pi` : pymc.Node, expected values of rates
       - `p` : array, observed values of rates
       - `n` : array, effective sample sizes of rates
+      - `groups` : array of int, optional, rows with the same group have the same pi
+        (see ism.design_groups), and their likelihoods are pooled
 
     :Results:
       - Returns dict of PyMC objects, including 'p_obs' and 'p_pred' the observed stochastic likelihood and data predicted stochastic
@@ -86,16 +231,18 @@ def poisson(name, pi, p, n):
     assert pl.all(n >= 0), 'effective sample size must non-negative'
 
     i_nonzero = (n!=0.)
+    logp = likelihood.poisson(p*n, n, i_nonzero, groups)
     @mc.observed(name='p_obs_%s'%name)
-    def p_obs(value=p, pi=pi, n=n):
-        return mc.poisson_like((value*n)[i_nonzero], (pi*n)[i_nonzero])
+    def p_obs(value=p, pi=pi):
+        return logp(pi)
 
     # for any observation with n=0, make predictions for n=1.e6, to use for predictive validity
     n_nonzero = pl.array(n.copy(), dtype=float)
     n_nonzero[n==0.] = 1.e6
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, n=n_nonzero):
-        return mc.rpoisson((pi*n).clip(1.e-9, pl.inf)) / (1.*n)
+        return poisson_pred(pi, n)
+    p_pred.pred_kernel = poisson_pred
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
@@ -119,22 +266,19 @@ def neg_binom(name, pi, delta, p, n):
 
     i_zero = (n==0.)
 
-    if (isinstance(delta, mc.Node) and pl.shape(delta.value) == ()) \
-            or (not isinstance(delta, mc.Node) and pl.shape(delta) == ()): # delta is a scalar
-        @mc.observed(name='p_obs_%s'%name)
-        def p_obs(value=p, pi=pi, delta=delta, n=n):
-            return mc.negative_binomial_like(value[~i_zero]*n[~i_zero], pi[~i_zero]*n[~i_zero]+1.e-9, delta)
-    else:
-        @mc.observed(name='p_obs_%s'%name)
-        def p_obs(value=p, pi=pi, delta=delta, n=n):
-            return mc.negative_binomial_like(value[~i_zero]*n[~i_zero], pi[~i_zero]*n[~i_zero]+1.e-9, delta[~i_zero])
+    # delta can be a scalar, or have a value for each row
+    logp = likelihood.neg_binom(p*n, n, ~i_zero)
+    @mc.observed(name='p_obs_%s'%name)
+    def p_obs(value=p, pi=pi, delta=delta):
+        return logp(pi, delta)
 
     # for any observation with n=0, make predictions for n=1.e9, to use for predictive validity
     n_nonzero = n.copy()
     n_nonzero[i_zero] = 1.e9
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, delta=delta, n=n_nonzero):
-        return mc.rnegative_binomial(pi*n+1.e-9, delta) / pl.array(n+1.e-9, dtype=float)
+        return neg_binom_pred(pi, delta, n)
+    p_pred.pred_kernel = neg_binom_pred
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
@@ -190,7 +334,8 @@ def normal_model(name, pi, sigma, p, s):
     s_noninf[i_inf] = 0.    
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf):
-        return mc.rnormal(pi, 1./(sigma**2. + s**2.))
+        return normal_pred(pi, sigma, s)
+    p_pred.pred_kernel = normal_pred
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
@@ -213,16 +358,17 @@ def log_normal_model(name, pi, sigma, p, s):
     assert pl.all(s >= 0), 'standard error must be non-negative'
 
     i_inf = pl.isinf(s)
+    logp = likelihood.log_normal(p, s, ~i_inf)
     @mc.observed(name='p_obs_%s'%name)
-    def p_obs(value=p, pi=pi, sigma=sigma, s=s):
-        return mc.normal_like(pl.log(value[~i_inf]), pl.log(pi[~i_inf]+1.e-9),
-                              1./(sigma**2. + (s[~i_inf]/value[~i_inf])**2.))
+    def p_obs(value=p, pi=pi, sigma=sigma):
+        return logp(pi, sigma)
 
     s_noninf = s.copy()
     s_noninf[i_inf] = 0.    
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf):
-        return pl.exp(mc.rnormal(pl.log(pi+1.e-9), 1./(sigma**2. + (s/(pi+1.e-9))**2)))
+        return log_normal_pred(pi, sigma, s)
+    p_pred.pred_kernel = log_normal_pred
 
     return dict(p_obs=p_obs, p_pred=p_pred)
 
@@ -256,6 +402,7 @@ def offset_log_normal(name, pi, sigma, p, s):
     s_noninf[i_inf] = 0.
     @mc.deterministic(name='p_pred_%s'%name)
     def p_pred(pi=pi, sigma=sigma, s=s_noninf, p_zeta=p_zeta):
-        return pl.exp(mc.rnormal(pl.log(pi+p_zeta), 1./(sigma**2. + (s/(pi+p_zeta))**2.))) - p_zeta
+        return offset_log_normal_pred(pi, sigma, s, p_zeta)
+    p_pred.pred_kernel = offset_log_normal_pred
 
     return dict(p_zeta=p_zeta, p_obs=p_obs, p_pred=p_pred)
@@ -9,9 +9,9 @@ $ python fit_all.py 4222    # submit jobs to cluster to estimate empirical prior
 """
 
 import optparse
-import subprocess
 
 import dismod3
+import job_queue
 
 def refit_missing(id, consistent_posterior=True, posterior_types='p i r', fast=False):
     """ Enqueues all jobs necessary to fit missing regions for specified model
@@ -37,7 +37,7 @@ def refit_missing(id, consistent_posterior=True, posterior_types='p i r', fast=F
     temp_dir = dir + '/posterior/country_level_posterior_dm-' + str(id) + '/'
 
     #fit each region/year/sex individually for this model
-    hold_str = ''
+    jobs = []
     post_names = []
     pretty_names = ''
     for ii, r in enumerate(dismod3.gbd_regions):
@@ -56,15 +56,7 @@ def refit_missing(id, consistent_posterior=True, posterior_types='p i r', fast=F
                     post_names.append(name_str)
                     pretty_names += 'http://winthrop.ihme.washington.edu/dismod/show/tile_%d_xxx+all+%s+%s+%s.png\n' % (id, dismod3.utils.clean(r), y, dismod3.utils.clean(s))
 
-                    if dismod3.settings.ON_SGE:
-                        #call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-                        call_str = 'qsub -cwd ' \
-                            + hold_str \
-                            + '-N %s ' % name_str \
-                            + 'run_on_cluster.sh '
-                    else:
-                        call_str = 'python '
-                    call_str += 'fit_posterior.py %d -r %s -s %s -y %s' % (id, dismod3.utils.clean(r), dismod3.utils.clean(s), y)
+                    call_str = 'fit_posterior.py %d -r %s -s %s -y %s' % (id, dismod3.utils.clean(r), dismod3.utils.clean(s), y)
 
                     if not consistent_posterior:
                         call_str += ' --inconsistent=True --types="%s"' % posterior_types
@@ -72,22 +64,17 @@ def refit_missing(id, consistent_posterior=True, posterior_types='p i r', fast=F
                     if fast:
                         call_str += ' --fast=true'
 
-                    subprocess.call(call_str, shell=True)
+                    jobs.append(job_queue.job(name_str, call_str, o, e))
 
     # after all posteriors have finished running, upload disease model json
     if len(post_names) > 0:
-        hold_str = '-hold_jid %s ' % ','.join(post_names)
         o = '%s/empirical_priors/stdout/%d_upload.txt' % (dir, id)
         e = '%s/empirical_priors/stderr/%d_upload.txt' % (dir, id)
-        if dismod3.settings.ON_SGE:
-            call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-                       + hold_str \
-                       + '-N upld-%s ' % id \
-                       + 'run_on_cluster.sh '
-        else:
-            call_str = 'python '
-        call_str += 'upload_fits.py %d' % id
-        subprocess.call(call_str, shell=True)
+        call_str = 'upload_fits.py %d' % id
+        jobs.append(job_queue.job('upld-%s' % id, call_str, o, e, after=post_names))
+
+        # run on the cluster, or on this machine (in the warm worker, if dismod3.settings.WORKER_SOCKET is set)
+        job_queue.run(jobs)
     else:
         print 'Nothing found missing to refit'
         
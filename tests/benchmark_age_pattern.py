@@ -0,0 +1,50 @@
+""" Benchmark Age Pattern Model
+
+Compare time to evaluate mu_age with the interp1d implementation of
+age_pattern.spline and with the precomputed basis matrix
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+import pymc as mc
+
+import age_pattern
+reload(age_pattern)
+
+def time_mu_age(vars, reps):
+    """ Time evaluation of mu_age after changing one knot
+
+    :Parameters:
+      - `vars` : dict, from age_pattern.spline
+      - `reps` : int, number of evaluations to time
+
+    :Results:
+      - Returns seconds per evaluation
+
+    """
+    start_time = time.time()
+    for r in range(reps):
+        k = r % len(vars['gamma'])
+        vars['gamma'][k].value = -5. + .01*(r%10)
+        vars['mu_age'].value
+    return (time.time() - start_time) / reps
+
+def benchmark_spline(reps=2000, knots=[0, 1, 5, 10, 15, 20, 25, 35, 45, 55, 65, 75, 85, 100]):
+    ages = pl.arange(101)
+    knots = pl.array(knots)
+
+    print '%10s %12s %12s %8s' % ('method', 'interp1d', 'basis', 'speedup')
+    for method in ['linear', 'nearest', 'zero', 'slinear', 'quadratic', 'cubic']:
+        t = {}
+        for use_basis in [False, True]:
+            vars = age_pattern.spline('bench_%s_%s' % (method, use_basis), ages, knots, 0., method, use_basis=use_basis)
+            t[use_basis] = time_mu_age(vars, reps)
+        print '%10s %10.1fus %10.1fus %7.1fx' % (method, t[False]*1.e6, t[True]*1.e6, t[False]/t[True])
+
+if __name__ == '__main__':
+    benchmark_spline()
@@ -0,0 +1,63 @@
+""" Benchmark Dismod ODE Solvers
+
+Compare time to find prevalence with the Runge-Kutta 4 solver from
+dismod_ode and with the closed-form solution from compartmental_model,
+for a single evaluation (as in each MCMC step) and for a batch of
+posterior draws (as in prediction)
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+
+import compartmental_model
+reload(compartmental_model)
+
+def rk4_prevalence(fun, i, r, f, C0):
+    N = len(i)
+    y = fun.forward(0, pl.hstack((i, r, f, 1-C0, C0)))
+    return y[N:] / (y[:N] + y[N:])
+
+def benchmark_ode(reps=200, draws=1000):
+    import dismod_ode
+
+    ages = pl.arange(101.)
+    m_all = .01*pl.ones(101)
+    fun = dismod_ode.ode_function(10, ages, m_all)
+
+    pl.seed(12345)
+    i = pl.exp(pl.randn(draws, 101) - 4.)
+    r = pl.exp(pl.randn(draws, 101) - 2.)
+    f = pl.exp(pl.randn(draws, 101) - 3.)
+    C0 = pl.rand(draws) * .01
+
+    start_time = time.time()
+    for k in range(reps):
+        p_rk4 = rk4_prevalence(fun, i[k], r[k], f[k], C0[k])
+    t_rk4 = (time.time() - start_time) / reps
+
+    start_time = time.time()
+    for k in range(reps):
+        p_cf = compartmental_model.prevalence(i[k], r[k], f[k], C0[k], ages)
+    t_cf = (time.time() - start_time) / reps
+
+    print 'single evaluation: rk4 %.1fus, closed form %.1fus, %.1fx speedup' % (t_rk4*1.e6, t_cf*1.e6, t_rk4/t_cf)
+    print 'max abs difference: %.2g' % pl.absolute(p_rk4 - p_cf).max()
+
+    start_time = time.time()
+    for k in range(draws):
+        rk4_prevalence(fun, i[k], r[k], f[k], C0[k])
+    t_rk4 = time.time() - start_time
+
+    start_time = time.time()
+    compartmental_model.prevalence(i, r, f, C0, ages)
+    t_cf = time.time() - start_time
+
+    print '%d draws: rk4 %.3fs, closed form batch %.3fs, %.1fx speedup' % (draws, t_rk4, t_cf, t_rk4/t_cf)
+
+if __name__ == '__main__':
+    benchmark_ode()
@@ -0,0 +1,41 @@
+""" Benchmark Import Time of dismod3
+
+Compare the time for a new python process to import dismod3 alone,
+the modules a fitting worker needs (ism, fit, and data), and
+everything the package used to import up front, as listed in
+dismod3._submodules.  Each import runs in a fresh interpreter, so
+nothing is cached between runs.
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import time
+import subprocess
+
+def time_import(stmt, reps):
+    """ Median seconds for a new python process to run stmt"""
+    cwd = os.path.dirname(os.path.abspath(__file__)) + '/..'
+    times = []
+    for k in range(reps):
+        start_time = time.time()
+        subprocess.check_call([sys.executable, '-c', stmt], cwd=cwd)
+        times.append(time.time() - start_time)
+    return sorted(times)[reps/2]
+
+def benchmark_import(reps=5):
+    t_python = time_import('pass', reps)
+    t_package = time_import('import dismod3', reps)
+    t_worker = time_import('import dismod3; dismod3.ism, dismod3.fit, dismod3.data', reps)
+    t_all = time_import('import dismod3; [getattr(dismod3, m) for m in dismod3._submodules]', reps)
+
+    print 'python startup:          %.2fs' % t_python
+    print 'import dismod3:          %.2fs' % t_package
+    print 'dismod3 + ism, fit, data: %.2fs' % t_worker
+    print 'all dismod3 submodules:  %.2fs' % t_all
+    print 'worker imports take %.0f%% of the time to import everything' % (100. * (t_worker - t_python) / (t_all - t_python))
+
+if __name__ == '__main__':
+    benchmark_import()
@@ -0,0 +1,105 @@
+""" Benchmark MAP initialization
+
+Compare time to MAP for the sequential fmin_powell passes of
+fit_model.find_asr_initial_vals and for the joint gradient-based fit
+of fit_model.find_joint_map, on simulated age-specific rate models
+and on the age group data of validate_age_group.py, and the
+log-posterior each reaches
+"""
+
+# matplotlib will open windows during testing unless you do the following
+import matplotlib
+matplotlib.use("AGG")
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import time
+
+import pylab as pl
+import pymc as mc
+
+import data
+import ism
+import data_simulation
+import validate_age_group
+import fit_model
+reload(fit_model)
+
+def simulated_model(n, areas, seed):
+    """ Generate an age-specific rate model of simulated prevalence data
+
+    :Parameters:
+      - `n` : int, number of rows of data
+      - `areas` : list of str, areas of small_output hierarchy to spread the data over
+      - `seed` : int, random seed, so that each method fits the same model
+
+    :Results:
+      - Returns dict of PyMC objects, from ism.age_specific_rate
+
+    """
+    pl.np.random.seed(seed)
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, .025)
+    d.input_data['area'] = [areas[i % len(areas)] for i in range(n)]
+    d.hierarchy, d.output_template = data_simulation.small_output()
+    d.parameters['p']['parameter_age_mesh'] = [0, 5, 10, 15, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+
+    vars = ism.age_specific_rate(d, 'p', reference_area='all', reference_sex='total', reference_year='all',
+                                 mu_age=None, mu_age_parent=None, sigma_age_parent=None)
+    return vars['p']
+
+def validation_model(n, seed):
+    """ Generate an age-specific rate model of the age group data of
+    validate_age_group.py
+
+    :Parameters:
+      - `n` : int, number of rows of data
+      - `seed` : int, random seed, so that each method fits the same model
+
+    :Results:
+      - Returns dict of PyMC objects, from ism.age_specific_rate
+
+    """
+    pl.np.random.seed(seed)
+    d = validate_age_group.simulate_age_group_data(N=n, delta_true=5.)
+    d.parameters['p']['parameter_age_mesh'] = validate_age_group.knots
+
+    vars = ism.age_specific_rate(d, 'p', reference_area='all', reference_sex='total', reference_year='all',
+                                 mu_age=None, mu_age_parent=None, sigma_age_parent=None)
+    return vars['p']
+
+def time_sequential(vars, tol=.001):
+    start_time = time.time()
+    fit_model.find_asr_initial_vals(vars, 'fmin_powell', tol, False)
+    mc.MAP(vars).fit(method='fmin_powell', tol=tol, verbose=False)
+    return time.time() - start_time
+
+def time_joint(vars, tol=.001):
+    start_time = time.time()
+    fit_model.find_joint_map(vars, 'fmin_l_bfgs_b', tol, False)
+    return time.time() - start_time
+
+def benchmark_map(seed=12345):
+    models = [['fixed effects', 50, lambda: simulated_model(50, ['all'], seed)],
+              ['random effects', 100, lambda: simulated_model(100, ['USA', 'CAN', 'NAHI', 'all'], seed)],
+              ['large', 500, lambda: simulated_model(500, ['USA', 'CAN', 'NAHI', 'all'], seed)],
+              ['age group', 30, lambda: validation_model(30, seed)]]
+
+    print '%16s %5s %12s %12s %8s %12s %12s' % ('model', 'n', 'sequential', 'joint', 'speedup', 'logp seq', 'logp joint')
+    for name, n, make_vars in models:
+        t = {}
+        logp = {}
+        for method, timer in [['sequential', time_sequential], ['joint', time_joint]]:
+            vars = make_vars()
+            t[method] = timer(vars)
+            logp[method] = mc.Model(vars).logp
+        print '%16s %5d %11.1fs %11.1fs %7.1fx %12.1f %12.1f' % (name, n, t['sequential'], t['joint'], t['sequential']/t['joint'],
+                                                              logp['sequential'], logp['joint'])
+
+if __name__ == '__main__':
+    benchmark_map()
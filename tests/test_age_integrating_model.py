@@ -63,6 +63,64 @@ def test_age_integrating_midpoint_approx():
     m = mc.MCMC(vars)
     m.sample(3)
 
+def test_age_integrate_approx():
+    # simulate data
+    n = 50
+    sigma_true = .025*pl.ones(n)
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    ages = pl.arange(101)
+    d = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, sigma_true)
+    d['age_weights'] = [';'.join(['%.4f'%w for w in pl.ones(a_1 - a_0 + 1)]) for a_0, a_1 in zip(d['age_start'], d['age_end'])]
+
+    # create model and priors
+    vars = {}
+    vars.update(age_pattern.age_pattern('test', ages, knots=pl.arange(0,101,5), smoothing=.01))
+    vars.update(age_integrating_model.age_integrate_approx('test', d['age_weights'], vars['mu_age'], d['age_start'], d['age_end'], ages))
+
+    # compare to the mean of mu_age over each interval
+    mu_age = vars['mu_age'].value
+    expected = [mu_age[a_0:a_1].mean() for a_0, a_1 in zip(d['age_start'], d['age_end'])]
+    assert pl.allclose(vars['mu_interval'].value, expected)
+
+    vars['pi'] = vars['mu_interval']
+    vars.update(rate_model.normal_model('test', pi=vars['pi'], sigma=0, p=d['value'], s=sigma_true))
+
+    # fit model
+    m = mc.MCMC(vars)
+    m.sample(3)
+
+def test_age_integrate_approx_spline():
+    # simulate age intervals
+    n = 50
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    ages = pl.arange(101)
+    d = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, .025*pl.ones(n))
+    d['age_weights'] = [';'.join(['%.4f'%w for w in pl.ones(a_1 - a_0 + 1)]) for a_0, a_1 in zip(d['age_start'], d['age_end'])]
+
+    vars = age_pattern.spline('test', ages, pl.arange(0,101,5), .01)
+    vars.update(age_integrating_model.age_integrate_approx('test', d['age_weights'], vars['mu_age'], d['age_start'], d['age_end'], ages))
+
+    # give the age pattern a shape, so that the mean over each interval depends on its ages
+    for g in vars['gamma']:
+        g.value = mc.rnormal(-5., 1.)
+
+    mu_age = vars['mu_age'].value
+    expected = [mu_age[a_0:a_1].mean() for a_0, a_1 in zip(d['age_start'], d['age_end'])]
+    assert pl.allclose(vars['mu_interval'].value, expected)
+
+def test_age_weight_operator():
+    ages = pl.arange(101)
+    w = pl.ones(101)
+    age_start = pl.array([0, 10, 0, 10, 50])
+    age_end = pl.array([5, 20, 5, 20, 50])
+    op = age_integrating_model.age_weight_operator(age_start, age_end, [w]*5, len(ages))
+
+    assert op['W'].shape == (3, 101), 'duplicate rows should be collapsed'
+    assert list(op['index']) == [0, 1, 0, 1, 2]
+    assert pl.allclose(op['W'] * ages, [2., 14.5, 50.])
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
@@ -37,6 +37,40 @@ def test_age_pattern_model_sim():
     m.sample(2)
 
 
+def test_spline_basis():
+    import scipy.interpolate
+    ages = pl.arange(101)
+    knots = pl.array([0, 1, 5, 10, 20, 40, 60, 80, 100])
+    y = pl.exp(mc.rnormal(0., 1., size=len(knots)))
+
+    for method in ['linear', 'nearest', 'zero', 'slinear', 'quadratic', 'cubic']:
+        B = age_pattern.spline_basis(knots, ages, method)
+        expected = scipy.interpolate.interp1d(knots, y, kind=method, bounds_error=False, fill_value=0.)(ages)
+        assert pl.allclose(pl.dot(B, y), expected), 'basis matrix should match interp1d for %s interpolation' % method
+
+    assert age_pattern.spline_basis(knots, ages, 'linear') is age_pattern.spline_basis(knots, ages, 'linear'), 'basis should be cached'
+
+def test_age_pattern_model_basis():
+    vars = age_pattern.age_pattern('test', ages=pl.arange(101), knots=pl.arange(0,101,5), smoothing=.1)
+    vars_B = age_pattern.age_pattern('test_B', ages=pl.arange(101), knots=pl.arange(0,101,5), smoothing=.1, use_basis=True)
+
+    for g, g_B in zip(vars['gamma'], vars_B['gamma']):
+        g.value = g_B.value = mc.rnormal(-5., 1.)
+    assert pl.allclose(vars['mu_age'].value, vars_B['mu_age'].value)
+
+def test_spline_basis_matches_interpolation():
+    ages = pl.arange(101)
+    knots = pl.arange(0,101,5)
+    vars = age_pattern.spline('test', ages, knots, .1, use_basis=False)
+    vars_B = age_pattern.spline('test_B', ages, knots, .1, use_basis=True)
+
+    # the basis matrix gives the same age pattern and smoothing prior as interpolation, for any knot values
+    for g, g_B in zip(vars['gamma'], vars_B['gamma']):
+        g.value = g_B.value = mc.rnormal(-5., 1.)
+    assert pl.allclose(vars['mu_age'].value, vars_B['mu_age'].value)
+    assert pl.allclose(vars['smooth_gamma'].logp, vars_B['smooth_gamma'].logp)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
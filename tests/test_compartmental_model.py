@@ -0,0 +1,77 @@
+""" Test closed-form solution of the compartmental model"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+
+import compartmental_model
+reload(compartmental_model)
+
+def rk4_prevalence(i, r, f, m_all, C0, ages, num_step=10):
+    """ Reference solution, with background mortality, by Runge-Kutta 4"""
+    def ode(j, x):
+        S, C = x
+        other = m_all[j] - f[j] * C / (S + C)
+        return pl.array([-(i[j] + other)*S + r[j]*C,
+                         i[j]*S - (r[j] + other + f[j])*C])
+
+    x = pl.array([1.-C0, C0])
+    p = [C0]
+    for j in range(len(ages)-1):
+        h = (ages[j+1] - ages[j]) / float(num_step)
+        for step in range(num_step):
+            k1 = h*ode(j, x)
+            k2 = h*ode(j, x + .5*k1)
+            k3 = h*ode(j, x + .5*k2)
+            k4 = h*ode(j, x + k3)
+            x = x + (k1 + 2.*k2 + 2.*k3 + k4) / 6.
+        p.append(x[1] / x.sum())
+    return pl.array(p)
+
+def test_prevalence_matches_rk4():
+    ages = pl.arange(101.)
+    pl.seed(12345)
+    for r_scale in [0., .1]:
+        i = pl.exp(pl.randn(101) - 4.)
+        r = r_scale * pl.exp(pl.randn(101))
+        f = pl.exp(pl.randn(101) - 3.)
+        m_all = .01*pl.ones(101)
+
+        p = compartmental_model.prevalence(i, r, f, .02, ages)
+        assert pl.allclose(p, rk4_prevalence(i, r, f, m_all, .02, ages), atol=1.e-6)
+
+def test_prevalence_irregular_ages():
+    ages = pl.array([0., 1., 5., 10., 20., 40., 60., 80., 100.])
+    i = .01*pl.ones(len(ages))
+    r = .05*pl.ones(len(ages))
+    f = .02*pl.ones(len(ages))
+
+    p = compartmental_model.prevalence(i, r, f, 0., ages)
+    assert pl.allclose(p, rk4_prevalence(i, r, f, .01*pl.ones(len(ages)), 0., ages, 100), atol=1.e-6)
+
+def test_prevalence_zero_rates():
+    ages = pl.arange(101.)
+    p = compartmental_model.prevalence(pl.zeros(101), pl.zeros(101), pl.zeros(101), 0., ages)
+    assert pl.all(p == 0.)
+
+    p = compartmental_model.prevalence(pl.zeros(101), pl.zeros(101), pl.zeros(101), .1, ages)
+    assert pl.allclose(p, .1)
+
+def test_prevalence_batch():
+    ages = pl.arange(101.)
+    pl.seed(12345)
+    i = pl.exp(pl.randn(20, 101) - 4.)
+    r = pl.exp(pl.randn(20, 101) - 2.)
+    f = pl.exp(pl.randn(20, 101) - 3.)
+    C0 = pl.rand(20) * .1
+
+    p = compartmental_model.prevalence(i, r, f, C0, ages)
+    assert p.shape == (20, 101)
+    for d in range(20):
+        assert pl.allclose(p[d], compartmental_model.prevalence(i[d], r[d], f[d], C0[d], ages))
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -45,6 +45,38 @@ def test_consistent_model_forward():
     print vars['p']['mu_age'].value[::10].round(3)
 
 
+def test_consistent_model_closed_form():
+    m = data.ModelData()
+    vars = ism.consistent(m, 'all', 'total', 'all', {})
+    vars_cf = ism.consistent(m, 'all', 'total', 'all', {}, ode_solver='closed_form')
+
+    for t in 'irf':
+        for n, n_cf in zip(vars[t]['gamma'], vars_cf[t]['gamma']):
+            n.value = n_cf.value = pl.log(.01)
+    vars['logit_C0'].value = vars_cf['logit_C0'].value = -5.
+
+    assert pl.allclose(vars['p']['mu_age'].value, vars_cf['p']['mu_age'].value, atol=1.e-6)
+
+def test_linearize_ode():
+    m = data.ModelData()
+    vars = ism.consistent(m, 'all', 'total', 'all', {})
+    for t in 'irf':
+        for n in vars[t]['gamma']:
+            n.value = pl.log(.01)
+    p_0 = vars['p']['mu_age'].value
+
+    assert ism.linearize_ode(vars) == True
+    assert pl.allclose(vars['p']['mu_age'].value, p_0)
+
+    # small changes to the knots are matched by the linearization
+    vars['i']['gamma'][3].value += 1.e-4
+    p_lin = vars['p']['mu_age'].value
+    assert not pl.allclose(p_lin, p_0, rtol=0., atol=1.e-12)
+
+    ism.linearize_ode(vars, False)
+    vars['i']['gamma'][3].value += 1.e-10  # clear cached value
+    assert pl.allclose(vars['p']['mu_age'].value, p_lin, rtol=1.e-6, atol=1.e-10)
+
 def test_consistent_model_sim():
     m = data.ModelData()
 
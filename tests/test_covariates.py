@@ -94,6 +94,20 @@ def test_covariate_model_sim_w_hierarchy():
     assert 'x_sex' in vars['X']
     assert len(vars['beta']) == 1
 
+def test_area_indicator_matrix():
+    hierarchy, output_template = data_simulation.small_output()
+    nodes = hierarchy.nodes()
+    ancestors = covariate_model.ancestor_matrix(hierarchy, nodes)
+
+    U = covariate_model.area_indicator_matrix(['USA', 'CAN', 'NAHI', 'all', 'XXX'], nodes, ancestors)
+    U = pandas.DataFrame(U.toarray(), columns=nodes)
+
+    assert list(U.ix[0, ['all', 'super-region-1', 'NAHI', 'USA', 'CAN']]) == [1, 1, 1, 1, 0]
+    assert list(U.ix[1, ['all', 'super-region-1', 'NAHI', 'USA', 'CAN']]) == [1, 1, 1, 0, 1]
+    assert list(U.ix[2, ['all', 'super-region-1', 'NAHI', 'USA', 'CAN']]) == [1, 1, 1, 0, 0]
+    assert U.ix[3].sum() == 1
+    assert U.ix[4].sum() == 0, 'areas not in hierarchy should have no random effects'
+
 def test_fixed_effect_priors():
     model = data.ModelData()
 
@@ -533,6 +547,65 @@ def test_predict_for_w_region_as_reference():
                         (vars['p']['mu_age'].trace().T * fe * re).T.mean(0))
 
 
+def test_predict_for_leaves():
+    # generate simulated data
+    n = 5
+    sigma_true = .025
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, sigma_true)
+    d.hierarchy, d.output_template = data_simulation.small_output()
+
+    # create model and priors
+    vars = ism.age_specific_rate(d, 'p', 'all', 'total', 'all', None, None, None)
+
+    # fit model
+    m = mc.MCMC(vars)
+    for n in m.stochastics:
+        m.use_step_method(mc.NoStepper, n)
+    m.sample(3)
+
+    # constant random effects, so that predictions are deterministic
+    d.parameters['p']['random_effects'] = {}
+    for i, node in enumerate(['USA', 'CAN', 'NAHI', 'super-region-1', 'all']):
+        d.parameters['p']['random_effects'][node] = dict(dist='Constant', mu=(i+1.)/10., sigma=1.e-9)
+
+    pred = covariate_model.predict_for_leaves(d, d.parameters['p'],
+                                              'all', 'total', 'all',
+                                              'NAHI', 'male', 1990,
+                                              vars['p'], 0., pl.inf)
+
+    assert sorted(pred['leaves']) == ['CAN', 'USA']
+    assert pred['draws'].shape == (2, 3, len(vars['p']['ages']))
+
+    # predictions for each leaf match predict_for
+    for l, draws in zip(pred['leaves'], pred['draws']):
+        assert_almost_equal(draws, covariate_model.predict_for(d, d.parameters['p'],
+                                                               'all', 'total', 'all',
+                                                               l, 'male', 1990,
+                                                               0., vars['p'], 0., pl.inf))
+
+    # aggregate matches population weighted predict_for
+    assert_almost_equal(pred['aggregate'], covariate_model.predict_for(d, d.parameters['p'],
+                                                                       'all', 'total', 'all',
+                                                                       'NAHI', 'male', 1990,
+                                                                       1., vars['p'], 0., pl.inf))
+
+def test_aggregate_covariate_shifts():
+    shifts = dict(leaves=['CAN', 'USA', 'MEX'],
+                  log_shift=pl.log([[1., 2.], [3., 4.], [5., 6.]]),
+                  pop=pl.array([1., 3., 6.]))
+
+    shift = covariate_model.aggregate_covariate_shifts(shifts, [['CAN', 'USA'], ['MEX']], True)
+    assert pl.allclose(shift, [[(1.+9.)/4., (2.+12.)/4.], [5., 6.]])
+
+    shift = covariate_model.aggregate_covariate_shifts(shifts, [['CAN', 'USA'], ['MEX']], False)
+    assert pl.allclose(shift, [[pl.sqrt(3.), pl.sqrt(8.)], [5., 6.]])
+
+    assert pl.allclose(covariate_model.aggregate_covariate_shift(shifts, ['USA', 'MEX'], True), [(9.+30.)/9., (12.+36.)/9.])
+
 def assert_almost_equal(x, y):
     log_offset_diff = pl.log(x + 1.e-4) - pl.log(y + 1.e-4)
     assert pl.all(log_offset_diff**2 <= 1.e-4), 'expected approximate equality, found means of:\n  %s\n  %s' % (x.mean(1), y.mean(1))
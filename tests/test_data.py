@@ -78,6 +78,86 @@ def test_save_and_load():
     assert sorted(d.hierarchy.edges()) == sorted(d2.hierarchy.edges()), 'hierarchy should be equal before and after save'
     assert d.nodes_to_fit == d2.nodes_to_fit, 'nodess_to_fit should be equal before and after save'
 
+def test_save_and_load_columnar():
+    import shutil
+    import columnar
+
+    d = data.ModelData.from_gbd_json('tests/dismoditis.json')
+    d.save('tests/tmp')
+
+    d2 = data.ModelData.load_binary('tests/tmp')
+    assert list(d.input_data.columns) == list(d2.input_data.columns), 'columnar load should keep column order'
+    assert pl.all(d.input_data.index == d2.input_data.index)
+    for col in ['value', 'area', 'sex', 'data_type', 'age_start', 'effective_sample_size']:
+        # compare entrywise, counting nan as equal to nan
+        assert pl.all([x == y or (x != x and y != y) for x, y in zip(d.input_data[col], d2.input_data[col])]), \
+            '%s should be equal before and after columnar save' % col
+    for aw, aw2 in zip(d.input_data['age_weights'], d2.input_data['age_weights']):
+        assert list(aw2) == [float(w) for w in aw.split(';') if w], 'age weights should be equal before and after save'
+    assert pl.all(d.output_template['area'] == d2.output_template['area'])
+    assert sorted(d.hierarchy.edges()) == sorted(d2.hierarchy.edges())
+    for n in d.hierarchy:
+        assert d.hierarchy.successors(n) == d2.hierarchy.successors(n), 'columnar load should keep the order of successors'
+    assert d.hierarchy.node['CHN']['pop'] == d2.hierarchy.node['CHN']['pop']
+
+    # read selected columns only
+    d3 = data.ModelData.load('tests/tmp', columns=['data_type', 'value'])
+    assert list(d3.input_data.columns) == ['data_type', 'value']
+
+    # age weights are available as a ragged array
+    meta = columnar.json.load(open('tests/tmp/columnar/input_data/meta.json'))
+    desc = [c for c in meta['columns'] if c['name'] == 'age_weights'][0]
+    values, offsets = columnar.load_column('tests/tmp/columnar/input_data', desc, as_text=False)
+    assert len(offsets) == len(d.input_data.index) + 1
+
+    # columns that are not in the input data are an error, not silently dropped
+    try:
+        data.ModelData.load('tests/tmp', columns=['data_type', 'valeu'])
+        assert 0, 'should raise an error for a missing column'
+    except AssertionError, e:
+        assert 'valeu' in str(e)
+
+    # the columnar copy is stale when any of the files it was saved with changes
+    import os
+    import time
+    future = time.time() + 10
+    os.utime('tests/tmp/hierarchy.json', (future, future))
+    try:
+        data.ModelData.load_binary('tests/tmp')
+        assert 0, 'should raise IOError for a stale columnar copy'
+    except IOError:
+        pass
+    d5 = data.ModelData.load('tests/tmp')
+    assert sorted(d.hierarchy.edges()) == sorted(d5.hierarchy.edges())
+
+    # fall back on csv files when columnar files are not there
+    shutil.rmtree('tests/tmp/columnar')
+    d4 = data.ModelData.load('tests/tmp')
+    assert d.input_data.shape == d4.input_data.shape
+
+def test_columnar_age_weights_precision():
+    import shutil
+
+    d = data.ModelData.from_gbd_json('tests/dismoditis.json')
+    d.save('tests/tmp')
+
+    # save age weights that do not have a short decimal form
+    d2 = data.ModelData.load_binary('tests/tmp')
+    for w in d2.input_data['age_weights']:
+        w[:] = 1. / (3. * max(len(w), 1))
+    d2.save('tests/tmp')
+
+    # columnar files keep the float values
+    d3 = data.ModelData.load_binary('tests/tmp')
+    for w2, w3 in zip(d2.input_data['age_weights'], d3.input_data['age_weights']):
+        assert list(w2) == list(w3), 'age weights should be equal before and after save'
+
+    # csv files keep them as text that parses to the same floats
+    shutil.rmtree('tests/tmp/columnar')
+    d4 = data.ModelData.load('tests/tmp')
+    for w2, w4 in zip(d2.input_data['age_weights'], d4.input_data['age_weights']):
+        assert list(w2) == [float(w) for w in str(w4).split(';') if w and w != 'nan']
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
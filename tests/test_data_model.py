@@ -80,6 +80,36 @@ def test_data_model_lower_bound():
     m = mc.MCMC(vars)
     m.sample(3)
 
+def test_data_model_compress():
+    # generate simulated data, with every row repeated
+    data_type = 'p'
+    n = 20
+    sigma_true = .025
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals(data_type, n, a, pi_age_true, sigma_true)
+    d.input_data = d.input_data.append(d.input_data, ignore_index=True)
+    d.hierarchy, d.output_template = data_simulation.small_output()
+
+    for rate_type in ['poisson', 'neg_binom']:
+        vars = ism.age_specific_rate(d, data_type, rate_type=rate_type)[data_type]
+        vars_c = ism.age_specific_rate(d, data_type, rate_type=rate_type, compress=True)[data_type]
+
+        assert len(vars_c['pi_design'].value) == n
+        assert vars_c['compression_ratio'] == 2.
+        assert pl.all(vars_c['design_index'][:n] == vars_c['design_index'][n:])
+
+        # the model is the same, with pi computed once for each group
+        assert list(vars_c['U'].columns) == list(vars['U'].columns)
+        assert list(vars_c['X'].columns) == list(vars['X'].columns)
+        assert pl.allclose(vars_c['pi'].value, vars['pi'].value)
+        assert pl.allclose(vars_c['p_obs'].logp, vars['p_obs'].logp)
+
+        m = mc.MCMC(vars_c)
+        m.sample(3)
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
@@ -0,0 +1,50 @@
+""" Test derived quantity kernels"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+
+import derived_quantities
+reload(derived_quantities)
+
+def duration_loop(r, m, f):
+    hazard = r + m + f
+    pr_not_exit = pl.exp(-hazard)
+    X = pl.empty(len(hazard))
+    X[-1] = 1 / hazard[-1]
+    for i in reversed(range(len(X)-1)):
+        X[i] = pr_not_exit[i] * (X[i+1] + 1) + 1 / hazard[i] * (1 - pr_not_exit[i]) - pr_not_exit[i]
+    return X
+
+def test_duration():
+    pl.seed(12345)
+    for scale in [.01, 1., 20.]:
+        r, m, f = [scale * pl.exp(pl.randn(101)) for k in range(3)]
+        assert pl.allclose(derived_quantities.duration(r, m, f), duration_loop(r, m, f))
+
+def test_duration_batch():
+    pl.seed(12345)
+    r, m, f = [pl.exp(pl.randn(20, 101) - 2.) for k in range(3)]
+    X = derived_quantities.duration(r, m, f)
+    assert X.shape == (20, 101)
+    for d in range(20):
+        assert pl.allclose(X[d], duration_loop(r[d], m[d], f[d]))
+
+def test_all_derived():
+    pl.seed(12345)
+    p, r, f = [pl.exp(pl.randn(20, 101) - 4.) for k in range(3)]
+    m_all = .01*pl.ones(101)
+
+    d = derived_quantities.all_derived(p, r, f, m_all)
+    m = (m_all - p*f).clip(1.e-6, 1.e6)
+    assert pl.allclose(d['m'], m)
+    assert pl.allclose(d['rr'], (m+f)/m)
+    assert pl.allclose(d['smr'], (m+f)/m_all)
+    assert pl.allclose(d['m_with'], m+f)
+    assert pl.allclose(d['X'][3], duration_loop(r[3], m[3], f[3]))
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,94 @@
+""" Test convergence diagnostics
+
+These tests are use randomized computation, so they might fail
+occasionally due to stochastic variation
+"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import diagnostics
+reload(diagnostics)
+
+def ar1_chains(phi, chains=4, n=4000, dims=2):
+    """ Generate chains x draws x dims array of AR(1) processes with
+    coefficient phi, which have integrated autocorrelation time (1+phi)/(1-phi)"""
+    e = pl.randn(chains, n, dims)
+    x = pl.zeros((chains, n, dims))
+    for t in range(1, n):
+        x[:, t] = phi * x[:, t-1] + e[:, t]
+    return x
+
+def test_autocovariance():
+    x = pl.randn(50, 3)
+    acov = diagnostics.autocovariance(x)
+    assert acov.shape == (50, 3)
+
+    # matches the direct computation at every lag
+    x_c = x - x.mean(axis=0)
+    for k in [0, 1, 10, 49]:
+        assert pl.allclose(acov[k], pl.sum(x_c[:50-k] * x_c[k:], axis=0) / 50.)
+
+def test_ess():
+    x = ar1_chains(.9)
+    ess = diagnostics.effective_sample_size(x)
+    assert ess.shape == (2,)
+    assert pl.all(abs(ess / (4*4000 / 19.) - 1.) < .25), 'ess should be close to the truth'
+
+    # independent draws are all effective
+    ess = diagnostics.effective_sample_size(pl.randn(4, 1000))
+    assert pl.all(ess > 3000)
+
+def test_rhat():
+    x = ar1_chains(.5)
+    assert pl.all(diagnostics.split_rhat(x) < 1.05), 'chains from the same distribution should have rhat near 1'
+
+    # a chain that is shifted, or that drifts, is detected
+    y = x.copy()
+    y[0] += 3.
+    assert pl.all(diagnostics.split_rhat(y) > 1.1)
+
+    y = x.copy()
+    y[0] += pl.linspace(0, 5, 4000).reshape((4000, 1))
+    assert pl.all(diagnostics.split_rhat(y) > 1.1)
+
+def test_autocorrelation():
+    x = ar1_chains(.9, chains=1)[0]
+    acorr = diagnostics.autocorrelation(x, 50)
+    assert acorr.shape == (51, 2)
+    assert pl.all(acorr[0] == 1.)
+    assert pl.allclose(acorr[1], .9, atol=.05) and pl.allclose(acorr[10], .9**10, atol=.15)
+
+def test_iat_and_geweke():
+    x = ar1_chains(.9, chains=1, n=10000)[0]
+    assert pl.all(abs(diagnostics.integrated_autocorrelation_time(x) / 19. - 1.) < .3)
+    assert pl.all(abs(diagnostics.geweke(x)) < 4.)
+
+    # a chain that drifts has large z-scores
+    x += pl.linspace(0, 20, 10000).reshape((10000, 1))
+    assert pl.all(abs(diagnostics.geweke(x)) > 4.)
+
+def test_convergence_report():
+    x = mc.Normal('x', 0., 1., value=pl.zeros(3))
+    y = mc.Uniform('y', 0., 1., value=.5)
+    m = mc.MCMC([x, y])
+    m.sample(1000, 500)
+
+    report = diagnostics.convergence_report([x, y])
+    assert list(report['stoch']) == ['x', 'x', 'x', 'y']
+    assert list(report['dim']) == [0, 1, 2, 0]
+    assert pl.all(report['ess'] > 0) and pl.all(report['ess'] <= 500 * pl.log10(500))
+    assert pl.allclose(report['ess'] * report['iat'], 500)
+    assert report['converged'].dtype == bool
+
+def test_constant_chains():
+    assert pl.all(diagnostics.split_rhat(pl.ones((4, 10, 2))) == 1.)
+    assert pl.all(diagnostics.effective_sample_size(pl.ones((4, 10, 2))) == 40.)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,86 @@
+""" Test content-addressed cache of fit results"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import tempfile
+
+import pylab as pl
+import pandas
+
+import fit_cache
+reload(fit_cache)
+
+def inputs():
+    input_data = pandas.DataFrame(dict(data_type=['p', 'p', 'i'], area=['USA', 'CAN', 'USA'],
+                                       value=[.1, .2, .01], age_start=[0, 10, 20]))
+    emp_priors = {('p', 'mu'): pl.ones(101)*.1, ('p', 'sigma'): pl.ones(101)*.01}
+    parameters = dict(p=dict(smoothness=dict(amount='Slightly'), random_effects={}), ages=range(101))
+    settings = dict(region='north_america_high_income', sex='male', year=2005, fast_fit=False)
+    return input_data, emp_priors, parameters, settings
+
+def test_input_hash():
+    key = fit_cache.input_hash(*inputs())
+    assert key == fit_cache.input_hash(*inputs()), 'hash should be stable'
+
+    # a change to any input changes the hash
+    input_data, emp_priors, parameters, settings = inputs()
+    input_data['value'][1] = .21
+    assert key != fit_cache.input_hash(input_data, emp_priors, parameters, settings)
+
+    input_data, emp_priors, parameters, settings = inputs()
+    emp_priors['p', 'mu'][50] = .11
+    assert key != fit_cache.input_hash(input_data, emp_priors, parameters, settings)
+
+    input_data, emp_priors, parameters, settings = inputs()
+    parameters['p']['smoothness']['amount'] = 'Very'
+    assert key != fit_cache.input_hash(input_data, emp_priors, parameters, settings)
+
+    input_data, emp_priors, parameters, settings = inputs()
+    settings['fast_fit'] = True
+    assert key != fit_cache.input_hash(input_data, emp_priors, parameters, settings)
+
+    # nan values hash consistently
+    input_data, emp_priors, parameters, settings = inputs()
+    input_data['value'][1] = pl.nan
+    assert fit_cache.input_hash(input_data) == fit_cache.input_hash(input_data.copy())
+
+def test_store_and_restore():
+    dir = tempfile.mkdtemp()
+    for d in ['json', 'image', 'posterior']:
+        os.makedirs('%s/%s' % (dir, d))
+    outputs = {'json/dm-1-posterior-asia_east-male-2005.json': '{"params": {}}',
+               'image/posterior-asia_east+male+2005.png': 'png',
+               'posterior/data-p-asia_east+male+2005.csv': 'data',
+               'posterior/dm-1-prevalence-asia_east-male-2005.csv': 'draws',
+               'posterior/dm-1-prevalence-asia_east-female-2005.csv': 'other sex'}
+    for f, contents in outputs.items():
+        open('%s/%s' % (dir, f), 'w').write(contents)
+
+    files = fit_cache.output_files(dir, 1, 'asia_east', 'male', 2005)
+    assert sorted(files) == sorted([f for f in outputs if 'female' not in f])
+
+    key = fit_cache.input_hash(*inputs())
+    assert not fit_cache.restore(dir, key), 'nothing stored yet'
+
+    fit_cache.store(dir, key, files)
+    for f in files:
+        os.remove('%s/%s' % (dir, f))
+
+    assert fit_cache.restore(dir, key)
+    for f in files:
+        assert open('%s/%s' % (dir, f)).read() == outputs[f]
+
+    assert not fit_cache.restore(dir, fit_cache.input_hash('different inputs'))
+
+    # a fit with no output files can be stored, but is never restored
+    key = fit_cache.input_hash('no outputs')
+    fit_cache.store(dir, key, [])
+    assert os.path.exists('%s/manifest.json' % fit_cache.cache_dir(dir, key))
+    assert not fit_cache.restore(dir, key)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,103 @@
+""" Test model fitting routines
+
+These tests are use randomized computation, so they might fail
+occasionally due to stochastic variation
+"""
+
+# matplotlib will open windows during testing unless you do the following
+import matplotlib
+matplotlib.use("AGG")
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import data
+import ism
+import data_simulation
+import fit_model
+import fit
+reload(fit_model)
+reload(fit)
+
+def simulated_model(n=50):
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, .025)
+    d.hierarchy, d.output_template = data_simulation.small_output()
+
+    d.vars += ism.age_specific_rate(d, 'p', reference_area='all', reference_sex='total', reference_year='all',
+                                    mu_age=None, mu_age_parent=None, sigma_age_parent=None)
+    return d
+
+def simulated_vars(n=50):
+    return simulated_model(n).vars['p']
+
+def test_data_initial_vals():
+    vars = simulated_vars()
+    fit_model.find_data_initial_vals(vars)
+
+    # the age pattern starts at the level of the data, not at the prior mean of the knots
+    mu = vars['mu_age'].value
+    level = pl.median(vars['data']['value'])
+    assert pl.all(mu[10:90] > level / 10.) and pl.all(mu[10:90] < level * 10.)
+
+def test_joint_map():
+    pl.seed(12345)
+    vars = simulated_vars()
+    logp_0 = mc.Model(vars).logp
+
+    evals = fit_model.find_joint_map(vars, 'fmin_l_bfgs_b', .001, False)
+    assert evals > 0
+    logp_joint = mc.Model(vars).logp
+    assert logp_joint > logp_0, 'MAP should improve the log-posterior'
+
+    # fit the same simulated data with sequential Powell fits, as fit_asr does with map_method='fmin_powell'
+    pl.seed(12345)
+    vars = simulated_vars()
+    fit_model.find_asr_initial_vals(vars, 'fmin_powell', .001, False)
+    mc.MAP(vars).fit(method='fmin_powell', tol=.001, verbose=False)
+    logp_powell = mc.Model(vars).logp
+
+    assert logp_joint > logp_powell - .01*abs(logp_powell), \
+        'joint MAP should reach the log-posterior of the Powell fits, but got %f and %f' % (logp_joint, logp_powell)
+
+def test_gradient_map_outside_support():
+    # the log-posterior increases up to the edge of its support at 4, so
+    # the optimizer steps outside of it, and must come back
+    x = mc.Uniform('x', 0., 10., value=1.)
+    @mc.potential
+    def edge(x=x):
+        if x > 4.:
+            return -pl.inf
+        return x
+
+    for method in ['fmin_l_bfgs_b', 'fmin_tnc']:
+        x.value = 1.
+        fit_model.find_gradient_map({}, [x, edge], method, .001, False)
+        assert 3.5 < x.value <= 4., 'should stop inside the support, near its edge'
+
+def test_multi_chain():
+    model = simulated_model()
+    map, mcmc = fit.fit_asr(model, 'p', iter=600, burn=200, thin=4, map_method='fmin_l_bfgs_b',
+                            chains=3, max_iter=1400, min_ess=50, max_rhat=1.2)
+
+    # sampling continues in blocks of iter-burn until converged or max_iter
+    result = mcmc.convergence
+    assert result['iter'] in [600, 1000, 1400]
+    assert len(result['ess']) == len(result['rhat']) == len(result['names'])
+    assert result['converged'] == (pl.all(result['ess'] >= 50) and pl.all(result['rhat'] <= 1.2))
+
+    # the draws of all chains are merged in the traces
+    n = 3 * (result['iter'] - 200) / 4
+    assert model.vars['p']['mu_age'].trace().shape == (n, 101)
+    assert mcmc.trace('deviance')[:].shape == (n,)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
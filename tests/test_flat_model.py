@@ -0,0 +1,94 @@
+""" Test flattened log-posterior
+
+These tests are use randomized computation, so they might fail
+occasionally due to stochastic variation
+"""
+
+# matplotlib will open windows during testing unless you do the following
+import matplotlib
+matplotlib.use("AGG")
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import data
+import ism
+import data_simulation
+import flat_model
+reload(flat_model)
+
+def asr_model():
+    # generate simulated data, with covariates and a hierarchy for random effects
+    n = 50
+    sigma_true = .025
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals('p', n, a, pi_age_true, sigma_true)
+    d.input_data['area'] = ['USA', 'CAN', 'NAHI', 'all', 'USA'] * (n/5)
+    d.hierarchy, d.output_template = data_simulation.small_output()
+
+    # include a truncated normal prior on a random effect, and a normal prior on a fixed effect
+    d.parameters['p']['random_effects'] = dict(CAN=dict(dist='TruncatedNormal', mu=.1, sigma=.5, lower=-1., upper=1.))
+    d.parameters['p']['fixed_effects'] = dict(x_0=dict(dist='Normal', mu=.2, sigma=.1))
+
+    vars = ism.age_specific_rate(d, 'p',
+                                 reference_area='all', reference_sex='total', reference_year='all',
+                                 mu_age=None, mu_age_parent=None, sigma_age_parent=None)
+    return vars['p']
+
+def test_logp_matches_pymc():
+    vars = asr_model()
+    m = mc.Model(vars)
+
+    for transform in [True, False]:
+        flat = flat_model.flatten(vars, transform)
+        x0 = flat['x0']
+        assert len(x0) == sum([pl.size(s.value) for s in m.stochastics])
+        assert pl.allclose(flat['logp'](x0), m.logp), 'logp should match at the initial values'
+
+        for i in range(10):
+            x = x0 + mc.rnormal(0., 10., size=len(x0)) * (transform and .1 or .001)
+            x = pl.array([pl.clip(x_k, lb, ub) for x_k, (lb, ub) in zip(x, flat['bounds'])], dtype=float)
+
+            logp = flat['logp'](x)
+            flat['set_values'](x)
+            assert pl.allclose(logp, m.logp), 'logp should match at random points'
+
+            # the values of the nodes map back to the same point
+            assert pl.allclose(flat['get_x'](), x)
+            for s, v in zip(flat['stochs'], flat['values'](x)):
+                assert pl.allclose(s.value, v)
+
+def test_logp_outside_support():
+    vars = asr_model()
+    flat = flat_model.flatten(vars, transform=False)
+
+    # move the truncated normal random effect outside its bounds
+    x = flat['x0'].copy()
+    k = [s.__name__ for s in flat['stochs']].index('alpha_p_CAN')
+    x[flat['slices'][k]] = 2.
+    assert flat['logp'](x) == -pl.inf
+
+def test_logit_transform():
+    vars = asr_model()
+    flat = flat_model.flatten(vars, transform=True)
+
+    # every point is inside the support, so logp is finite even far out on the logit scale
+    x = flat['x0'].copy()
+    k = [s.__name__ for s in flat['stochs']].index('alpha_p_CAN')
+    x[flat['slices'][k]] = 50.
+    assert pl.isfinite(flat['logp'](x))
+    assert flat['bounds'][flat['slices'][k].start] == (None, None)
+
+    # the jacobian term is only included on request
+    assert flat['logp'](x, jacobian=True) != flat['logp'](x)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
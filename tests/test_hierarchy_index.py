@@ -0,0 +1,76 @@
+""" Test array index of the area hierarchy"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import networkx as nx
+
+import hierarchy_index
+reload(hierarchy_index)
+
+def deep_hierarchy(width=3, depth=7):
+    """ Make a hierarchy deeper than the five levels of the GBD hierarchy,
+    with width children for each node above depth"""
+    G = nx.DiGraph()
+    G.add_node('all')
+    parents = ['all']
+    for d in range(1, depth+1):
+        children = []
+        for p in parents:
+            for k in range(width):
+                c = '%s_%d' % (p, k)
+                G.add_edge(p, c)
+                children.append(c)
+        parents = children
+    return G
+
+def test_index_matches_networkx():
+    G = deep_hierarchy()
+    index = hierarchy_index.build(G)
+
+    assert len(index['nodes']) == G.number_of_nodes()
+    assert index['depth'].max() == 7
+    assert hierarchy_index.levels(index) == 8, 'deep hierarchies need more than 5 levels of sigma_alpha'
+    assert index['ancestors'].shape == (G.number_of_nodes(), 8)
+
+    for n in G:
+        i = index['id'][n]
+        assert hierarchy_index.path(index, n) == nx.shortest_path(G, 'all', n)
+        assert index['depth'][i] == nx.shortest_path_length(G, 'all', n)
+        assert set(hierarchy_index.subtree(index, n)) == set(nx.dfs_preorder_nodes(G, n))
+        assert index['leaf'][i] == (G.successors(n) == [])
+
+    # breadth-first order of leaves, as networkx finds them
+    for n in ['all', 'all_1', 'all_1_2']:
+        leaves = [l for l in nx.traversal.bfs_tree(G, n) if G.successors(l) == []]
+        assert hierarchy_index.leaves(index, n) == leaves
+    assert hierarchy_index.leaves(index, 'all_1_2_0_1_0_2_1') == ['all_1_2_0_1_0_2_1']
+
+def test_subtree_tests():
+    G = deep_hierarchy(width=2, depth=4)
+    index = hierarchy_index.build(G)
+
+    areas = ['all_0_1', 'all_0_1_1_0', 'all_1_0', 'all', 'not_an_area']
+    assert list(hierarchy_index.in_subtree(index, areas, 'all_0')) == [True, True, False, False, False]
+    assert hierarchy_index.path(index, 'all_0_1_1_0', 'all_0_1') == ['all_0_1', 'all_0_1_1', 'all_0_1_1_0']
+
+    A = hierarchy_index.row_ancestors(index, areas)
+    assert A.shape == (5, 5)
+    assert [index['nodes'][j] for j in A[1] if j >= 0] == nx.shortest_path(G, 'all', 'all_0_1_1_0')
+    assert pl.all(A[3, 1:] == -1)
+    assert pl.all(A[4] == -1), 'areas not in hierarchy should have no ancestors'
+
+def test_index_of_subtree():
+    G = deep_hierarchy(width=2, depth=3)
+    index = hierarchy_index.build(G, 'all_1')
+
+    assert index['nodes'][0] == 'all_1'
+    assert len(index['nodes']) == 7
+    assert 'all_0' not in index['id']
+    assert hierarchy_index.path(index, 'all_1_0_1') == ['all_1', 'all_1_0', 'all_1_0_1']
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,53 @@
+""" Test local job executor"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import tempfile
+
+import job_queue
+reload(job_queue)
+
+def make_jobs(dir, cmds, holds, afters={}):
+    jobs = []
+    for name in sorted(cmds):
+        jobs.append(job_queue.job(name, cmds[name],
+                                  os.path.join(dir, '%s.out' % name),
+                                  os.path.join(dir, '%s.err' % name),
+                                  holds.get(name, []), afters.get(name, [])))
+    return jobs
+
+def test_run_local_order():
+    dir = tempfile.mkdtemp()
+    log = os.path.join(dir, 'log.txt')
+    append = '-c "open(\'%s\', \'a\').write(\'%%s\\\\n\')"' % log
+    cmds = dict(a=append % 'a', b1=append % 'b1', b2=append % 'b2', c=append % 'c')
+    holds = dict(b1=['a'], b2=['a'], c=['b1', 'b2'])
+
+    results = job_queue.run_local(make_jobs(dir, cmds, holds), max_procs=2, poll_interval=.01)
+    assert results == dict(a=0, b1=0, b2=0, c=0)
+
+    order = open(log).read().split()
+    assert order[0] == 'a' and order[-1] == 'c' and sorted(order[1:3]) == ['b1', 'b2']
+
+def test_run_local_retry_and_skip():
+    dir = tempfile.mkdtemp()
+    flag = os.path.join(dir, 'flag')
+    # fails the first time it is run, succeeds the second time
+    flaky = '-c "import os, sys; ok = os.path.exists(\'%s\'); open(\'%s\', \'w\'); print \'attempt\'; sys.exit(not ok)"' % (flag, flag)
+    cmds = dict(a=flaky, b='-c "import sys; sys.exit(3)"', c='-c "pass"', d='-c "pass"')
+    holds = dict(c=['b'])
+    # like SGE -hold_jid, d runs once a and b have finished, even though b failed
+    afters = dict(d=['a', 'b'])
+
+    results = job_queue.run_local(make_jobs(dir, cmds, holds, afters), max_procs=4, retries=1, poll_interval=.01)
+    assert results == dict(a=0, b=3, c=None, d=0)
+
+    # stdout of both attempts is kept
+    assert open(os.path.join(dir, 'a.out')).read().split() == ['attempt', 'attempt']
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
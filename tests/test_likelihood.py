@@ -0,0 +1,68 @@
+""" Test likelihoods with cached data-only terms against the PyMC likelihoods"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import pylab as pl
+import pymc as mc
+
+import likelihood
+reload(likelihood)
+
+def simulated_data(N=50):
+    n = pl.exp(mc.rnormal(8, 1**-2, size=N))
+    n[:3] = 0.
+    k = pl.array(mc.rnegative_binomial(.01*n+1.e-9, 50., size=N), dtype=float)
+    p = k / pl.where(n > 0, n, 1.)
+    pi = mc.runiform(.005, .02, size=N)
+    return p, n, pi
+
+def test_neg_binom():
+    p, n, pi = simulated_data()
+    rows = (n != 0)
+    logp = likelihood.neg_binom(p*n, n, rows)
+    for delta in [5., 50., 1.e12, pl.where(pl.arange(len(n)) % 2, 5., 1.e12)]:
+        delta_rows = delta if pl.shape(delta) == () else delta[rows]
+        assert pl.allclose(logp(pi, delta), mc.negative_binomial_like((p*n)[rows], (pi*n)[rows]+1.e-9, delta_rows))
+
+    # evaluating again gives the same value, since the buffers are overwritten
+    assert logp(pi, 5.) == logp(pi, 5.)
+    assert logp(pi, -1.) == -pl.inf
+
+def test_poisson():
+    p, n, pi = simulated_data()
+    rows = (n != 0)
+    logp = likelihood.poisson(p*n, n, rows)
+    assert pl.allclose(logp(pi), mc.poisson_like((p*n)[rows], (pi*n)[rows]))
+    assert logp(-pi) == -pl.inf
+
+def test_binom():
+    p, n, pi = simulated_data()
+    logp = likelihood.binom(p*n, n)
+    assert pl.allclose(logp(pi), mc.binomial_like(p*n, n, pi+1.e-9))
+    assert logp(pi+1.) == -pl.inf
+
+def test_pooled():
+    p, n, pi = simulated_data()
+    rows = (n != 0)
+    groups = pl.arange(len(n)) % 7
+    pi = pi[groups]
+
+    # rows with the same pi can be pooled without changing the likelihood
+    assert pl.allclose(likelihood.poisson(p*n, n, rows, groups)(pi), likelihood.poisson(p*n, n, rows)(pi))
+    assert pl.allclose(likelihood.binom(p*n, n, groups=groups)(pi), likelihood.binom(p*n, n)(pi))
+
+def test_log_normal():
+    p, n, pi = simulated_data()
+    p += .001
+    s = 1. / pl.sqrt(n)
+    rows = ~pl.isinf(s)
+    logp = likelihood.log_normal(p, s, rows)
+    for sigma in [.01, .1, 1.]:
+        assert pl.allclose(logp(pi, sigma), mc.normal_like(pl.log(p[rows]), pl.log(pi[rows]+1.e-9),
+                                                           1./(sigma**2. + (s[rows]/p[rows])**2.)))
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,64 @@
+""" Test binary population cube"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import csv
+import tempfile
+
+import pylab as pl
+
+import dismod3
+from dismod3 import population
+reload(population)
+
+def write_csv(fname):
+    ages = range(dismod3.settings.MAX_AGE)
+    f = open(fname, 'w')
+    w = csv.writer(f)
+    w.writerow(['Age %d Population' % a for a in ages] + ['Country Code', 'Year', 'Sex'])
+    for i, iso in enumerate(['CAN', 'USA']):
+        for y in dismod3.settings.gbd_years:
+            for s in ['male', 'female']:
+                w.writerow([(i+1.)*(a+1.) for a in ages] + [iso, y, s])
+    f.close()
+
+def test_cube():
+    fname = os.path.join(tempfile.mkdtemp(), 'population.csv')
+    write_csv(fname)
+
+    cube = population.get_cube(fname)
+    assert cube['pop'].shape == (2, len(dismod3.settings.gbd_years), 2, dismod3.settings.MAX_AGE)
+    assert os.path.exists(fname.replace('.csv', '-cube.npy')), 'should save binary file'
+
+    # loading again from the binary file gives the same cube
+    population._cube.clear()
+    cube2 = population.get_cube(fname)
+    assert pl.all(cube2['pop'] == cube['pop']) and cube2['areas'] == ['CAN', 'USA']
+
+    pop = population.population_by_age(cube2)
+    assert pl.all(pop['USA', '2005', 'male'] == 2*pl.arange(1, dismod3.settings.MAX_AGE+1))
+
+    totals = population.aggregate(dict(north_america=['CAN', 'USA'], can=['CAN']), cube2)
+    assert pl.allclose(totals['north_america'], 3*totals['can'])
+
+    total = population.regional_population('USA', 2005, 'total', cube2)
+    assert pl.all(total == pop['USA', '2005', 'male'] + pop['USA', '2005', 'female'])
+
+def test_save_while_mapped():
+    fname = os.path.join(tempfile.mkdtemp(), 'population.csv')
+    write_csv(fname)
+    cube = population.get_cube(fname)
+    cube_fname = fname.replace('.csv', '-cube')
+
+    # saving a new cube replaces the files, without changing the one that is already mapped
+    new_cube = dict(cube, pop=2*pl.array(cube['pop']))
+    population.save(new_cube, cube_fname)
+    assert pl.all(population.load(cube_fname)['pop'] == 2*cube['pop'])
+    assert [f for f in os.listdir(os.path.dirname(fname)) if '.tmp' in f] == [], 'should not leave temporary files'
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -73,6 +73,65 @@ def test_log_normal_model_sim(N=16):
     m = mc.MCMC(vars)
     m.sample(1)
 
+def test_marginal_beta_binom(N=16):
+    # simulate beta-binomial data
+    n = pl.array(pl.exp(mc.rnormal(10, 1**-2, size=N)), dtype=int)
+    k = mc.rbinomial(n, mc.rbeta(.01*1.e4, .99*1.e4, size=N))
+    p = k / pl.array(n, dtype=float)
+
+    vars = dict(mu_age=mc.Uniform('mu_age', 0., 1., value=.01))
+    vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=vars['mu_age']: mu*pl.ones(N))
+    vars.update(rate_model.marginal_beta_binom('sim', vars['mu_interval'], p, n))
+    assert 'pi_latent' not in vars
+
+    # the likelihood is the beta-binomial likelihood of the counts
+    for pi, p_n in [[.01, 1.e4], [.02, 5.e4]]:
+        vars['mu_age'].value = pi
+        vars['p_n'].value = p_n
+        assert pl.allclose(vars['p_obs'].logp, mc.betabin_like(pl.array(p*n, dtype=int), pi*p_n, (1-pi)*p_n, n))
+
+    # non-integer counts p*n are truncated, as in the binomial likelihood of beta_binom
+    p_frac = (k + .7) / pl.array(n, dtype=float)
+    frac_vars = dict(mu_age=mc.Uniform('mu_age', 0., 1., value=.01))
+    frac_vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=frac_vars['mu_age']: mu*pl.ones(N))
+    frac_vars.update(rate_model.marginal_beta_binom('frac', frac_vars['mu_interval'], p_frac, n))
+    assert pl.allclose(frac_vars['p_obs'].logp, mc.betabin_like(pl.array(p_frac*n, dtype=int), .01*1.e4, .99*1.e4, n))
+
+    m = mc.MCMC(vars)
+    m.sample(200, 100)
+    assert vars['p_pred'].trace().shape == (100, N)
+
+def test_predict(N=16):
+    n = pl.array(pl.exp(mc.rnormal(10, 1**-2, size=N)), dtype=int)
+    p = pl.array(mc.rnegative_binomial(n*.01, 50, size=N), dtype=float) / n
+    s = 1./pl.sqrt(n)
+
+    for rate_type in ['binom', 'beta_binom', 'marginal_beta_binom', 'poisson', 'neg_binom', 'normal_model', 'log_normal_model', 'offset_log_normal']:
+        vars = dict(mu_age=mc.Uniform('mu_age', 0., 1., value=.01),
+                    sigma=mc.Uniform('sigma', 0., 10., value=.1),
+                    delta=mc.Uniform('delta', 1., 1000., value=50.))
+        vars['mu_interval'] = mc.Lambda('mu_interval', lambda mu=vars['mu_age']: mu*pl.ones(N))
+        if rate_type in ['binom', 'beta_binom', 'marginal_beta_binom', 'poisson']:
+            vars.update(getattr(rate_model, rate_type)('sim', vars['mu_interval'], p, n))
+        elif rate_type == 'neg_binom':
+            vars.update(rate_model.neg_binom('sim', vars['mu_interval'], vars['delta'], p, n))
+        else:
+            vars.update(getattr(rate_model, rate_type)('sim', vars['mu_interval'], vars['sigma'], p, s))
+
+        # sample without tallying p_pred, and draw the predictions afterwards
+        vars['p_pred'].keep_trace = False
+        m = mc.MCMC(vars)
+        m.sample(200, 100)
+        assert 'p_pred_sim' not in m._funs_to_tally
+
+        p_pred = rate_model.predict(vars['p_pred'])
+        assert p_pred.shape == (100, N), rate_type
+        assert pl.all(pl.isfinite(p_pred)), rate_type
+
+        # the predictions center on pi
+        pi = vars['mu_interval'].trace()
+        assert pl.all(abs(p_pred.mean(axis=0) - pi.mean(axis=0)) < 4 * p_pred.std(axis=0) + 1.e-3), rate_type
+
 if __name__ == '__main__':
     import nose
     nose.runmodule()
@@ -0,0 +1,123 @@
+""" Test on-disk trace database and tally policy"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import shutil
+import tempfile
+
+import pylab as pl
+import pymc as mc
+
+import data
+import data_simulation
+import ism
+import covariate_model
+import trace_db
+reload(trace_db)
+
+def simple_vars():
+    mu = mc.Normal('mu', 0., 1., value=pl.zeros(3))
+    sigma = mc.Uniform('sigma', 0., 10., value=1.)
+
+    @mc.deterministic
+    def pi(mu=mu):
+        return pl.exp(mu)
+
+    @mc.deterministic
+    def mu_interval(pi=pi, sigma=sigma):
+        return pi * sigma
+
+    obs = mc.Normal('obs', mu, sigma**-2, value=[.1, .2, .3], observed=True)
+    return dict(mu=mu, sigma=sigma, pi=pi, mu_interval=mu_interval, obs=obs)
+
+def test_matches_ram():
+    dir = tempfile.mkdtemp()
+    try:
+        for chunk_size in [1, 7, 1000]:
+            vars = simple_vars()
+            m_ram = mc.MCMC(vars)
+            pl.seed(12345)
+            m_ram.sample(250, 50, 2)
+
+            vars = simple_vars()
+            m_disk = mc.MCMC(vars, db=trace_db.Database(dir, chunk_size=chunk_size))
+            pl.seed(12345)
+            m_disk.sample(250, 50, 2)
+
+            for name in ['mu', 'sigma', 'pi', 'mu_interval', 'deviance']:
+                assert pl.allclose(m_ram.trace(name)[:], m_disk.trace(name)[:]), 'draws of %s should match' % name
+            assert m_disk.trace('mu')[:].shape == (100, 3)
+            assert pl.allclose(m_ram.trace('mu').gettrace(thin=5), vars['mu'].trace(thin=5))
+            assert pl.allclose(vars['mu'].stats()['mean'], m_ram.trace('mu')[:].mean(axis=0))
+
+            # a second chain is kept separately
+            m_disk.sample(50)
+            assert len(vars['mu'].trace()) == 50
+            assert len(vars['mu'].trace(chain=None)) == 150
+    finally:
+        shutil.rmtree(dir)
+
+def test_float32():
+    dir = tempfile.mkdtemp()
+    try:
+        vars = simple_vars()
+        m = mc.MCMC(vars, db=trace_db.Database(dir, float32=True))
+        m.sample(100)
+        tr = vars['pi'].trace()
+        assert tr.dtype == float
+        assert pl.allclose(tr, pl.exp(vars['mu'].trace()), rtol=1.e-6)
+    finally:
+        shutil.rmtree(dir)
+
+def test_tally_only():
+    dir = tempfile.mkdtemp()
+    try:
+        vars = simple_vars()
+        trace_db.tally_only(vars, ['pi'])
+        m = mc.MCMC(vars, db=trace_db.Database(dir))
+        m.sample(100)
+
+        assert 'pi' in m._funs_to_tally and 'mu_interval' not in m._funs_to_tally
+        assert 'mu' in m._funs_to_tally and 'sigma' in m._funs_to_tally
+
+        # other deterministics can be recomputed from the draws of the stochs
+        mu_interval = trace_db.recompute(m, vars['mu_interval'])
+        assert mu_interval.shape == (100, 3)
+        assert pl.allclose(mu_interval, pl.exp(vars['mu'].trace()) * vars['sigma'].trace()[:, None])
+    finally:
+        shutil.rmtree(dir)
+
+def test_tally_only_effects():
+    # with zero_re, one random effect of each set of siblings is a deterministic
+    a = pl.arange(0, 100, 1)
+    pi_age_true = .0001 * (a * (100. - a) + 100.)
+    d = data.ModelData()
+    d.input_data = data_simulation.simulated_age_intervals('p', 20, a, pi_age_true, .025)
+    d.input_data['area'] = ['USA', 'CAN'] * 10
+    d.hierarchy, d.output_template = data_simulation.small_output()
+    vars = ism.age_specific_rate(d, 'p', 'all', 'total', 'all', None, None, None, zero_re=True)
+    assert [n for n in vars['p']['alpha'] if isinstance(n, mc.Deterministic)]
+
+    dir = tempfile.mkdtemp()
+    try:
+        trace_db.tally_only(vars)
+        m = mc.MCMC(vars, db=trace_db.Database(dir))
+        m.sample(3)
+
+        # the effects are tallied, since predictions read their traces
+        for n in vars['p']['alpha'] + vars['p']['beta']:
+            if isinstance(n, mc.Node):
+                assert len(n.trace()) == 3
+        pred = covariate_model.predict_for(d, d.parameters['p'],
+                                           'all', 'total', 'all',
+                                           'USA', 'male', 1990,
+                                           0., vars['p'], 0., pl.inf)
+        assert pl.shape(pred) == pl.shape(vars['p']['mu_age'].trace())
+    finally:
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
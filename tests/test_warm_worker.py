@@ -0,0 +1,81 @@
+""" Test warm worker that runs jobs in forked children"""
+
+# add to path, to make importing possible
+import sys
+sys.path += ['.', '..']
+
+import os
+import time
+import socket
+import tempfile
+import types
+
+import warm_worker
+reload(warm_worker)
+
+def start_worker(path):
+    """ start a worker that can run the fake script hello.py"""
+    hello = types.ModuleType('hello')
+    def main():
+        if sys.argv[1:] == ['fail']:
+            raise ValueError, 'job failed'
+        print 'hello', ' '.join(sys.argv[1:])
+    hello.main = main
+    sys.modules['hello'] = hello
+    warm_worker.scripts['hello.py'] = 'hello'
+    warm_worker.preload = lambda: 0.
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            warm_worker.serve(path)
+        finally:
+            os._exit(0)
+
+    for i in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(.01)
+    return pid
+
+def test_submit():
+    dir = tempfile.mkdtemp()
+    path = os.path.join(dir, 'worker.sock')
+    o = os.path.join(dir, 'out.txt')
+    e = os.path.join(dir, 'err.txt')
+    pid = start_worker(path)
+    try:
+        reply = warm_worker.submit(path, 'hello.py "big world"', o, e)
+        assert reply['returncode'] == 0
+        assert reply['seconds'] >= 0. and 'cpu_seconds' in reply and 'startup_seconds' in reply
+        assert open(o).read().startswith('hello big world\n')
+
+        reply = warm_worker.submit(path, 'hello.py fail', o, e)
+        assert reply['returncode'] == 1
+        assert 'ValueError: job failed' in open(e).read()
+
+        reply = warm_worker.submit(path, 'not_a_script.py', o, e)
+        assert reply['returncode'] == 2
+
+        assert len(open(path + '.log').readlines()) == 3, 'should log timings of each job'
+
+        # a malformed request gets an error reply, and the worker keeps serving
+        for line in ['not json\n', '["hello.py"]\n', '']:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(path)
+            conn.sendall(line)
+            conn.shutdown(socket.SHUT_WR)
+            reply = warm_worker.json.loads(conn.makefile().readline())
+            conn.close()
+            assert reply['returncode'] == 2 and 'error' in reply
+
+        reply = warm_worker.submit(path, 'hello.py again', o, e)
+        assert reply['returncode'] == 0
+    finally:
+        warm_worker.stop(path)
+        os.waitpid(pid, 0)
+    assert not os.path.exists(path)
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule()
@@ -0,0 +1,224 @@
+""" PyMC trace database that keeps the draws in files, and a policy
+for which nodes to tally
+
+The default 'ram' database of mc.MCMC keeps every draw of every tallied
+node in memory, and by default every deterministic is tallied,
+including the vectors with an entry for each row of data (pi, p_pred,
+mu_interval, cum_sum_mu, ...), so the memory needed for a long fit of a
+consistent model grows with the number of rows times the number of
+kept draws.  The Database here appends the draws of each node and
+chain to its own file in chunks of chunk_size draws, optionally as
+float32, and memory-maps the file when the trace is read, so that the
+memory used while sampling does not depend on the length of the chain.
+tally_only() turns off the traces of all deterministics except the
+outputs that are used after fitting, and recompute() finds the draws
+of any other deterministic from the tallied stochs.  The posterior
+predictions p_pred are not tallied; rate_model.predict draws them
+after sampling.
+
+Example
+-------
+>>> import trace_db
+>>> trace_db.tally_only(model.vars)
+>>> db = trace_db.Database(dir + '/traces/all+total+all', float32=True)
+>>> dismod3.fit.fit_asr(model, 'p', iter=50000, burn=10000, thin=40, db=db)
+>>> model.vars['p']['mu_age'].trace()  # read from dir/traces/all+total+all/mu_age_p.0.dat
+>>> trace_db.recompute(model.mcmc, model.vars['p']['mu_interval'])
+"""
+
+import os
+
+import pylab as pl
+import pymc as mc
+from pymc.database import base
+
+# deterministics that are used after fitting, by name in the vars dict;
+# with zero_re, some of the random effects in alpha are deterministics
+default_outputs = ['mu_age', 'pi', 'delta', 'alpha', 'beta']
+
+class Trace(base.Trace):
+    """ Trace of one node, with one file for each chain"""
+    def __init__(self, name, getfunc=None, db=None):
+        base.Trace.__init__(self, name, getfunc=getfunc, db=db)
+        self._buffer = {}
+        self._index = {}
+        self._length = {}
+
+    def _path(self, chain):
+        return os.path.join(self.db.dbname, '%s.%d.dat' % (self.name, chain))
+
+    def _initialize(self, chain, length):
+        """ Start an empty file for the chain, and a buffer for one chunk of draws"""
+        if self._getfunc is None:
+            self._getfunc = self.db.model._funs_to_tally[self.name]
+
+        value = pl.asarray(self._getfunc())
+        self._shape = value.shape
+        self._dtype = value.dtype
+        if self.db.float32 and value.dtype == pl.float64:
+            self._dtype = pl.dtype(pl.float32)
+
+        self._buffer[chain] = pl.zeros((self.db.chunk_size,) + self._shape, dtype=self._dtype)
+        self._index[chain] = 0
+        self._length[chain] = 0
+        open(self._path(chain), 'wb').close()
+
+    def tally(self, chain):
+        self._buffer[chain][self._index[chain]] = self._getfunc()
+        self._index[chain] += 1
+        if self._index[chain] == self.db.chunk_size:
+            self._flush(chain)
+
+    def _flush(self, chain):
+        """ Append the buffered draws of the chain to its file"""
+        if self._index.get(chain, 0) > 0:
+            f = open(self._path(chain), 'ab')
+            self._buffer[chain][:self._index[chain]].tofile(f)
+            f.close()
+            self._length[chain] += self._index[chain]
+            self._index[chain] = 0
+
+    def _finalize(self, chain):
+        self._flush(chain)
+
+    def truncate(self, index, chain):
+        """ Drop the draws of the chain after the first index"""
+        self._flush(chain)
+        f = open(self._path(chain), 'r+b')
+        f.truncate(index * self._buffer[chain].itemsize * int(pl.prod(self._shape)))
+        f.close()
+        self._length[chain] = index
+
+    def store(self, chain, values):
+        """ Replace the draws of the chain with values, as when merging several chains"""
+        self._index[chain] = 0
+        f = open(self._path(chain), 'wb')
+        pl.asarray(values, dtype=self._dtype).tofile(f)
+        f.close()
+        self._length[chain] = len(values)
+
+    def _chain_values(self, chain):
+        """ Memory-map the file of the chain"""
+        self._flush(chain)
+        if self._length[chain] == 0:
+            return pl.zeros((0,) + self._shape, dtype=self._dtype)
+        return pl.memmap(self._path(chain), dtype=self._dtype, mode='r', shape=(self._length[chain],) + self._shape)
+
+    def _select(self, slicing, chain):
+        if chain is None:
+            values = pl.concatenate([self._chain_values(c) for c in sorted(self._length)])
+        else:
+            values = self._chain_values(range(self.db.chains)[chain])
+
+        # copy the selected draws out of the file, as float64 if they were stored as float32
+        values = values[slicing]
+        if values.dtype == pl.float32:
+            return values.astype(float)
+        return pl.array(values)
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """ Return the draws of the chain, or of all chains concatenated if chain is None"""
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        return self._select(slicing, chain)
+
+    __call__ = gettrace
+
+    def __getitem__(self, index):
+        return self._select(index, getattr(self, '_chain', -1))
+
+    def length(self, chain=-1):
+        if chain is None:
+            return sum([self.length(c) for c in self._length])
+        chain = range(self.db.chains)[chain]
+        return self._length[chain] + self._index[chain]
+
+class Database(base.Database):
+    """ Trace database with a file for each node and chain in directory dbname
+
+    :Parameters:
+      - `dbname` : str, directory for the files, created if it does not exist
+      - `chunk_size` : int, optional, number of draws to buffer in memory before writing
+      - `float32` : bool, optional, store float64 values as float32, to halve the size of the files
+
+    """
+    def __init__(self, dbname, chunk_size=100, float32=False):
+        self.__name__ = 'trace_db'
+        self.__Trace__ = Trace
+        self.dbname = dbname
+        self.chunk_size = chunk_size
+        self.float32 = float32
+        self.trace_names = []
+        self._traces = {}
+        self.chains = 0
+        if not os.path.exists(dbname):
+            os.makedirs(dbname)
+
+    def commit(self):
+        for name, trace in self._traces.items():
+            for chain in trace._index:
+                trace._flush(chain)
+
+    def close(self, *args, **kwargs):
+        self.commit()
+
+def tally_only(vars, outputs=default_outputs):
+    """ Turn off the traces of the deterministics in vars, except for outputs
+
+    :Parameters:
+      - `vars` : dict, or dict of dicts, of PyMC nodes and lists of nodes, e.g. model.vars
+      - `outputs` : list of str, keys of the deterministics to keep tallying
+
+    .. note::
+      - this must be called before mc.MCMC(vars) is created, since that
+        decides which nodes to tally
+      - stochs are always tallied, so that other deterministics can be
+        recomputed from their draws with recompute()
+
+    """
+    # a node can appear under several keys, e.g. as mu_age of one rate type and
+    # as a parent of another, so keep it if any of them is an output
+    keys = {}
+    def find_keys(vars):
+        for key, val in vars.items():
+            if isinstance(val, dict):
+                find_keys(val)
+                continue
+            if isinstance(val, list):
+                nodes = val
+            else:
+                nodes = [val]
+            for n in nodes:
+                if isinstance(n, mc.Deterministic):
+                    keys.setdefault(n, []).append(key)
+    find_keys(vars)
+
+    for n, n_keys in keys.items():
+        n.keep_trace = len([k for k in n_keys if k in outputs]) > 0
+
+def recompute(m, node, chain=-1):
+    """ Find the draws of a deterministic that was not tallied, by
+    setting the stochs to each of their tallied draws in turn
+
+    :Parameters:
+      - `m` : mc.MCMC, after sampling
+      - `node` : PyMC node, a deterministic of the model sampled by m
+      - `chain` : int, optional, the chain to use, or None for all chains
+
+    :Results:
+      - Returns array of the values of node, with one row for each draw
+
+    """
+    stochs = [s for s in m.stochastics if s.__name__ in m._funs_to_tally]
+    traces = [m.trace(s.__name__, chain)[:] for s in stochs]
+    current = [s.value for s in stochs]
+
+    draws = []
+    for i in range(len(traces[0])):
+        for s, tr in zip(stochs, traces):
+            s.value = tr[i]
+        draws.append(pl.copy(node.value))
+
+    for s, v in zip(stochs, current):
+        s.value = v
+    return pl.array(draws)
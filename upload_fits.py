@@ -88,12 +88,6 @@ def merge_data_csvs(id):
     return df
 
 import csv, subprocess
-population_by_age = dict(
-    [[(dismod3.utils.clean(r['Country Code']), int(r['Year']), r['Sex']),
-      [max(.001,float(r['Age %d Population' % i])) for i in range(dismod3.settings.MAX_AGE)]] 
-     for r in csv.DictReader(open(dismod3.settings.CSV_PATH + 'population.csv'))
-     ]
-)
 def dm_to_dta(dm, fname):
     X = ['type, region, sex, year, age, pop, prior, posterior, upper, lower'.split(', ')]
 
@@ -115,9 +109,10 @@ def dm_to_dta(dm, fname):
                         posterior = -99 * pl.ones(100)
                         lower = -99 * pl.ones(100)
                         upper = -99 * pl.ones(100)
+                    pop = dismod3.population.regional_population(r, y, s)
                     for a in range(100):
                         X.append([t, r, s, y, a,
-                                  population_by_age[r,y,s][a],
+                                  pop[a],
                                   prior[a],
                                   posterior[a],
                                   upper[a],
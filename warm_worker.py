@@ -0,0 +1,279 @@
+#!/usr/bin/python2.5
+""" Long-lived worker that runs fitting jobs in forked children
+
+Starting a fitting script costs the imports of pymc, pylab, pandas,
+networkx, and pycppad, the reload() chains in dismod3, and parsing the
+population and country tables, every time.  The worker pays this
+once: it imports the scripts, then listens on a unix socket and forks
+a child for each job it receives, so each job starts with everything
+already loaded.  Each child runs the main() of its script with
+sys.argv set from the job command line, with stdout and stderr
+appended to the job's files.
+
+Every job reports how long it ran, and one line per job is appended
+to the timings log (the socket path + '.log') with the job command,
+return code, wall seconds, cpu seconds, and the seconds the worker
+spent loading at startup, which is the overhead a fresh interpreter
+would have added to the job.
+
+Example
+-------
+
+$ python warm_worker.py serve -s /tmp/dismod_worker.sock &
+$ python warm_worker.py submit -s /tmp/dismod_worker.sock -o out.txt -e err.txt "fit_posterior.py 4222 -r asia_east -s male -y 2005"
+$ python warm_worker.py stop -s /tmp/dismod_worker.sock
+
+With dismod3.settings.WORKER_SOCKET set to the socket path, fit_all,
+refit_missing, and dismod_daemon send their jobs to the worker
+instead of starting a new python process for each.
+"""
+
+import os
+import sys
+import time
+import shlex
+import signal
+import socket
+import traceback
+
+import simplejson as json
+
+# scripts that the worker can run, and the modules that provide their main()
+scripts = {'fit_world.py': 'fit_world',
+           'fit_emp_prior.py': 'fit_emp_prior',
+           'fit_posterior.py': 'fit_posterior',
+           'upload_fits.py': 'upload_fits'}
+
+def preload():
+    """ Import the fitting scripts, and everything they import
+
+    Results
+    -------
+    Returns the number of seconds it took
+    """
+    start = time.time()
+
+    # matplotlib backend setup
+    import matplotlib
+    matplotlib.use("AGG")
+
+    import dismod3
+    for module in scripts.values():
+        __import__(module)
+
+    # dismod3 imports its submodules on first use, so use them all now
+    for name in dismod3._submodules:
+        getattr(dismod3, name)
+
+    return time.time() - start
+
+def serve(path):
+    """ Accept jobs on a unix socket until a stop request arrives
+
+    Parameters
+    ----------
+    path : str
+      Path of the unix socket to listen on
+    """
+    startup = preload()
+    print 'loaded fitting code in %.1f seconds' % startup
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    print 'worker listening on %s' % path
+
+    # finished children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            try:
+                request = json.loads(conn.makefile().readline())
+                if not isinstance(request, dict):
+                    raise ValueError, 'request must be a json object'
+            except ValueError, e:
+                # reply to a malformed request with an error, and keep serving
+                try:
+                    conn.sendall(json.dumps(dict(returncode=2, error='bad request: %s' % e)) + '\n')
+                except socket.error:
+                    pass
+                conn.close()
+                continue
+
+            if request.get('stop'):
+                conn.close()
+                break
+
+            if os.fork() == 0:
+                # the child must never return into the accept loop
+                rc = 1
+                try:
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    reply = run_job(request, startup)
+                    rc = reply['returncode']
+                    log_timings(path + '.log', request, reply)
+                    conn.sendall(json.dumps(reply) + '\n')
+                    conn.close()
+                finally:
+                    os._exit(rc & 0xff)
+            conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+def run_job(request, startup=0.):
+    """ Run a job in this process, which should be a forked child of the worker
+
+    Parameters
+    ----------
+    request : dict
+      With the job command line as 'cmd', and the paths of the files
+      to append stdout and stderr to as 'o' and 'e'
+    startup : float, optional
+      Seconds the worker spent in preload(), to report with the timings
+
+    Results
+    -------
+    Returns dict with the returncode, seconds, and cpu_seconds of the job
+    """
+    start = time.time()
+    cpu_start = sum(os.times()[:2])
+
+    # send output of job to its files
+    for fd, fname in [(1, request['o']), (2, request['e'])]:
+        f = open(fname, 'a')
+        os.dup2(f.fileno(), fd)
+        f.close()
+    sys.stdout = os.fdopen(1, 'w', 0)
+    sys.stderr = os.fdopen(2, 'w', 0)
+
+    # children inherit the random state of the worker, so give each its own
+    import random
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+
+    args = shlex.split(request['cmd'])
+    module = scripts.get(os.path.basename(args[0]))
+    if module == None:
+        print >> sys.stderr, 'warm_worker cannot run %s, only %s' % (args[0], ', '.join(sorted(scripts)))
+        rc = 2
+    else:
+        sys.argv = args
+        try:
+            sys.modules[module].main()
+            rc = 0
+        except SystemExit, e:
+            if e.code == None:
+                rc = 0
+            elif isinstance(e.code, int):
+                rc = e.code
+            else:
+                print >> sys.stderr, e.code
+                rc = 1
+        except:
+            traceback.print_exc()
+            rc = 1
+
+    reply = dict(returncode=rc, seconds=time.time() - start,
+                 cpu_seconds=sum(os.times()[:2]) - cpu_start,
+                 startup_seconds=startup)
+    print 'job finished in %.1f seconds (%.1f cpu seconds), a new python process would have added %.1f seconds to load' \
+        % (reply['seconds'], reply['cpu_seconds'], startup)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return reply
+
+def log_timings(fname, request, reply):
+    """ Append a tab-separated line of the job timings to fname"""
+    try:
+        f = open(fname, 'a')
+        f.write('%s\t%s\t%d\t%.3f\t%.3f\t%.3f\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), request['cmd'],
+                                                  reply['returncode'], reply['seconds'],
+                                                  reply['cpu_seconds'], reply['startup_seconds']))
+        f.close()
+    except IOError:
+        pass
+
+def submit(path, cmd, o, e):
+    """ Run a job on the worker and wait for it to finish
+
+    Parameters
+    ----------
+    path : str
+      Path of the unix socket of the worker
+    cmd : str
+      The script and arguments to run, e.g. 'fit_posterior.py 4222 -r asia_east -s male -y 2005'
+    o, e : str
+      Paths of files to append the stdout and stderr of the job to
+
+    Results
+    -------
+    Returns dict with the returncode, seconds, cpu_seconds, and
+    startup_seconds of the job; returncode is -1 if the job died
+    without replying
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    conn.sendall(json.dumps(dict(cmd=cmd, o=os.path.abspath(o), e=os.path.abspath(e))) + '\n')
+    line = conn.makefile().readline()
+    conn.close()
+    if not line:
+        return dict(returncode=-1)
+    return json.loads(line)
+
+def stop(path):
+    """ Ask the worker listening on path to exit, after the jobs it has started"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    conn.sendall(json.dumps(dict(stop=True)) + '\n')
+    conn.close()
+
+def main():
+    import optparse
+
+    usage = 'usage: %prog [options] serve|stop|submit [job command line]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-s', '--socket', default='',
+                      help='path of unix socket of worker (dismod3.settings.WORKER_SOCKET by default)')
+    parser.add_option('-o', '--stdout', default='/dev/null',
+                      help='file to append stdout of submitted job to')
+    parser.add_option('-e', '--stderr', default='/dev/null',
+                      help='file to append stderr of submitted job to')
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1 or args[0] not in ['serve', 'stop', 'submit'] \
+           or (args[0] == 'submit') != (len(args) == 2):
+        parser.error('incorrect arguments')
+
+    path = options.socket
+    if not path:
+        import dismod3.settings
+        path = dismod3.settings.WORKER_SOCKET
+    if not path:
+        parser.error('no socket given, and dismod3.settings.WORKER_SOCKET is not set')
+
+    if args[0] == 'serve':
+        serve(path)
+    elif args[0] == 'stop':
+        stop(path)
+    else:
+        try:
+            reply = submit(path, args[1], options.stdout, options.stderr)
+        except socket.error, e:
+            print >> sys.stderr, 'could not reach worker on %s: %s' % (path, e)
+            sys.exit(1)
+        if reply['returncode'] == -1:
+            print >> sys.stderr, 'worker child died while running %s' % args[1]
+        elif 'error' in reply:
+            print >> sys.stderr, 'worker rejected %s: %s' % (args[1], reply['error'])
+        sys.exit(reply['returncode'])
+
+if __name__ == '__main__':
+    main()